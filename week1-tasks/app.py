@@ -1,34 +1,593 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import (Flask, Response, render_template, request, jsonify, redirect, url_for, flash,
+                   g, make_response)
+from flask.json.provider import DefaultJSONProvider
+from markupsafe import Markup
+import atexit
+import base64
+import functools
+import hmac
+import itertools
 import json
+import logging
 import os
 import re
-from datetime import datetime
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
+
+from cache import LRUCache
+from changes import DELETE, INSERT, UPDATE, ChangeLog
+from dedup import (DEFAULT_THRESHOLD, WORKERS as DEDUP_WORKERS, find_duplicates, merge_fields,
+                   pick_survivor)
+from indexes import (ContactStats, LazyIndex, LookupIndex, OrderedIndex, PrefixIndex, TimeIndex,
+                     TrigramIndex, created_stamp, fill_index, normalize_email, normalize_phone,
+                     updated_stamp)
+from metrics import ContactMetrics, Registry
+from profiling import RequestProfiler
+from query import QueryError, parse_query, plan_query, with_terms
+from records import ContactRecord
+from snapshots import MappedContacts, SnapshotError
+from storage import default_filename, open_storage
+
+# jsonify turns contact records into the same dicts the API always returned
+class ContactJSONProvider(DefaultJSONProvider):
+    @staticmethod
+    def default(o):
+        if isinstance(o, ContactRecord):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+app.json = ContactJSONProvider(app)
 app.secret_key = 'your-secret-key-change-this'
 
+PAGE_SIZE = 24
+MAX_API_LIMIT = 1000
+MAX_IMPORT_ERRORS = 1000
+EXPORT_CHUNK_LINES = 500
+READ_RETRIES = 20
+# Result and page caches; entries are also limited by the contacts (or HTML
+# characters) they hold so a few huge result lists cannot take all the memory
+CACHE_ENTRIES = int(os.environ.get('CONTACTS_CACHE_ENTRIES', 256))
+CACHE_MAX_CONTACTS = int(os.environ.get('CONTACTS_CACHE_MAX_CONTACTS', 100000))
+CACHE_MAX_HTML = int(os.environ.get('CONTACTS_CACHE_MAX_HTML', 8 * 1024 * 1024))
+# Writes that change more contacts than this clear the caches instead of
+# checking every cached search term against every changed contact
+MAX_PRECISE_INVALIDATIONS = 64
+# Changes kept for /api/changes; clients further behind have to reload
+CHANGE_LOG_SIZE = int(os.environ.get('CONTACTS_CHANGE_LOG_SIZE', 10000))
+SSE_POLL_SECONDS = 1.0
+SSE_KEEPALIVE_SECONDS = 15.0
+MAX_BATCH_OPERATIONS = 10000
+MAX_SUGGESTIONS = 50
+RECENT_DAYS = 7
+MAX_RECENT_DAYS = 3650
+# Orders contacts can be listed in; prefix one with '-' for the reverse
+ORDERS = ('name', 'created_at', 'updated_at')
+# Write-behind: acknowledge writes once they are in memory and save them at
+# most this many seconds later, many at a time (0 saves every write at once).
+# A write that would queue more changes than the limit saves them right away.
+WRITE_BEHIND_DELAY = float(os.environ.get('CONTACTS_WRITE_BEHIND_DELAY', 0))
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get('CONTACTS_WRITE_BEHIND_MAX_PENDING', 1000))
+# Reject a phone number or email address that another contact already has
+UNIQUE_PHONES = os.environ.get('CONTACTS_UNIQUE_PHONES', '') == '1'
+UNIQUE_EMAILS = os.environ.get('CONTACTS_UNIQUE_EMAILS', '') == '1'
+# Request profiling: profile this fraction of requests with cProfile, and
+# with a slow threshold keep only the profiles of requests at least that
+# slow (every request is then a candidate unless a rate is given). The token
+# guards /admin/profiles and lets a request ask to be profiled through the
+# X-Profile-Token header; without it both are disabled.
+PROFILE_SLOW_MS = os.environ.get('CONTACTS_PROFILE_SLOW_MS')
+PROFILE_SAMPLE_RATE = float(os.environ.get('CONTACTS_PROFILE_SAMPLE_RATE',
+                                           1.0 if PROFILE_SLOW_MS else 0.0))
+PROFILE_KEEP = int(os.environ.get('CONTACTS_PROFILE_KEEP', 20))
+PROFILE_TOKEN = os.environ.get('CONTACTS_PROFILE_TOKEN', '')
+
+# Immutable view of the contact book as of one published version
+Snapshot = namedtuple('Snapshot', ['seq', 'contacts', 'keys'])
+
+# Cursors are the position of the last contact on a page, so they stay
+# valid while contacts are added or deleted. In name order that is its name
+# key; in the time orders an (epoch microseconds, name key) pair.
+def encode_cursor(position):
+    text = position if isinstance(position, str) else json.dumps(position)
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, order='name'):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    text = base64.b64decode(padded.encode('ascii'), altchars=b'-_', validate=True).decode('utf-8')
+    if order == 'name':
+        return text
+    position = json.loads(text)
+    if (not isinstance(position, list) or len(position) != 2 or
+            type(position[0]) is not int or not isinstance(position[1], str)):
+        raise ValueError('cursor is not a (time, key) pair')
+    return tuple(position)
+
+# Query parameters that filter on time, and the query terms they stand for.
+# "after" includes the moment given (for a date, that whole day); "before"
+# excludes it. Spaces are accepted in place of the T of ISO timestamps.
+TIME_FILTERS = {'created_after': 'added:>=', 'created_before': 'added:<',
+                'updated_after': 'updated:>=', 'updated_before': 'updated:<'}
+
+def time_filtered(search, args):
+    terms = [prefix + args[name].strip().replace(' ', 'T')
+             for name, prefix in TIME_FILTERS.items() if args.get(name, '').strip()]
+    return with_terms(search, terms)
+
+# Split an order parameter such as '-created_at' into ('created_at', True)
+def parse_order(order):
+    reverse = order.startswith('-')
+    order = order[1:] if reverse else order
+    if order not in ORDERS:
+        raise ValueError(f'order must be one of {", ".join(ORDERS)}, optionally prefixed with -')
+    return order, reverse
+
+# Page results are (contacts, next_cursor) pairs
+def cached_contacts(value):
+    return len(value[0]) if isinstance(value, tuple) else len(value)
+
+# Run a mutating ContactManager method under the storage lock, after picking
+# up whatever other worker processes wrote since this one last looked
+def exclusive(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.storage.locked():
+            self.sync()
+            with self._publishing():
+                return method(self, *args, **kwargs)
+    return wrapper
+
+# Pending work of a ContactManager.batch() block
+class Batch:
+    def __init__(self):
+        self.changes = {}     # name_key -> contact (None for a deletion) to persist
+        self.undo = []        # (name_key, contact before the batch touched it)
+        self.feed = []        # change feed entries to publish after the commit
+        self.discard = False
+        self.committed = False
+    
+    # Throw away everything done in the block when it ends
+    def rollback(self):
+        self.discard = True
+
 class ContactManager:
-    def __init__(self, filename="contacts.json"):
+    def __init__(self, filename="contacts.json", storage="json", write_behind_delay=0,
+                 max_pending=WRITE_BEHIND_MAX_PENDING, unique_phones=False, unique_emails=False,
+                 dedup_workers=0):
         self.filename = filename
-        self.contacts = self.load_contacts()
+        self.storage = open_storage(storage, filename)
+        self.unique_phones = unique_phones
+        self.unique_emails = unique_emails
+        self.dedup_workers = dedup_workers
+        # Sequence lock: odd while a writer is changing the book, so readers
+        # can tell whether what they just read was changed under them
+        self._seq = 0
+        self._write_depth = 0
+        # Held by a writer only while it changes memory, not while it saves
+        self._memory_lock = threading.RLock()
+        self._snapshot = None
+        # Version of what is in memory: bumped once per write that changed
+        # something. While memory matches the stored book the ETag is the
+        # storage's shared version, the same in every worker; otherwise the
+        # instance id keeps it from matching another process's.
+        self.instance_id = os.urandom(4).hex()
+        self.version = 0
+        self.book_version = ('', 0)
+        self._stored = (self.book_version, 0)   # (book version, self.version matching it)
+        self.modified_at = datetime.now(timezone.utc)
+        self._dirty = False
+        # Cache keys all start with the lowercase search term, which is how a
+        # change finds the entries it affects
+        self.result_cache = LRUCache(CACHE_ENTRIES, CACHE_MAX_CONTACTS, sizeof=cached_contacts)
+        self.html_cache = LRUCache(CACHE_ENTRIES, CACHE_MAX_HTML)
+        self._changed_contacts = []
+        self._batch = None
+        self.write_behind_delay = write_behind_delay
+        self.max_pending = max_pending
+        self._pending = {}      # name_key -> contact (None for a deletion) not saved yet
+        self._pending_since = None
+        self._pending_feed = []  # change feed entries of the queued changes
+        self._flush_wakeup = threading.Condition()
+        self._flusher = None
+        self._closing = False
+        self.flushes = 0
+        self.flush_errors = 0
+        self.metrics = ContactMetrics(self)
+        self.metrics.gauge('contacts_pending_writes', "Changes queued by write-behind",
+                           lambda: len(self._pending))
+        self.metrics.callback_counter('contacts_flushes_total', "Write-behind saves",
+                                      lambda: self.flushes)
+        self.metrics.callback_counter('contacts_flush_errors_total', "Write-behind saves that failed",
+                                      lambda: self.flush_errors)
+        for cache_name in ('result_cache', 'html_cache'):
+            cache = getattr(self, cache_name)
+            self.metrics.callback_counter(f'contacts_{cache_name}_hits_total', "Cache hits",
+                                          lambda cache=cache: cache.hits)
+            self.metrics.callback_counter(f'contacts_{cache_name}_misses_total', "Cache misses",
+                                          lambda cache=cache: cache.misses)
+        with self.storage.locked():
+            self.contacts = self.load_contacts()
+            self.book_version = self.storage.shared_version()
+        self._stored = (self.book_version, self.version)
+        self.changes = ChangeLog(CHANGE_LOG_SIZE, self.book_version[1])
+        self.build_indexes()
+        if write_behind_delay > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name='contacts-write-behind',
+                                             daemon=True)
+            self._flusher.start()
     
+    # Contacts are kept as compact records; dicts are only built for output
     def load_contacts(self):
         try:
-            if os.path.exists(self.filename):
-                with open(self.filename, 'r') as file:
-                    return json.load(file)
-            return {}
-        except (json.JSONDecodeError, IOError):
+            with self.metrics.storage_seconds.time('load'):
+                contacts = self.storage.load()
+        except (json.JSONDecodeError, SnapshotError, IOError) as e:
+            self._storage_failed('load', e)
             return {}
+        if isinstance(contacts, MappedContacts):
+            return contacts  # records are decoded from the mapped file when used
+        for name_key, contact in contacts.items():
+            contacts[name_key] = ContactRecord.from_dict(contact)
+        return contacts
     
     def save_contacts(self):
         try:
-            with open(self.filename, 'w') as file:
-                json.dump(self.contacts, file, indent=2)
+            with self.metrics.storage_seconds.time('save'):
+                self.storage.save(self.contacts)
             return True
-        except IOError:
+        except IOError as e:
+            self._storage_failed('save', e)
             return False
     
+    # Callers only get False back, so count and log what went wrong
+    def _storage_failed(self, operation, error):
+        self.metrics.storage_errors.inc(operation)
+        logger.error("Could not %s contacts in %s: %s", operation, self.filename, error)
+    
+    # Persist (name_key, contact) pairs; a contact of None marks a deletion
+    def commit_changes(self, changes):
+        if self._batch is not None:
+            # Persisted together when the batch ends
+            for name_key, contact in changes:
+                self._batch.changes.pop(name_key, None)
+                self._batch.changes[name_key] = contact
+            return True
+        if self._flusher is not None:
+            self._queue_changes(changes)
+            return True
+        try:
+            with self._persisting(), self.metrics.storage_seconds.time('apply'):
+                self.storage.apply(changes, self.contacts)
+        except IOError as e:
+            self._storage_failed('apply', e)
+            return False
+        self._saved()
+        return True
+    
+    # Write-behind: queue changes (newest per contact wins) for the flush thread
+    def _queue_changes(self, changes):
+        with self._flush_wakeup:
+            for name_key, contact in changes:
+                self._pending.pop(name_key, None)
+                self._pending[name_key] = contact
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+                self._flush_wakeup.notify()
+        if len(self._pending) >= self.max_pending:
+            self.flush()
+    
+    # Save every queued change with one storage write. Callers of the
+    # storage lock are always up to date, so other processes' changes are
+    # in memory before a JSON file is rewritten from it.
+    def flush(self):
+        with self.storage.locked():
+            self.sync()
+            with self._flush_wakeup:
+                changes = list(self._pending.items())
+                self._pending = {}
+                self._pending_since = None
+            if not changes:
+                return True
+            feed, self._pending_feed = self._pending_feed, []
+            try:
+                with self._persisting(), self.metrics.storage_seconds.time('apply'):
+                    self.storage.apply(changes, self.contacts)
+            except IOError as e:
+                self._storage_failed('apply', e)
+                self.flush_errors += 1
+                with self._flush_wakeup:
+                    # Retry later, keeping anything queued meanwhile
+                    for name_key, contact in changes:
+                        self._pending.setdefault(name_key, contact)
+                    self._pending_since = time.monotonic()
+                    self._pending_feed[:0] = feed
+                return False
+            self._saved()
+            for entry in feed:
+                self.changes.record(*entry, version=self.book_version[1])
+            self.changes.complete(self.book_version[1])
+            self.flushes += 1
+            return True
+    
+    def _flush_loop(self):
+        while True:
+            with self._flush_wakeup:
+                while self._pending_since is None and not self._closing:
+                    self._flush_wakeup.wait()
+                if self._closing:
+                    return
+                delay = self._pending_since + self.write_behind_delay - time.monotonic()
+                if delay > 0:
+                    self._flush_wakeup.wait(delay)
+                    continue
+            self.flush()
+    
+    # Save queued writes and stop the flush thread; registered with atexit
+    def close(self):
+        if self._flusher is not None:
+            with self._flush_wakeup:
+                self._closing = True
+                self._flush_wakeup.notify()
+            self._flusher.join()
+            self._flusher = None
+        return self.flush() if self._pending else True
+    
+    # Apply changes other processes made; only takes the lock when there are some
+    def sync(self):
+        if not self.storage.changed():
+            return 0
+        with self.storage.locked():
+            with self._publishing():
+                try:
+                    changes = self.storage.refresh(self.contacts)
+                except (json.JSONDecodeError, IOError):
+                    return 0
+                self.book_version = self.storage.shared_version()
+                version = self.book_version[1]
+                for name_key, contact in changes:
+                    if name_key in self._pending:
+                        continue  # our queued write is newer and will overwrite it
+                    # Another process's rename arrives as a delete and an insert
+                    if contact is not None:
+                        contact = ContactRecord.from_dict(contact)
+                        op = UPDATE if name_key in self.contacts else INSERT
+                        self._put(name_key, contact)
+                        self.changes.record(op, name_key, contact, version=version)
+                    elif name_key in self.contacts:
+                        self._remove(name_key)
+                        self.changes.record(DELETE, name_key, version=version)
+            self._saved(self.book_version)
+        return len(changes)
+    
+    # Group writes: inside the block add/update/delete/import only change memory,
+    # and everything is persisted with one commit at the end. If the block
+    # raises, calls rollback() or the commit fails, all of it is undone.
+    @contextmanager
+    def batch(self):
+        if self._batch is not None:
+            yield self._batch  # nested batches join the outer one
+            return
+        with self.storage.locked():
+            self.sync()
+            with self._publishing():
+                batch = self._batch = Batch()
+                try:
+                    yield batch
+                except BaseException:
+                    batch.discard = True
+                    raise
+                finally:
+                    self._batch = None
+                    changes = list(batch.changes.items())
+                    if not batch.discard and (not changes or self.commit_changes(changes)):
+                        batch.committed = True
+                        for entry in batch.feed:
+                            self._feed(*entry)
+                    else:
+                        self._undo(batch)
+    
+    def _undo(self, batch):
+        for name_key, contact in reversed(batch.undo):
+            if contact is not None:
+                self._put(name_key, contact)
+            elif name_key in self.contacts:
+                self._remove(name_key)
+    
+    def _record_change(self, op, name_key, contact=None, old_key=None):
+        if self._batch is not None:
+            self._batch.feed.append((op, name_key, contact, old_key))
+        else:
+            self._feed(op, name_key, contact, old_key)
+    
+    # Feed entries carry the shared write count that saved them, so with
+    # write-behind they wait for the flush
+    def _feed(self, op, name_key, contact=None, old_key=None):
+        if self._flusher is not None:
+            self._pending_feed.append((op, name_key, contact, old_key))
+        else:
+            self.changes.record(op, name_key, contact, old_key, self.book_version[1])
+    
+    # Memory matches the stored book once it is saved or synced, unless
+    # write-behind still has changes queued
+    def _saved(self, book_version=None):
+        self.book_version = book_version or self.storage.shared_version()
+        if not self._pending:
+            self._stored = (self.book_version, self.version)
+    
+    # Writers hold the storage lock; readers never take it and use read() instead
+    @contextmanager
+    def _publishing(self):
+        self._write_depth += 1
+        if self._write_depth == 1:
+            self._memory_lock.acquire()
+            self._seq += 1
+        try:
+            yield
+        finally:
+            self._write_depth -= 1
+            if self._write_depth == 0:
+                self._publish()
+    
+    # End the odd window: readers see everything written to memory so far
+    def _publish(self):
+        self._invalidate_cached()
+        if self._dirty:
+            self._dirty = False
+            self.version += 1
+            self.modified_at = datetime.now(timezone.utc)
+        self.changes.complete(self.book_version[1])
+        self._seq += 1
+        self._memory_lock.release()
+    
+    # Save to storage with the change already published, so readers do not
+    # wait for the disk. The writer still holds the storage lock, and memory
+    # is back in an odd window afterwards for whatever the writer does next.
+    # Nothing is undone here: only a batch or an import takes its changes
+    # back when the save fails, and a single failed write stays in memory.
+    @contextmanager
+    def _persisting(self):
+        if self._write_depth == 0:
+            yield
+            return
+        self._publish()
+        try:
+            yield
+        finally:
+            self._memory_lock.acquire()
+            self._seq += 1
+    
+    # Run a read-only function against a consistent version of the book. It
+    # is retried if a writer was active meanwhile, and only waits for the
+    # writer's in-memory change if writers keep interfering
+    def read(self, func):
+        for _ in range(READ_RETRIES):
+            seq = self._seq
+            if seq % 2 == 0:
+                try:
+                    result = func()
+                except (RuntimeError, KeyError, IndexError):
+                    # "changed size during iteration", or a key or list item removed mid-read
+                    result = None
+                    seq = None
+                if self._seq == seq:
+                    return result
+            time.sleep(0)
+        with self._memory_lock:
+            return func()
+    
+    # Immutable copy of the whole book, shared by readers until the next write.
+    # It costs a copy of every contact, so only whole-book work such as
+    # duplicate detection uses it.
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.seq != self._seq:
+            snapshot = self.read(lambda: Snapshot(self._seq, MappingProxyType(dict(self.contacts)),
+                                                  self.order.snapshot()))
+            self._snapshot = snapshot
+        return snapshot
+    
+    # Create every index from self.contacts. Each index is kept up to date
+    # through add(key, contact) and remove(key, contact). A memory-mapped
+    # snapshot is not read at startup: its indexes are filled on first use.
+    def build_indexes(self):
+        self.result_cache.clear()
+        self.html_cache.clear()
+        indexes = {
+            'search_index': TrigramIndex(
+                lambda c: (c['name'].lower(), c['phone'], c['email'].lower())),
+            'order': OrderedIndex(),
+            'phone_index': LookupIndex('phone', normalize_phone),
+            'email_index': LookupIndex('email', normalize_email),
+            'phone_prefix': PrefixIndex('phone', normalize_phone),
+            'email_prefix': PrefixIndex('email', normalize_email),
+            'created_order': TimeIndex(created_stamp),
+            'updated_order': TimeIndex(updated_stamp),
+            'stats': ContactStats(),
+        }
+        lazy = isinstance(self.contacts, MappedContacts)
+        for attribute, index in indexes.items():
+            if lazy:
+                index = LazyIndex(index, lambda: self.contacts, self._memory_lock)
+            else:
+                fill_index(index, self.contacts)
+            setattr(self, attribute, index)
+        self.indexes = tuple(getattr(self, attribute) for attribute in indexes)
+        self.orders = {'created_at': self.created_order, 'updated_at': self.updated_order}
+        # The indexes the query planner may use, under the names it looks for
+        self.query_indexes = {
+            'text': self.search_index, 'name_prefix': self.order,
+            'phone': self.phone_index, 'email': self.email_index,
+            'phone_prefix': self.phone_prefix, 'email_prefix': self.email_prefix,
+            'added': self.created_order, 'updated': self.updated_order,
+        }
+    
+    def _index_contact(self, name_key, contact):
+        for index in self.indexes:
+            index.add(name_key, contact)
+        self._changed_contacts.append(contact)
+    
+    def _unindex_contact(self, name_key, contact):
+        for index in self.indexes:
+            index.remove(name_key, contact)
+        self._changed_contacts.append(contact)
+    
+    # Drop cached results for the search terms that the contacts changed by
+    # this write (old and new versions) match; the others cannot have changed
+    def _invalidate_cached(self):
+        changed, self._changed_contacts = self._changed_contacts, []
+        if not changed:
+            return
+        if len(changed) > MAX_PRECISE_INVALIDATIONS:
+            self.result_cache.clear()
+            self.html_cache.clear()
+            return
+        stale = lambda key: any(parse_query(key[0]).matches(contact) for contact in changed)
+        self.result_cache.invalidate(stale)
+        self.html_cache.invalidate(stale)
+    
+    # Look up key in cache, or compute and store it. A value computed while a
+    # write was in progress may already be stale, so it is not kept.
+    def cached(self, cache, key, compute):
+        value = cache.get(key)
+        if value is not None:
+            return value
+        seq = self._seq
+        value = compute()
+        if seq % 2 == 0:
+            cache.put(key, value)
+            if self._seq != seq:
+                # A write started meanwhile; its invalidation may have run first
+                cache.discard(key)
+        return value
+    
+    def cache_stats(self):
+        return {'results': self.result_cache.stats(), 'html': self.html_cache.stats()}
+    
+    # Store a contact and keep every index in step with it
+    def _put(self, name_key, contact):
+        old_contact = self.contacts.get(name_key)
+        if self._batch is not None:
+            self._batch.undo.append((name_key, old_contact))
+        if old_contact is not None:
+            self._unindex_contact(name_key, old_contact)
+        self.contacts[name_key] = contact
+        self._index_contact(name_key, contact)
+        self._dirty = True
+    
+    def _remove(self, name_key):
+        contact = self.contacts.pop(name_key)
+        if self._batch is not None:
+            self._batch.undo.append((name_key, contact))
+        self._unindex_contact(name_key, contact)
+        self._dirty = True
+        return contact
+    
     def validate_email(self, email):
         if not email:
             return True  # Email is optional
@@ -36,59 +595,199 @@ class ContactManager:
         return re.match(pattern, email) is not None
     
     def validate_phone(self, phone):
-        cleaned_phone = re.sub(r'[\s\-()]', '', phone)
+        cleaned_phone = normalize_phone(phone)
         return cleaned_phone.isdigit() and 10 <= len(cleaned_phone) <= 15
     
+    # owner is the key of the contact being updated, which may keep its own values
+    def check_contact(self, phone, email, owner=None):
+        if not self.validate_phone(phone):
+            return "Invalid phone number"
+        if email and not self.validate_email(email):
+            return "Invalid email format"
+        if self.unique_phones:
+            for name_key in self.phone_index.lookup(phone):
+                if name_key != owner:
+                    return f"Phone number already belongs to {self.contacts[name_key]['name']}"
+        if self.unique_emails and email:
+            for name_key in self.email_index.lookup(email):
+                if name_key != owner:
+                    return f"Email already belongs to {self.contacts[name_key]['name']}"
+        return None
+    
+    @exclusive
     def add_contact(self, name, phone, email="", address=""):
         name_key = name.lower().strip()
         if name_key in self.contacts:
             return False, "Contact already exists"
         
-        if not self.validate_phone(phone):
-            return False, "Invalid phone number"
+        error = self.check_contact(phone, email)
+        if error:
+            return False, error
         
-        if email and not self.validate_email(email):
-            return False, "Invalid email format"
-        
-        self.contacts[name_key] = {
-            'name': name.strip(),
-            'phone': phone.strip(),
-            'email': email.strip(),
-            'address': address.strip(),
-            'created_at': datetime.now().isoformat()
-        }
+        contact = ContactRecord(
+            name=name.strip(),
+            phone=phone.strip(),
+            email=email.strip(),
+            address=address.strip(),
+            created_at=datetime.now().isoformat()
+        )
+        self._put(name_key, contact)
         
-        if self.save_contacts():
+        if self.commit_changes([(name_key, contact)]):
+            self._record_change(INSERT, name_key, contact)
             return True, "Contact added successfully"
         return False, "Failed to save contact"
     
-    def search_contacts(self, search_term):
-        if not search_term:
-            return list(self.contacts.values())
+    # Add contacts from an iterable of NDJSON lines and persist them with one write
+    @exclusive
+    def import_contacts(self, lines):
+        imported = []
+        rejected = 0
+        errors = []
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+                error = "Invalid JSON"
+            else:
+                error = self._import_error(record)
+            if error:
+                rejected += 1
+                if len(errors) < MAX_IMPORT_ERRORS:
+                    errors.append({'line': line_number, 'error': error})
+                continue
+            
+            name_key = record['name'].lower().strip()
+            now = datetime.now().isoformat()
+            contact = ContactRecord(
+                name=record['name'].strip(),
+                phone=record['phone'].strip(),
+                email=(record.get('email') or '').strip(),
+                address=(record.get('address') or '').strip(),
+                created_at=record.get('created_at') or now,
+                updated_at=record.get('updated_at') or None
+            )
+            self._put(name_key, contact)
+            imported.append(name_key)
         
-        search_term = search_term.lower()
-        results = []
-        for contact in self.contacts.values():
-            if (search_term in contact['name'].lower() or 
-                search_term in contact['phone'] or 
-                search_term in contact['email'].lower()):
-                results.append(contact)
-        return results
+        result = {'imported': len(imported), 'rejected': rejected, 'errors': errors}
+        if imported and not self.commit_changes((k, self.contacts[k]) for k in imported):
+            for name_key in imported:
+                self._remove(name_key)
+            result['imported'] = 0
+            return False, result
+        for name_key in imported:
+            self._record_change(INSERT, name_key, self.contacts[name_key])
+        return True, result
+    
+    def _import_error(self, record):
+        if not isinstance(record, dict):
+            return "Record must be a JSON object"
+        for field in ('name', 'phone', 'email', 'address', 'created_at', 'updated_at'):
+            if record.get(field) is not None and not isinstance(record[field], str):
+                return f"Field '{field}' must be a string"
+        if not (record.get('name') or '').strip():
+            return "Name cannot be empty"
+        if record['name'].lower().strip() in self.contacts:
+            return "Contact already exists"
+        return self.check_contact(record.get('phone') or '', (record.get('email') or '').strip())
+    
+    def search_contacts(self, search_term, order='name', reverse=False):
+        def compute():
+            contacts = self.read(lambda: [
+                contact for position, contact
+                in self.iter_contacts(search_term, order=order, reverse=reverse)])
+            if search_term:
+                self.metrics.search_results.observe(len(contacts))
+            return contacts
+        return self.cached(self.result_cache, (search_term.lower(), 'all', order, reverse), compute)
+    
+    # Yield (position, contact) pairs in the given order, starting after the
+    # given position; see encode_cursor for what a position is. The search
+    # can be a structured query (see query.py), planned over the indexes.
+    def iter_contacts(self, search_term='', after=None, order='name', reverse=False):
+        query = parse_query(search_term)
+        candidates = None
+        if query:
+            candidates = plan_query(query, self.query_indexes, len(self.contacts)).candidates()
+            self.metrics.search_candidates.observe(
+                len(self.contacts) if candidates is None else len(candidates))
+        index = self.orders.get(order)
+        if candidates is None:
+            # No search, or no index selective enough: walk the ordered index
+            positions = (self.order.keys_after(after, reverse) if index is None
+                         else index.items(after, reverse))
+        else:
+            if index is None:
+                positions = sorted(candidates, reverse=reverse)
+            else:
+                positions = sorted(((index.value(self.contacts[k]), k) for k in candidates),
+                                   reverse=reverse)
+            if after is not None:
+                positions = [p for p in positions if (p < after if reverse else p > after)]
+        for position in positions:
+            contact = self.contacts.get(position if index is None else position[1])
+            if contact is None:
+                continue
+            if query.matches(contact):
+                yield position, contact
+    
+    # The plan for a search, with the candidates each step left, without
+    # fetching any contact
+    def explain(self, search_term):
+        def run():
+            plan = plan_query(parse_query(search_term), self.query_indexes, len(self.contacts))
+            return dict(plan.explain(), query=search_term)
+        return self.read(run)
+    
+    def page_contacts(self, search_term, limit, cursor=None, order='name', reverse=False):
+        after = decode_cursor(cursor, order) if cursor else None
+        
+        def compute():
+            page = self.read(lambda: list(itertools.islice(
+                self.iter_contacts(search_term, after, order, reverse), limit + 1)))
+            next_cursor = encode_cursor(page[limit - 1][0]) if len(page) > limit else None
+            return [contact for position, contact in page[:limit]], next_cursor
+        return self.cached(self.result_cache,
+                           (search_term.lower(), 'page', after, limit, order, reverse), compute)
+    
+    # Contacts whose phone number or email matches exactly after normalization
+    def find_by_phone(self, phone):
+        return self.read(lambda: [self.contacts[k] for k in self.phone_index.lookup(phone)])
+    
+    def find_by_email(self, email):
+        return self.read(lambda: [self.contacts[k] for k in self.email_index.lookup(email)])
+    
+    # Up to limit names, phone numbers and email addresses starting with prefix,
+    # each with the name of the contact it belongs to
+    def suggest(self, prefix, limit=10):
+        def collect():
+            name_prefix = prefix.lower()
+            names = [self.contacts[k]['name'] for k in self.order.prefix(name_prefix, limit)] \
+                if name_prefix else []
+            phones = [{'value': self.contacts[k]['phone'], 'name': self.contacts[k]['name']}
+                      for _, k in self.phone_prefix.prefix(prefix, limit)]
+            emails = [{'value': self.contacts[k]['email'], 'name': self.contacts[k]['name']}
+                      for _, k in self.email_prefix.prefix(prefix, limit)]
+            return {'names': names, 'phones': phones, 'emails': emails}
+        return self.read(collect)
     
     def get_contact(self, name):
         name_key = name.lower().strip()
         return self.contacts.get(name_key)
     
+    @exclusive
     def update_contact(self, old_name, name, phone, email="", address=""):
         old_key = old_name.lower().strip()
         if old_key not in self.contacts:
             return False, "Contact not found"
         
-        if not self.validate_phone(phone):
-            return False, "Invalid phone number"
-        
-        if email and not self.validate_email(email):
-            return False, "Invalid email format"
+        error = self.check_contact(phone, email, owner=old_key)
+        if error:
+            return False, error
         
         # If name changed, check if new name already exists
         new_key = name.lower().strip()
@@ -96,54 +795,232 @@ class ContactManager:
             return False, "Contact with new name already exists"
         
         # Update contact
-        contact_data = {
-            'name': name.strip(),
-            'phone': phone.strip(),
-            'email': email.strip(),
-            'address': address.strip(),
-            'created_at': self.contacts[old_key].get('created_at', datetime.now().isoformat()),
-            'updated_at': datetime.now().isoformat()
-        }
+        contact_data = ContactRecord(
+            name=name.strip(),
+            phone=phone.strip(),
+            email=email.strip(),
+            address=address.strip(),
+            created_at=self.contacts[old_key].get('created_at', datetime.now().isoformat()),
+            updated_at=datetime.now().isoformat()
+        )
         
+        changes = []
         # Remove old key if name changed
         if new_key != old_key:
-            del self.contacts[old_key]
+            self._remove(old_key)
+            changes.append((old_key, None))
         
-        self.contacts[new_key] = contact_data
+        self._put(new_key, contact_data)
+        changes.append((new_key, contact_data))
         
-        if self.save_contacts():
+        if self.commit_changes(changes):
+            self._record_change(UPDATE, new_key, contact_data,
+                                old_key=old_key if new_key != old_key else None)
             return True, "Contact updated successfully"
         return False, "Failed to save contact"
     
+    @exclusive
     def delete_contact(self, name):
         name_key = name.lower().strip()
         if name_key not in self.contacts:
             return False, "Contact not found"
         
-        del self.contacts[name_key]
-        if self.save_contacts():
+        self._remove(name_key)
+        if self.commit_changes([(name_key, None)]):
+            self._record_change(DELETE, name_key)
             return True, "Contact deleted successfully"
         return False, "Failed to delete contact"
     
+    # Clusters ({name_key: contact}) of contacts that probably belong to the same
+    # person; see dedup.py. They are found in a snapshot, so writers are not held up.
+    def find_duplicates(self, threshold=DEFAULT_THRESHOLD):
+        contacts = self.snapshot().contacts
+        return [{name_key: contacts[name_key] for name_key in cluster}
+                for cluster in find_duplicates(contacts, threshold, self.dedup_workers)]
+    
+    # Fold contacts into the one named keep (by default the most complete):
+    # its fields win, empty ones are filled from the others, which are
+    # deleted. Every value already belongs to one of them, so none is re-validated.
+    @exclusive
+    def merge_contacts(self, names, keep=None):
+        name_keys = list(dict.fromkeys(name.lower().strip() for name in names))
+        if len(name_keys) < 2:
+            return False, "At least two contacts are needed to merge"
+        for name_key in name_keys:
+            if name_key not in self.contacts:
+                return False, f"Contact '{name_key}' not found"
+        contacts = {name_key: self.contacts[name_key] for name_key in name_keys}
+        keep_key = keep.lower().strip() if keep else pick_survivor(contacts)
+        if keep_key not in contacts:
+            return False, "The contact to keep must be one of the merged contacts"
+        
+        merged = merge_fields(contacts[keep_key],
+                              [contact for k, contact in contacts.items() if k != keep_key])
+        contact_data = ContactRecord(updated_at=datetime.now().isoformat(), **merged)
+        changes = []
+        for name_key in name_keys:
+            if name_key != keep_key:
+                self._remove(name_key)
+                changes.append((name_key, None))
+        self._put(keep_key, contact_data)
+        changes.append((keep_key, contact_data))
+        
+        if self.commit_changes(changes):
+            for name_key, _ in changes[:-1]:
+                self._record_change(DELETE, name_key)
+            self._record_change(UPDATE, keep_key, contact_data)
+            return True, f"Merged {len(name_keys)} contacts into {contact_data.name}"
+        return False, "Failed to save contacts"
+    
+    def etag(self):
+        (book_id, count), version = self._stored
+        if book_id and version == self.version:
+            return f'{book_id}-{count}'
+        return f'{book_id}-{count}-{self.instance_id}-{self.version}'
+    
     def get_stats(self):
-        total = len(self.contacts)
-        with_email = sum(1 for c in self.contacts.values() if c['email'])
-        with_address = sum(1 for c in self.contacts.values() if c['address'])
-        return {
-            'total': total,
-            'with_email': with_email,
-            'with_address': with_address
-        }
+        return self.read(self.stats.as_dict)
+    
+    def get_domain_counts(self, limit=None):
+        return self.read(lambda: self.stats.domain_counts(limit))
+
+# Initialize contact manager (one per worker process)
+storage_kind = os.environ.get('CONTACTS_STORAGE', 'json')
+cm = ContactManager(os.environ.get('CONTACTS_FILE', default_filename(storage_kind)),
+                    storage=storage_kind, write_behind_delay=WRITE_BEHIND_DELAY,
+                    unique_phones=UNIQUE_PHONES, unique_emails=UNIQUE_EMAILS,
+                    dedup_workers=DEDUP_WORKERS)
+# Queued writes are saved when the process exits normally
+atexit.register(cm.close)
+
+# Request latency by route, method and status. Streamed responses (export,
+# the change stream) are timed until their headers are sent.
+http_metrics = Registry()
+request_seconds = http_metrics.histogram(
+    'contacts_http_request_duration_seconds', "Time to handle a request",
+    ('route', 'method', 'status'))
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
 
-# Initialize contact manager
-cm = ContactManager()
+@app.before_request
+def sync_contacts():
+    cm.sync()
+
+@app.after_request
+def record_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_seconds.observe(time.perf_counter() - started, route, request.method,
+                                str(response.status_code))
+    return response
+
+profiler = RequestProfiler(PROFILE_SAMPLE_RATE,
+                           float(PROFILE_SLOW_MS) / 1000 if PROFILE_SLOW_MS else None,
+                           PROFILE_KEEP)
+
+def has_profile_token():
+    token = request.headers.get('X-Profile-Token', '')
+    # compare_digest() only takes ASCII str, so compare the UTF-8 bytes
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+# Registered after sync_contacts, so a profile covers the view, template
+# rendering and JSON encoding rather than picking up other processes' writes
+@app.before_request
+def start_profile():
+    forced = has_profile_token() and not request.path.startswith('/admin/')
+    profile = profiler.start(forced)
+    if profile is not None:
+        g.profile = (profile, time.perf_counter(), forced)
+
+def stop_profile(status):
+    profiled = g.pop('profile', None)
+    if profiled is None:
+        return None, False
+    profile, started, forced = profiled
+    report = profiler.finish(profile, time.perf_counter() - started, {
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'route': request.url_rule.rule if request.url_rule else 'unmatched',
+        'status': status,
+    }, forced)
+    return report, forced
+
+@app.after_request
+def finish_profile(response):
+    report, forced = stop_profile(response.status_code)
+    if report is not None and forced:
+        response.headers['X-Profile-Id'] = str(report['id'])
+    return response
+
+# after_request is skipped when an exception propagates (PROPAGATE_EXCEPTIONS,
+# as under debug=True); the profiler must still stop or it stays busy for good
+@app.teardown_request
+def release_profile(error):
+    stop_profile(500)
+
+# Answer polls with 304 Not Modified while the dataset version is unchanged,
+# before the view runs. The version is read first, so a write that lands
+# while the view runs only makes the response newer than its ETag.
+def conditional(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        etag = cm.etag()
+        modified_at = cm.modified_at
+        last_modified = modified_at.replace(microsecond=0)
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            # The header only has whole seconds, and a later write in the
+            # same second as the client's copy must still count as a change
+            not_modified = bool(request.if_modified_since and
+                                request.if_modified_since >= modified_at)
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
 
 @app.route('/')
 def index():
     search = request.args.get('search', '')
-    contacts = cm.search_contacts(search)
+    cursor = request.args.get('cursor')
+    order = request.args.get('order', 'name')
+    
+    def render_cards():
+        contacts, next_cursor = cm.page_contacts(search, PAGE_SIZE, cursor, *parse_order(order))
+        return Markup(render_template('_contact_cards.html', contacts=contacts, search=search,
+                                      cursor=cursor, next_cursor=next_cursor, order=order))
+    try:
+        # The cards are cached on their own; the stats above them change with every write
+        cards = cm.cached(cm.html_cache, (search.lower(), search, cursor, order), render_cards)
+    except QueryError as e:
+        flash(f'Invalid search: {e}', 'error')
+        return redirect(url_for('index'))
+    except ValueError:
+        flash('Invalid page link', 'error')
+        return redirect(url_for('index', search=search))
     stats = cm.get_stats()
-    return render_template('index.html', contacts=contacts, search=search, stats=stats)
+    return render_template('index.html', cards=cards, search=search, order=order, stats=stats)
+
+# Contacts added since the start of the day `days` ago, newest first: the
+# home page with a date query, so paging, caching and the cards are shared
+@app.route('/recent')
+def recent_contacts():
+    days = request.args.get('days', RECENT_DAYS, type=int)
+    if not 1 <= days <= MAX_RECENT_DAYS:
+        flash(f'days must be between 1 and {MAX_RECENT_DAYS}', 'error')
+        days = RECENT_DAYS
+    since = (datetime.now() - timedelta(days=days)).date().isoformat()
+    return redirect(url_for('index', search=f'added:>={since}', order='-created_at'))
 
 @app.route('/add', methods=['GET', 'POST'])
 def add_contact():
@@ -191,14 +1068,359 @@ def delete_contact(name):
     return redirect(url_for('index'))
 
 @app.route('/api/contacts')
+@conditional
 def api_contacts():
-    search = request.args.get('search', '')
-    contacts = cm.search_contacts(search)
+    try:
+        search = time_filtered(request.args.get('search', ''), request.args)
+        order, reverse = parse_order(request.args.get('order', 'name'))
+        parse_query(search)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if request.args.get('explain') in ('1', 'true'):
+        return jsonify(cm.explain(search))
+    if 'limit' not in request.args and 'cursor' not in request.args:
+        return jsonify(cm.search_contacts(search, order, reverse))
+    
+    limit = request.args.get('limit', 50, type=int)
+    if not 1 <= limit <= MAX_API_LIMIT:
+        return jsonify({'error': f'limit must be between 1 and {MAX_API_LIMIT}'}), 400
+    try:
+        contacts, next_cursor = cm.page_contacts(search, limit, request.args.get('cursor'),
+                                                 order, reverse)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return jsonify({'contacts': contacts, 'next_cursor': next_cursor})
+
+@app.route('/api/contacts/by-phone/<phone>')
+@conditional
+def api_contacts_by_phone(phone):
+    if not normalize_phone(phone):
+        return jsonify({'error': 'Phone number is empty'}), 400
+    contacts = cm.find_by_phone(phone)
+    if not contacts:
+        return jsonify({'error': 'No contact has this phone number'}), 404
     return jsonify(contacts)
 
+@app.route('/api/contacts/by-email/<email>')
+@conditional
+def api_contacts_by_email(email):
+    if not normalize_email(email):
+        return jsonify({'error': 'Email is empty'}), 400
+    contacts = cm.find_by_email(email)
+    if not contacts:
+        return jsonify({'error': 'No contact has this email address'}), 404
+    return jsonify(contacts)
+
+@app.route('/api/contacts/suggest')
+def api_suggest_contacts():
+    limit = request.args.get('limit', 10, type=int)
+    if not 1 <= limit <= MAX_SUGGESTIONS:
+        return jsonify({'error': f'limit must be between 1 and {MAX_SUGGESTIONS}'}), 400
+    return jsonify(cm.suggest(request.args.get('prefix', ''), limit))
+
+@app.route('/api/contacts/export')
+def api_export_contacts():
+    # Each chunk is read like a page, from the name index after the last key
+    # sent, so memory stays flat however large the book is
+    def generate():
+        after = None
+        while True:
+            chunk = cm.read(lambda: list(itertools.islice(cm.iter_contacts(after=after),
+                                                          EXPORT_CHUNK_LINES)))
+            if not chunk:
+                return
+            yield ''.join(json.dumps(contact.to_dict()) + '\n' for name_key, contact in chunk)
+            after = chunk[-1][0]
+    
+    return Response(generate(), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': 'attachment; filename=contacts.ndjson'})
+
+@app.route('/api/contacts/import', methods=['POST'])
+def api_import_contacts():
+    success, result = cm.import_contacts(request.stream)
+    if not success:
+        result['error'] = 'Failed to save contacts'
+        return jsonify(result), 500
+    return jsonify(result)
+
+BATCH_FIELDS = ('name', 'new_name', 'phone', 'email', 'address')
+
+def batch_operation_error(operation):
+    if not isinstance(operation, dict):
+        return "Operation must be a JSON object"
+    if operation.get('op') not in ('create', 'update', 'delete'):
+        return "op must be create, update or delete"
+    for field in BATCH_FIELDS:
+        if operation.get(field) is not None and not isinstance(operation[field], str):
+            return f"Field '{field}' must be a string"
+    if not (operation.get('name') or '').strip():
+        return "Name cannot be empty"
+    if operation.get('new_name') is not None and not operation['new_name'].strip():
+        return "Name cannot be empty"
+    return None
+
+def apply_batch_operation(operation):
+    name = operation['name']
+    if operation['op'] == 'create':
+        return cm.add_contact(name, operation.get('phone') or '', operation.get('email') or '',
+                              operation.get('address') or '')
+    if operation['op'] == 'delete':
+        return cm.delete_contact(name)
+    # Fields left out of an update, or sent as null, keep their current values
+    contact = cm.get_contact(name)
+    if contact is None:
+        return False, "Contact not found"
+    fields = {field: contact[field] if operation.get(field) is None else operation[field]
+              for field in ('phone', 'email', 'address')}
+    return cm.update_contact(name, operation.get('new_name') or contact['name'], **fields)
+
+# Apply a list of create/update/delete operations with one write. Either a
+# JSON list, or {"operations": [...], "atomic": false} to save the valid
+# operations even when others fail; by default one failure rejects them all.
+@app.route('/api/contacts/batch', methods=['POST'])
+def api_batch_contacts():
+    body = request.get_json(silent=True)
+    atomic = True
+    if isinstance(body, dict):
+        atomic = body.get('atomic', True) is not False
+        body = body.get('operations')
+    if not isinstance(body, list):
+        return jsonify({'error': 'Expected a list of operations'}), 400
+    if len(body) > MAX_BATCH_OPERATIONS:
+        return jsonify({'error': f'At most {MAX_BATCH_OPERATIONS} operations per batch'}), 413
+    
+    results = []
+    with cm.batch() as batch:
+        for index, operation in enumerate(body):
+            error = batch_operation_error(operation)
+            if error:
+                success, message = False, error
+            else:
+                success, message = apply_batch_operation(operation)
+            op = operation.get('op') if isinstance(operation, dict) else None
+            results.append({'index': index, 'op': op, 'success': success, 'message': message})
+        failed = sum(1 for result in results if not result['success'])
+        if failed and atomic:
+            batch.rollback()
+    
+    applied = len(results) - failed if batch.committed else 0
+    response = {'committed': batch.committed, 'applied': applied, 'failed': failed,
+                'results': results}
+    if not batch.committed and not (failed and atomic):
+        response['error'] = 'Failed to save contacts'
+        return jsonify(response), 500
+    return jsonify(response), 422 if failed and atomic else 200
+
+# Where a client resumes the change feed: after sequence number `since` if it
+# last read from this process, or else after the shared version it reached
+# ("<book id>-<write count>", the same in every gunicorn worker). None when
+# the client has to reload the whole book.
+def changes_after(since, instance, version, limit=None):
+    found = None
+    if instance == cm.instance_id or (instance is None and version is None):
+        found = cm.changes.after(since, limit=limit)
+    book_id, _, count = (version or '').rpartition('-')
+    if found is None and count.isdigit() and book_id == cm.book_version[0]:
+        found = cm.changes.after(version=int(count), limit=limit)
+    return found
+
+def feed_version(count):
+    return f'{cm.book_version[0]}-{count}'
+
+def changes_gone():
+    return jsonify({'error': 'Changes are no longer available, reload all contacts',
+                    'instance': cm.instance_id, 'latest': cm.changes.latest,
+                    'version': feed_version(cm.changes.version)}), 410
+
+# Changes after sequence number `since` or shared `version`; 410 when the
+# client has to reload the whole book because the changes were dropped
+@app.route('/api/changes')
+def api_changes():
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', MAX_API_LIMIT, type=int)
+    if not 1 <= limit <= MAX_API_LIMIT:
+        return jsonify({'error': f'limit must be between 1 and {MAX_API_LIMIT}'}), 400
+    found = changes_after(since, request.args.get('instance'), request.args.get('version'), limit)
+    if found is None:
+        return changes_gone()
+    changes, latest, version = found
+    return jsonify({'instance': cm.instance_id, 'changes': changes, 'latest': latest,
+                    'version': feed_version(version), 'has_more': latest < cm.changes.latest})
+
+# Event ids hold both cursors; the version is the one before the change's own,
+# because other changes of the same write may still follow
+def sse_event(manager, entry):
+    version = max(entry['version'] - 1, 0)
+    event_id = f"{manager.instance_id}-{entry['seq']}-{manager.book_version[0]}-{version}"
+    return f"id: {event_id}\nevent: change\ndata: {app.json.dumps(entry)}\n\n"
+
+# Push changes as Server-Sent Events. Reconnecting browsers send the id of the
+# last event they received in Last-Event-ID, which resumes the stream there,
+# also when the reconnect reaches another worker.
+@app.route('/api/changes/stream')
+def api_changes_stream():
+    last_event = request.headers.get('Last-Event-ID', '').split('-')
+    if len(last_event) == 4 and last_event[1].isdigit():
+        instance, seq, book_id, version = last_event
+        found = changes_after(int(seq), instance, f'{book_id}-{version}', 0)
+    else:
+        found = cm.changes.after(request.args.get('since', cm.changes.latest, type=int), limit=0)
+    if found is None:
+        return changes_gone()
+    since = found[1]
+    manager = cm
+    
+    def generate():
+        last = since
+        idle = 0.0
+        yield f"retry: {int(SSE_POLL_SECONDS * 1000)}\n\n"
+        while True:
+            entries = manager.changes.since(last, MAX_API_LIMIT)
+            if entries is None:
+                # Fell too far behind; the client has to reload
+                yield "event: reset\ndata: {}\n\n"
+                return
+            if entries:
+                yield ''.join(sse_event(manager, entry) for entry in entries)
+                last = entries[-1]['seq']
+                idle = 0.0
+                continue
+            if idle >= SSE_KEEPALIVE_SECONDS:
+                yield ": keepalive\n\n"
+                idle = 0.0
+            if not manager.changes.wait(last, SSE_POLL_SECONDS):
+                idle += SSE_POLL_SECONDS
+                # Writes from other processes only show up after a sync
+                manager.sync()
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/stats')
+@conditional
 def api_stats():
     return jsonify(cm.get_stats())
 
+@app.route('/api/cache/stats')
+def api_cache_stats():
+    return jsonify(cm.cache_stats())
+
+# Profiles kept by this worker process; all of these need the profile token
+def profile_admin(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not PROFILE_TOKEN:
+            return jsonify({'error': 'Profiling admin is disabled'}), 404
+        if not has_profile_token():
+            return jsonify({'error': 'Missing or wrong X-Profile-Token'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/admin/profiles', methods=['GET', 'DELETE'])
+@profile_admin
+def admin_profiles():
+    if request.method == 'DELETE':
+        profiler.clear()
+    return jsonify({'settings': profiler.settings(), 'profiles': profiler.reports()})
+
+@app.route('/admin/profiles/<int:report_id>')
+@profile_admin
+def admin_profile(report_id):
+    report = profiler.report(report_id)
+    if report is None:
+        return jsonify({'error': 'Profile not found or already dropped'}), 404
+    if request.args.get('format') == 'text':
+        return Response(report['text'], mimetype='text/plain')
+    return jsonify(report)
+
+@app.route('/admin/profiles/settings', methods=['PUT'])
+@profile_admin
+def admin_profile_settings():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    sample_rate = data.get('sample_rate')
+    if sample_rate is not None and (not isinstance(sample_rate, (int, float)) or
+                                    not 0 <= sample_rate <= 1):
+        return jsonify({'error': 'sample_rate must be between 0 and 1'}), 400
+    keep = data.get('keep')
+    if keep is not None and (not isinstance(keep, int) or not 1 <= keep <= 1000):
+        return jsonify({'error': 'keep must be between 1 and 1000'}), 400
+    changes = {'sample_rate': sample_rate, 'keep': keep}
+    if 'slow_ms' in data:
+        slow_ms = data['slow_ms']
+        if slow_ms is not None and (not isinstance(slow_ms, (int, float)) or slow_ms < 0):
+            return jsonify({'error': 'slow_ms must be a positive number or null'}), 400
+        changes['slow_seconds'] = None if slow_ms is None else slow_ms / 1000
+    profiler.configure(**changes)
+    return jsonify(profiler.settings())
+
+def threshold_error(threshold):
+    if isinstance(threshold, bool) or not isinstance(threshold, (int, float)) or \
+            not 0 < threshold <= 1:
+        return 'threshold must be greater than 0 and at most 1'
+    return None
+
+# Clusters of likely duplicates, each with the name of the contact a merge keeps
+@app.route('/api/duplicates')
+@conditional
+def api_duplicates():
+    threshold = request.args.get('threshold', DEFAULT_THRESHOLD, type=float)
+    error = threshold_error(threshold)
+    if error:
+        return jsonify({'error': error}), 400
+    clusters = [{'keep': cluster[pick_survivor(cluster)]['name'],
+                 'contacts': list(cluster.values())}
+                for cluster in cm.find_duplicates(threshold)]
+    return jsonify({'count': len(clusters), 'clusters': clusters})
+
+# Merge one cluster, {"names": [...], "keep": "name"} with keep optional, or
+# with {"all": true, "threshold": 0.9} every cluster /api/duplicates finds.
+# All merges are saved with one write.
+@app.route('/api/duplicates/merge', methods=['POST'])
+def api_merge_duplicates():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    keep = data.get('keep')
+    if data.get('all') is True:
+        threshold = data.get('threshold', DEFAULT_THRESHOLD)
+        error = threshold_error(threshold)
+        if error:
+            return jsonify({'error': error}), 400
+        clusters = [[contact['name'] for contact in cluster.values()]
+                    for cluster in cm.find_duplicates(threshold)]
+        keep = None
+    else:
+        names = data.get('names')
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            return jsonify({'error': 'names must be a list of contact names'}), 400
+        if keep is not None and not isinstance(keep, str):
+            return jsonify({'error': 'keep must be a contact name'}), 400
+        clusters = [names]
+    
+    results = []
+    with cm.batch() as batch:
+        for names in clusters:
+            success, message = cm.merge_contacts(names, keep)
+            results.append({'names': names, 'success': success, 'message': message})
+    merged = sum(1 for result in results if result['success']) if batch.committed else 0
+    response = {'merged': merged, 'results': results}
+    if not batch.committed:
+        response['error'] = 'Failed to save contacts'
+        return jsonify(response), 500
+    return jsonify(response), 200 if merged == len(results) else 422
+
+# Prometheus text format; each worker process reports its own numbers
+@app.route('/metrics')
+def metrics():
+    return Response(cm.metrics.render() + http_metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/stats/domains')
+@conditional
+def api_stats_domains():
+    return jsonify(cm.get_domain_counts(request.args.get('limit', type=int)))
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
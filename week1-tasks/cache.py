@@ -0,0 +1,99 @@
+"""
+Bounded least-recently-used cache with hit, miss and eviction counters.
+
+Entries are evicted when either the entry count or the total size (as
+measured by ``sizeof``) goes over its limit. ``invalidate(predicate)``
+removes only the entries whose key matches, so a write can drop the
+results it affects and leave the rest cached.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """Thread-safe LRU mapping limited by entry count and total size."""
+
+    def __init__(self, max_entries: int, max_size: Optional[int] = None,
+                 sizeof: Callable[[Any], int] = len):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self._sizeof = sizeof
+        self._entries: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self._sizeof(value)
+        if self.max_entries <= 0 or (self.max_size is not None and size > self.max_size):
+            return  # would evict everything else and still not fit
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._size += size
+            while (len(self._entries) > self.max_entries or
+                   (self.max_size is not None and self._size > self.max_size)):
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+
+    def _discard(self, key: Hashable) -> None:
+        del self._entries[key]
+        self._size -= self._sizes.pop(key)
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Remove the entries whose key satisfies ``predicate``; returns how many."""
+        with self._lock:
+            stale = [key for key in self._entries if predicate(key)]
+            for key in stale:
+                self._discard(key)
+            self.invalidations += len(stale)
+            return len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._sizes.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'size': self._size,
+                'max_entries': self.max_entries,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,134 @@
+"""
+Change feed for incremental sync.
+
+``ChangeLog`` keeps the most recent inserts, updates and deletes with
+consecutive sequence numbers, so a client that remembers the last number
+it saw can ask for just the changes after it. Only a bounded number of
+changes is kept; a client that fell further behind has to reload.
+
+Sequence numbers belong to one process. Each change is also labelled with
+the storage's shared write count (see ``Storage.shared_version()``) as of
+when this process saved or read it, which is never lower than the count of
+the write that made it. A client that has every change up to count ``N``
+from one process can therefore resume from any other process with the
+changes labelled above ``N``. It may get a few changes again, which is
+harmless because every change carries the whole contact.
+"""
+
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+
+
+class ChangeLog:
+    """Bounded, thread-safe log of contact changes with increasing sequence numbers.
+
+    ``version`` is the write count the log is complete up to: every change
+    made by writes up to that count has been recorded.
+    """
+
+    def __init__(self, max_entries: int = 10000, version: int = 0):
+        self._entries: deque = deque(maxlen=max_entries)
+        self._latest = 0
+        self._version = version
+        # Clients with a lower version need changes this log does not have
+        self._floor = version
+        self._changed = threading.Condition()
+
+    @property
+    def latest(self) -> int:
+        """Sequence number of the newest change, 0 before the first one."""
+        return self._latest
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def oldest(self) -> int:
+        """Sequence number of the oldest change still kept."""
+        with self._changed:
+            return self._entries[0]['seq'] if self._entries else self._latest + 1
+
+    def record(self, op: str, key: str, contact=None, old_key: Optional[str] = None,
+               version: int = 0) -> Dict:
+        """Append one change; ``old_key`` is set when an update renamed the contact."""
+        with self._changed:
+            self._latest += 1
+            entry = {'seq': self._latest, 'version': version, 'op': op, 'key': key,
+                     'contact': contact}
+            if old_key is not None:
+                entry['old_key'] = old_key
+            if len(self._entries) == self._entries.maxlen:
+                self._floor = max(self._floor, self._entries[0]['version'])
+            self._entries.append(entry)
+            self._changed.notify_all()
+            return entry
+
+    def complete(self, version: int) -> None:
+        """Every change of the writes up to ``version`` has been recorded."""
+        with self._changed:
+            if version > self._version:
+                self._version = version
+                self._changed.notify_all()
+
+    def since(self, seq: int, limit: Optional[int] = None) -> Optional[List[Dict]]:
+        """Changes after ``seq`` (at most ``limit``), or None if some were already dropped."""
+        found = self.after(seq, limit=limit)
+        return None if found is None else found[0]
+
+    def after(self, seq: Optional[int] = None, version: Optional[int] = None,
+              limit: Optional[int] = None) -> Optional[Tuple[List[Dict], int, int]]:
+        """Changes after sequence number ``seq`` of this log or, without one, after
+        write count ``version``; at most ``limit`` of them.
+
+        Returns the changes with the sequence number and version a client has
+        reached once it applied them, or None if some of the changes were
+        already dropped or ``seq`` is not one this log has reached.
+        """
+        with self._changed:
+            oldest = self._entries[0]['seq'] if self._entries else self._latest + 1
+            if seq is not None:
+                if not oldest - 1 <= seq <= self._latest:
+                    return None
+                start = seq - oldest + 1
+            elif version is None or version < self._floor:
+                return None
+            else:
+                start = self._first_after(version)
+            end = len(self._entries)
+            stop = end if limit is None else min(start + limit, end)
+            if seq is None:
+                # One write can make several changes; a client that resumes by
+                # version has to get all of them at once to get past it
+                while start < stop < end and \
+                        self._entries[stop]['version'] == self._entries[stop - 1]['version']:
+                    stop += 1
+            entries = [self._entries[i] for i in range(start, stop)]
+            if stop == end:
+                reached = self._version
+            else:
+                reached = min(self._entries[stop]['version'] - 1, self._version)
+            if version is not None:
+                reached = max(reached, version)
+            return entries, oldest + stop - 1, reached
+
+    def _first_after(self, version: int) -> int:
+        """Index of the first change labelled above ``version``; labels never go down."""
+        low, high = 0, len(self._entries)
+        while low < high:
+            middle = (low + high) // 2
+            if self._entries[middle]['version'] <= version:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def wait(self, seq: int, timeout: float) -> bool:
+        """Block until there is a change after ``seq`` or ``timeout`` seconds pass."""
+        with self._changed:
+            return self._changed.wait_for(lambda: self._latest > seq, timeout)
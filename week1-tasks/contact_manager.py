@@ -1,35 +1,106 @@
 import json
 import os
 import re
-from typing import Dict, List, Optional
+from contextlib import nullcontext
+from typing import Dict, List, Optional, Tuple
+
+from dedup import DEFAULT_THRESHOLD, WORKERS, find_duplicates, merge_fields, pick_survivor
+from indexes import ContactStats, LazyIndex, OrderedIndex, TrigramIndex, fill_index
+from metrics import ContactMetrics
+from query import QueryError, parse_query, plan_query
+from snapshots import MappedContacts, SnapshotError
+from storage import default_filename, open_storage
 
 class ContactManager:
-    def __init__(self, filename: str = "contacts.json"):
-        """Initialize the Contact Manager with a JSON file for persistence."""
+    def __init__(self, filename: str = "contacts.json", storage: str = "json"):
+        """Initialize the Contact Manager with a storage backend for persistence."""
         self.filename = filename
-        self.contacts = self.load_contacts()
+        self.storage = open_storage(storage, filename)
+        self.metrics = ContactMetrics(self)
+        with self.storage.locked():
+            self.contacts = self.load_contacts()
+        self.search_index = self._build_index(TrigramIndex(lambda contact: (contact['name'].lower(),)))
+        self.order = self._build_index(OrderedIndex())
+        self.stats = self._build_index(ContactStats())
+    
+    def _build_index(self, index):
+        """Fill an index now, or on first use when the contacts are read from a mapped snapshot."""
+        if isinstance(self.contacts, MappedContacts):
+            # One thread both reads and writes, so filling needs no lock
+            return LazyIndex(index, lambda: self.contacts, nullcontext())
+        fill_index(index, self.contacts)
+        return index
     
     def load_contacts(self) -> Dict[str, Dict]:
-        """Load contacts from JSON file."""
+        """Load contacts from the storage backend."""
         try:
-            if os.path.exists(self.filename):
-                with open(self.filename, 'r') as file:
-                    return json.load(file)
-            return {}
-        except (json.JSONDecodeError, IOError) as e:
+            with self.metrics.storage_seconds.time('load'):
+                return self.storage.load()
+        except (json.JSONDecodeError, SnapshotError, IOError) as e:
+            self.metrics.storage_errors.inc('load')
             print(f"Error loading contacts: {e}")
             return {}
     
     def save_contacts(self) -> bool:
-        """Save contacts to JSON file."""
+        """Rewrite all contacts to the storage backend."""
+        try:
+            with self.metrics.storage_seconds.time('save'):
+                self.storage.save(self.contacts)
+            return True
+        except IOError as e:
+            self.metrics.storage_errors.inc('save')
+            print(f"Error saving contacts: {e}")
+            return False
+    
+    def commit_changes(self, changes: List[Tuple[str, Optional[Dict]]]) -> bool:
+        """Persist changed contacts; a contact of None marks a deletion."""
         try:
-            with open(self.filename, 'w') as file:
-                json.dump(self.contacts, file, indent=2)
+            with self.metrics.storage_seconds.time('apply'):
+                self.storage.apply(changes, self.contacts)
             return True
         except IOError as e:
+            self.metrics.storage_errors.inc('apply')
             print(f"Error saving contacts: {e}")
             return False
     
+    def sync(self) -> int:
+        """Pick up changes other processes (such as the web app) saved since we last looked."""
+        if not self.storage.changed():
+            return 0
+        with self.storage.locked():
+            try:
+                changes = self.storage.refresh(self.contacts)
+            except (json.JSONDecodeError, IOError) as e:
+                print(f"Error reloading contacts: {e}")
+                return 0
+            for name_key, contact in changes:
+                if contact is not None:
+                    self._store_contact(name_key, contact)
+                elif name_key in self.contacts:
+                    self._remove_contact(name_key)
+        return len(changes)
+    
+    def _index_contact(self, name_key: str, contact: Dict) -> None:
+        """Add a contact to the search index, name order and statistics."""
+        self.search_index.add(name_key, contact)
+        self.order.add(name_key, contact)
+        self.stats.add(name_key, contact)
+    
+    def _store_contact(self, name_key: str, contact: Dict) -> None:
+        """Store a contact, replacing any contact under the same key."""
+        if name_key in self.contacts:
+            self._remove_contact(name_key)
+        self.contacts[name_key] = contact
+        self._index_contact(name_key, contact)
+    
+    def _remove_contact(self, name_key: str) -> Dict:
+        """Remove a contact from memory and from every index."""
+        contact = self.contacts.pop(name_key)
+        self.search_index.remove(name_key, contact)
+        self.order.remove(name_key, contact)
+        self.stats.remove(name_key, contact)
+        return contact
+    
     def validate_email(self, email: str) -> bool:
         """Validate email format using regex."""
         pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
@@ -62,45 +133,67 @@ class ContactManager:
                 print("Error: Invalid email format.")
                 return False
             
-            # Check if contact already exists
-            name_key = name.lower().strip()
-            if name_key in self.contacts:
-                print(f"Error: Contact '{name}' already exists.")
-                return False
-            
-            # Add contact
-            self.contacts[name_key] = {
-                'name': name.strip(),
-                'phone': phone.strip(),
-                'email': email.strip(),
-                'address': address.strip()
-            }
-            
-            if self.save_contacts():
-                print(f"Contact '{name}' added successfully!")
-                return True
-            else:
-                print("Error: Failed to save contact.")
-                return False
+            with self.storage.locked():
+                self.sync()
+                
+                # Check if contact already exists
+                name_key = name.lower().strip()
+                if name_key in self.contacts:
+                    print(f"Error: Contact '{name}' already exists.")
+                    return False
+                
+                # Add contact
+                contact = {
+                    'name': name.strip(),
+                    'phone': phone.strip(),
+                    'email': email.strip(),
+                    'address': address.strip()
+                }
+                self._store_contact(name_key, contact)
+                
+                if self.commit_changes([(name_key, contact)]):
+                    print(f"Contact '{name}' added successfully!")
+                    return True
+                else:
+                    print("Error: Failed to save contact.")
+                    return False
                 
         except Exception as e:
             print(f"Error adding contact: {e}")
             return False
     
     def search_contact(self, search_term: str) -> List[Dict]:
-        """Search for contacts by name (partial match)."""
+        """Search for contacts by name (partial match) or with a query such as name:jo*."""
         try:
             search_term = search_term.lower().strip()
             if not search_term:
                 print("Error: Search term cannot be empty.")
                 return []
             
-            results = []
-            for key, contact in self.contacts.items():
-                if search_term in key or search_term in contact['name'].lower():
-                    results.append(contact)
+            try:
+                query = parse_query(search_term)
+            except QueryError as e:
+                print(f"Error: Invalid search: {e}")
+                return []
+            # Free text only looks at names here, the field the trigram index covers
+            plan = plan_query(query, {'text': self.search_index, 'name_prefix': self.order},
+                              len(self.contacts), text_fields=('name',))
+            candidates = plan.candidates()
+            if candidates is None:
+                # No index narrows it down: scan every contact, already in name order
+                self.metrics.search_candidates.observe(len(self.contacts))
+                candidates = self.order.keys_after()
+            else:
+                self.metrics.search_candidates.observe(len(candidates))
+                candidates = sorted(candidates)
             
-            return results
+            matches = []
+            for key in candidates:
+                if query.matches(self.contacts[key], ('name',)):
+                    matches.append(key)
+            self.metrics.search_results.observe(len(matches))
+            
+            return [self.contacts[key] for key in matches]
         except Exception as e:
             print(f"Error searching contacts: {e}")
             return []
@@ -114,6 +207,8 @@ class ContactManager:
                 return False
             
             contact = self.contacts[name_key]
+            old_key = name_key
+            updates = {}
             print(f"\nUpdating contact: {contact['name']}")
             print("Press Enter to keep current value, or type new value:")
             
@@ -125,10 +220,9 @@ class ContactManager:
                     if new_name.lower() in self.contacts:
                         print(f"Error: Contact '{new_name}' already exists.")
                         return False
-                    # Remove old key and add new one
-                    del self.contacts[name_key]
+                    # The old key is removed once all new values are valid
                     name_key = new_name.lower()
-                contact['name'] = new_name
+                updates['name'] = new_name
             
             # Update phone
             new_phone = input(f"Phone ({contact['phone']}): ").strip()
@@ -136,7 +230,7 @@ class ContactManager:
                 if not self.validate_phone(new_phone):
                     print("Error: Invalid phone number format.")
                     return False
-                contact['phone'] = new_phone
+                updates['phone'] = new_phone
             
             # Update email
             new_email = input(f"Email ({contact['email']}): ").strip()
@@ -144,22 +238,42 @@ class ContactManager:
                 if not self.validate_email(new_email):
                     print("Error: Invalid email format.")
                     return False
-                contact['email'] = new_email
+                updates['email'] = new_email
             
             # Update address
             new_address = input(f"Address ({contact['address']}): ").strip()
             if new_address:
-                contact['address'] = new_address
-            
-            # Save updated contact
-            self.contacts[name_key] = contact
+                updates['address'] = new_address
             
-            if self.save_contacts():
-                print("Contact updated successfully!")
-                return True
-            else:
-                print("Error: Failed to save updated contact.")
-                return False
+            # Save updated contact, re-checking the keys in case another
+            # process changed them while we were prompting
+            with self.storage.locked():
+                self.sync()
+                if old_key not in self.contacts:
+                    print(f"Error: Contact '{name}' was deleted by another user.")
+                    return False
+                if name_key != old_key and name_key in self.contacts:
+                    print(f"Error: Contact '{updates['name']}' already exists.")
+                    return False
+                
+                # Apply only the fields typed in to the current contact, so an
+                # edit made elsewhere while we were prompting is kept. A copy
+                # is edited so a background snapshot never sees half of it.
+                contact = dict(self.contacts[old_key])
+                contact.update(updates)
+                changes = []
+                if name_key != old_key:
+                    self._remove_contact(old_key)
+                    changes.append((old_key, None))
+                self._store_contact(name_key, contact)
+                changes.append((name_key, contact))
+                
+                if self.commit_changes(changes):
+                    print("Contact updated successfully!")
+                    return True
+                else:
+                    print("Error: Failed to save updated contact.")
+                    return False
                 
         except Exception as e:
             print(f"Error updating contact: {e}")
@@ -177,13 +291,18 @@ class ContactManager:
             confirm = input(f"Are you sure you want to delete '{contact_name}'? (y/N): ").lower()
             
             if confirm == 'y' or confirm == 'yes':
-                del self.contacts[name_key]
-                if self.save_contacts():
-                    print(f"Contact '{contact_name}' deleted successfully!")
-                    return True
-                else:
-                    print("Error: Failed to save changes.")
-                    return False
+                with self.storage.locked():
+                    self.sync()
+                    if name_key not in self.contacts:
+                        print(f"Error: Contact '{name}' not found.")
+                        return False
+                    self._remove_contact(name_key)
+                    if self.commit_changes([(name_key, None)]):
+                        print(f"Contact '{contact_name}' deleted successfully!")
+                        return True
+                    else:
+                        print("Error: Failed to save changes.")
+                        return False
             else:
                 print("Deletion cancelled.")
                 return False
@@ -193,7 +312,7 @@ class ContactManager:
             return False
     
     def list_all_contacts(self) -> None:
-        """Display all contacts."""
+        """Display all contacts in name order, straight from the ordered index."""
         try:
             if not self.contacts:
                 print("No contacts found.")
@@ -203,8 +322,8 @@ class ContactManager:
             print(f"{'ALL CONTACTS':^60}")
             print(f"{'='*60}")
             
-            for contact in sorted(self.contacts.values(), key=lambda x: x['name'].lower()):
-                self.display_contact(contact)
+            for name_key in self.order.keys_after():
+                self.display_contact(self.contacts[name_key])
                 print("-" * 60)
                 
         except Exception as e:
@@ -217,9 +336,58 @@ class ContactManager:
         print(f"Email: {contact['email'] if contact['email'] else 'N/A'}")
         print(f"Address: {contact['address'] if contact['address'] else 'N/A'}")
     
+    def find_duplicates(self, threshold: float = DEFAULT_THRESHOLD) -> List[Dict[str, Dict]]:
+        """Clusters ({name_key: contact}) of contacts that probably belong to the same person."""
+        return [{name_key: self.contacts[name_key] for name_key in cluster}
+                for cluster in find_duplicates(self.contacts, threshold, WORKERS)]
+    
+    def merge_contacts(self, name_keys: List[str]) -> bool:
+        """Merge contacts into the most complete one, filling its empty fields from the others."""
+        try:
+            with self.storage.locked():
+                self.sync()
+                missing = [name_key for name_key in name_keys if name_key not in self.contacts]
+                if missing:
+                    print(f"Error: Contact '{missing[0]}' not found.")
+                    return False
+                
+                contacts = {name_key: self.contacts[name_key] for name_key in name_keys}
+                keep_key = pick_survivor(contacts)
+                merged = merge_fields(contacts[keep_key],
+                                      [contact for k, contact in contacts.items() if k != keep_key])
+                if merged['created_at'] is None:
+                    del merged['created_at']
+                
+                changes = []
+                for name_key in name_keys:
+                    if name_key != keep_key:
+                        self._remove_contact(name_key)
+                        changes.append((name_key, None))
+                self._store_contact(keep_key, merged)
+                changes.append((keep_key, merged))
+                
+                if self.commit_changes(changes):
+                    print(f"Merged {len(name_keys)} contacts into '{merged['name']}'.")
+                    return True
+                else:
+                    print("Error: Failed to save merged contacts.")
+                    return False
+                
+        except Exception as e:
+            print(f"Error merging contacts: {e}")
+            return False
+    
     def get_contact_count(self) -> int:
         """Get total number of contacts."""
         return len(self.contacts)
+    
+    def get_stats(self) -> Dict[str, int]:
+        """Get contact counters without scanning the contacts."""
+        return self.stats.as_dict()
+    
+    def get_metrics(self) -> Dict[str, object]:
+        """Storage timings and errors, bytes written, search sizes and the contact count."""
+        return self.metrics.as_dict()
 
 
 def display_menu():
@@ -233,7 +401,8 @@ def display_menu():
     print("4. Delete Contact")
     print("5. List All Contacts")
     print("6. Contact Statistics")
-    print("7. Exit")
+    print("7. Find Duplicates")
+    print("8. Exit")
     print("="*50)
 
 
@@ -243,12 +412,15 @@ def main():
     print("Developed for Techplement Internship - Week 1 Task")
     
     # Initialize contact manager
-    cm = ContactManager()
+    storage_kind = os.environ.get("CONTACTS_STORAGE", "json")
+    cm = ContactManager(os.environ.get("CONTACTS_FILE", default_filename(storage_kind)),
+                        storage=storage_kind)
     
     while True:
         try:
+            cm.sync()
             display_menu()
-            choice = input("Enter your choice (1-7): ").strip()
+            choice = input("Enter your choice (1-8): ").strip()
             
             if choice == '1':
                 # Add Contact
@@ -263,7 +435,7 @@ def main():
             elif choice == '2':
                 # Search Contact
                 print("\n--- SEARCH CONTACT ---")
-                search_term = input("Enter name to search: ").strip()
+                search_term = input("Enter name or query (e.g. name:jo* email:@acme.com): ").strip()
                 results = cm.search_contact(search_term)
                 
                 if results:
@@ -293,23 +465,49 @@ def main():
             
             elif choice == '6':
                 # Contact Statistics
-                count = cm.get_contact_count()
+                stats = cm.get_stats()
                 print(f"\n--- CONTACT STATISTICS ---")
-                print(f"Total contacts: {count}")
-                if count > 0:
-                    with_email = sum(1 for contact in cm.contacts.values() if contact['email'])
-                    with_address = sum(1 for contact in cm.contacts.values() if contact['address'])
-                    print(f"Contacts with email: {with_email}")
-                    print(f"Contacts with address: {with_address}")
+                print(f"Total contacts: {stats['total']}")
+                if stats['total'] > 0:
+                    print(f"Contacts with email: {stats['with_email']}")
+                    print(f"Contacts with address: {stats['with_address']}")
+                    top_domains = cm.stats.domain_counts(5)
+                    if top_domains:
+                        print("Top email domains:")
+                        for domain, domain_count in top_domains.items():
+                            print(f"  {domain}: {domain_count}")
             
             elif choice == '7':
+                # Find Duplicates
+                print("\n--- FIND DUPLICATES ---")
+                clusters = cm.find_duplicates()
+                if clusters:
+                    for number, cluster in enumerate(clusters, 1):
+                        print(f"\nGroup {number}:")
+                        print("-" * 40)
+                        for contact in cluster.values():
+                            cm.display_contact(contact)
+                            print("-" * 40)
+                    answer = input("\nGroups to merge (e.g. 1,3), 'all', or Enter to skip: ")
+                    answer = answer.strip().lower()
+                    if answer == 'all':
+                        chosen = range(1, len(clusters) + 1)
+                    else:
+                        chosen = [int(part) for part in answer.split(',')
+                                  if part.strip().isdigit() and 1 <= int(part) <= len(clusters)]
+                    for number in chosen:
+                        cm.merge_contacts(list(clusters[number - 1]))
+                else:
+                    print("No duplicate contacts found.")
+            
+            elif choice == '8':
                 # Exit
                 print("\nThank you for using Contact Management System!")
                 print("Goodbye!")
                 break
             
             else:
-                print("Invalid choice! Please enter a number between 1-7.")
+                print("Invalid choice! Please enter a number between 1-8.")
         
         except KeyboardInterrupt:
             print("\n\nProgram interrupted by user.")
@@ -0,0 +1,224 @@
+"""
+Duplicate contact detection with blocking keys.
+
+Comparing every contact with every other one takes quadratic time. Instead
+each contact gets up to three blocking keys: its phone number (digits only,
+without a country code), its email address (lowercase, without a +tag) and
+the Soundex codes of its name words in sorted order, so "Jon Doe", "John
+Doe" and "Doe, John" share a block. Only contacts in the same block are
+compared. A block larger than ``window`` is sorted by name and each contact
+is only compared with the next ``window`` ones, which keeps the work close
+to linear however many contacts share, say, an office phone number.
+
+A pair counts as a duplicate when the similarity of their name words
+(each word matched to its closest word in the other name, averaged over
+the longer name) plus a bonus for a shared phone number or email address
+reaches ``threshold``. Pairs are joined into clusters with union-find. Blocks are
+independent, so with ``workers`` above 1 they are compared in a process
+pool.
+"""
+
+import functools
+import itertools
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from difflib import SequenceMatcher
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+DEFAULT_THRESHOLD = 0.9
+BLOCK_WINDOW = 20
+PHONE_WEIGHT = 0.1
+EMAIL_WEIGHT = 0.3
+# Contacts sent to a pool worker at a time
+CHUNK_SIZE = 20000
+PHONE_DIGITS = 10
+MERGED_FIELDS = ('name', 'phone', 'email', 'address')
+# Processes the web app and the CLI compare blocks in; 0 or 1 compares them in the caller
+WORKERS = int(os.environ.get('CONTACTS_DEDUP_WORKERS', 0))
+
+_SOUNDEX = {letter: digit for digit, letters in
+            (('1', 'bfpv'), ('2', 'cgjkqsxz'), ('3', 'dt'), ('4', 'l'), ('5', 'mn'), ('6', 'r'))
+            for letter in letters}
+
+# (contact key, sorted name words, phone key, email key, name key)
+Entry = Tuple[str, Tuple[str, ...], str, str, str]
+
+
+def soundex(word: str) -> str:
+    """American Soundex code of ``word``: its first letter and three digits."""
+    word = word.lower()
+    if not word:
+        return ''
+    code = word[0].upper()
+    previous = _SOUNDEX.get(word[0], '')
+    for letter in word[1:]:
+        digit = _SOUNDEX.get(letter, '')
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        if letter not in 'hw':
+            previous = digit
+    return code.ljust(4, '0')
+
+
+def name_words(name: str) -> Tuple[str, ...]:
+    """Lowercase words of a name, sorted, so word order and punctuation do not matter."""
+    return tuple(sorted(re.findall(r'[^\W_]+', name.lower())))
+
+
+def phone_key(phone: str) -> str:
+    """The last ten digits of a phone number, which drops country and trunk prefixes."""
+    digits = re.sub(r'\D', '', phone)
+    return digits[-PHONE_DIGITS:] if len(digits) >= 7 else ''
+
+
+def email_key(email: str) -> str:
+    """Lowercase address without a +tag in the local part, or '' if it has no domain."""
+    local, at, domain = email.strip().lower().rpartition('@')
+    if not at or not local or not domain:
+        return ''
+    return f"{local.split('+', 1)[0]}@{domain}"
+
+
+def _entry(key: str, contact: Dict) -> Entry:
+    words = name_words(contact.get('name') or '')
+    # Numbers in a name (such as "Office 2") are kept as they are
+    name = ' '.join(soundex(word) if word.isalpha() else word for word in words)
+    return (key, words, phone_key(contact.get('phone') or ''),
+            email_key(contact.get('email') or ''), name)
+
+
+def _block_keys(entry: Entry) -> Iterator[str]:
+    # The prefix letter is also the order in which a shared block is chosen
+    for prefix, value in zip('pen', entry[2:]):
+        if value:
+            yield f'{prefix}:{value}'
+
+
+def blocking_keys(contact: Dict) -> List[str]:
+    """The blocks a contact is compared in: 'p:' phone, 'e:' email and 'n:' name keys."""
+    return list(_block_keys(_entry('', contact)))
+
+
+def _first_shared(a: Entry, b: Entry) -> str:
+    for prefix, value_a, value_b in zip('pen', a[2:], b[2:]):
+        if value_a and value_a == value_b:
+            return prefix
+    return ''
+
+
+@functools.lru_cache(maxsize=65536)
+def _word_similarity(a: str, b: str) -> float:
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+
+def name_similarity(a: Tuple[str, ...], b: Tuple[str, ...]) -> float:
+    """Closest-word similarity of each word of the shorter name, averaged over the longer name."""
+    if len(a) > len(b):
+        a, b = b, a
+    if not a:
+        return 0.0
+    return sum(max(_word_similarity(word, other) for other in b) for word in a) / len(b)
+
+
+def _is_duplicate(a: Entry, b: Entry, threshold: float) -> bool:
+    bonus = ((PHONE_WEIGHT if a[2] and a[2] == b[2] else 0) +
+             (EMAIL_WEIGHT if a[3] and a[3] == b[3] else 0))
+    return name_similarity(a[1], b[1]) + bonus >= threshold
+
+
+def compare_blocks(blocks: List[Tuple[str, List[Entry]]], threshold: float,
+                   window: int) -> List[Tuple[str, str]]:
+    """Duplicate (key, key) pairs within each (block key, entries) block."""
+    pairs = []
+    for block_key, entries in blocks:
+        prefix = block_key[0]
+        entries = sorted(entries, key=lambda entry: entry[1])
+        for i, a in enumerate(entries):
+            for b in itertools.islice(entries, i + 1, i + 1 + window):
+                # A pair in several blocks is only compared in the first of them
+                if _first_shared(a, b) == prefix and _is_duplicate(a, b, threshold):
+                    pairs.append((a[0], b[0]))
+    return pairs
+
+
+def _chunks(blocks: List[Tuple[str, List[Entry]]]) -> Iterator[List[Tuple[str, List[Entry]]]]:
+    chunk, size = [], 0
+    for block in blocks:
+        chunk.append(block)
+        size += len(block[1])
+        if size >= CHUNK_SIZE:
+            yield chunk
+            chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+def _clusters(pairs: Iterable[Tuple[str, str]]) -> List[List[str]]:
+    parent: Dict[str, str] = {}
+
+    def find(key: str) -> str:
+        root = key
+        while parent[root] != root:
+            root = parent[root]
+        while parent[key] != root:
+            parent[key], key = root, parent[key]
+        return root
+
+    for a, b in pairs:
+        parent.setdefault(a, a)
+        parent.setdefault(b, b)
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    groups: Dict[str, List[str]] = {}
+    for key in parent:
+        groups.setdefault(find(key), []).append(key)
+    return sorted(sorted(group) for group in groups.values())
+
+
+def find_duplicates(contacts: Dict[str, Dict], threshold: float = DEFAULT_THRESHOLD,
+                    workers: int = 0, window: int = BLOCK_WINDOW) -> List[List[str]]:
+    """Clusters of two or more contact keys that probably belong to the same person.
+
+    Each cluster is sorted, and clusters are ordered by their first key.
+    """
+    blocks: Dict[str, List[Entry]] = {}
+    for key, contact in contacts.items():
+        entry = _entry(key, contact)
+        for block_key in _block_keys(entry):
+            blocks.setdefault(block_key, []).append(entry)
+    shared = [(block_key, entries) for block_key, entries in blocks.items() if len(entries) > 1]
+    del blocks
+    if workers > 1 and len(shared) > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            results = pool.map(compare_blocks, _chunks(shared), itertools.repeat(threshold),
+                               itertools.repeat(window))
+            return _clusters(itertools.chain.from_iterable(results))
+    return _clusters(compare_blocks(shared, threshold, window))
+
+
+def pick_survivor(contacts: Dict[str, Dict]) -> str:
+    """Key of the contact a merge keeps: the most fields filled in, then the oldest."""
+    def rank(key):
+        contact = contacts[key]
+        filled = sum(1 for field in MERGED_FIELDS if contact.get(field))
+        return -filled, contact.get('created_at') or '\uffff', key
+    return min(contacts, key=rank)
+
+
+def merge_fields(keep: Dict, others: Iterable[Dict]) -> Dict:
+    """Fields of ``keep``, empty ones filled from ``others``, with the earliest created_at."""
+    others = list(others)
+    merged = {field: keep.get(field) or '' for field in MERGED_FIELDS}
+    for other in others:
+        for field in MERGED_FIELDS:
+            if not merged[field] and other.get(field):
+                merged[field] = other[field]
+    created = [contact.get('created_at') for contact in [keep] + others if contact.get('created_at')]
+    merged['created_at'] = min(created) if created else None
+    return merged
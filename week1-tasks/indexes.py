@@ -0,0 +1,418 @@
+"""
+In-memory indexes kept alongside ContactManager.contacts.
+
+Each index is updated through ``add(key, contact)`` and
+``remove(key, contact)`` whenever a contact is stored or removed, so lookups
+never need to scan the whole contact book.
+"""
+
+import bisect
+import itertools
+import re
+from array import array
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from records import ContactRecord, Timestamp, epoch_micros
+
+GRAM_SIZE = 3
+# Appended to a prefix, sorts after every string that starts with the prefix
+_PREFIX_END = '\U0010ffff'
+# Time index value of a contact without the timestamp: the smallest 64-bit integer
+UNDATED = -2 ** 63
+
+
+class TrigramIndex:
+    """Inverted index from three-character substrings to contact keys.
+
+    ``fields`` returns the lowercase texts of a contact that should be
+    searchable. A substring query intersects the posting sets of its
+    trigrams; the resulting candidates still have to be verified by the
+    caller, because trigrams can match out of order.
+    """
+
+    def __init__(self, fields: Callable[[Dict], Iterable[str]]):
+        self._fields = fields
+        self._postings: Dict[str, Set[str]] = {}
+
+    def _grams(self, contact: Dict) -> Set[str]:
+        grams = set()
+        for text in self._fields(contact):
+            for i in range(len(text) - GRAM_SIZE + 1):
+                grams.add(text[i:i + GRAM_SIZE])
+        return grams
+
+    def add(self, key: str, contact: Dict) -> None:
+        postings = self._postings
+        for gram in self._grams(contact):
+            keys = postings.get(gram)
+            if keys is None:
+                postings[gram] = {key}
+            else:
+                keys.add(key)
+
+    def remove(self, key: str, contact: Dict) -> None:
+        postings = self._postings
+        for gram in self._grams(contact):
+            keys = postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del postings[gram]
+
+    def candidates(self, term: str) -> Optional[Set[str]]:
+        """Keys that may contain ``term``, or None if it is too short to index."""
+        if len(term) < GRAM_SIZE:
+            return None
+        posting_sets = []
+        for i in range(len(term) - GRAM_SIZE + 1):
+            keys = self._postings.get(term[i:i + GRAM_SIZE])
+            if not keys:
+                return set()
+            posting_sets.append(keys)
+        posting_sets.sort(key=len)
+        return posting_sets[0].intersection(*posting_sets[1:])
+
+    def estimate(self, term: str) -> Optional[int]:
+        """Upper bound on ``len(candidates(term))`` from posting set sizes alone."""
+        if len(term) < GRAM_SIZE:
+            return None
+        return min(len(self._postings.get(term[i:i + GRAM_SIZE], ()))
+                   for i in range(len(term) - GRAM_SIZE + 1))
+
+
+class OrderedIndex:
+    """Contact keys kept in sorted order, maintained with bisect."""
+
+    def __init__(self):
+        self._keys: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def load(self, keys: Iterable[str]) -> None:
+        """Replace the index with ``keys`` in one sort instead of n inserts."""
+        self._keys = sorted(keys)
+
+    def add(self, key: str, contact: Dict) -> None:
+        bisect.insort(self._keys, key)
+
+    def remove(self, key: str, contact: Dict) -> None:
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+    def snapshot(self) -> Tuple[str, ...]:
+        """Immutable copy of the keys in order, taken in one step."""
+        return tuple(self._keys)
+
+    def keys_after(self, key: Optional[str] = None, reverse: bool = False) -> Iterator[str]:
+        """Iterate keys in order, or in reverse, starting after ``key`` when it is given."""
+        if not reverse:
+            start = 0 if key is None else bisect.bisect_right(self._keys, key)
+            return itertools.islice(self._keys, start, None)
+        return self._keys_before(key)
+
+    def _keys_before(self, key: Optional[str]) -> Iterator[str]:
+        keys = self._keys
+        i = len(keys) if key is None else bisect.bisect_left(keys, key)
+        while i > 0:
+            i -= 1
+            yield keys[i]
+
+    def prefix(self, prefix: str, limit: Optional[int] = None) -> List[str]:
+        """Up to ``limit`` (or all) keys starting with ``prefix``, in order."""
+        keys = self._keys
+        i = bisect.bisect_left(keys, prefix)
+        found: List[str] = []
+        while i < len(keys) and len(found) != limit and keys[i].startswith(prefix):
+            found.append(keys[i])
+            i += 1
+        return found
+
+    def count_prefix(self, prefix: str) -> int:
+        """Number of keys starting with ``prefix``, by two binary searches."""
+        return (bisect.bisect_left(self._keys, prefix + _PREFIX_END) -
+                bisect.bisect_left(self._keys, prefix))
+
+
+class SortedIndex:
+    """Contact keys ordered by a value computed from each contact.
+
+    Values and their contact keys are kept in two parallel lists ordered by
+    (value, key) rather than one list of tuples, which would cost an extra
+    object per contact. With ``skip_empty`` contacts whose value is empty
+    are left out.
+    """
+
+    def __init__(self, value: Callable[[Dict], str], skip_empty: bool = False):
+        self.value = value
+        self.skip_empty = skip_empty
+        self._values: List[str] = []
+        self._keys: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def load(self, contacts: Dict[str, Dict]) -> None:
+        """Replace the index with the values of ``contacts`` in one sort."""
+        pairs = []
+        for key, contact in contacts.items():
+            value = self.value(contact)
+            if value or not self.skip_empty:
+                pairs.append((value, key))
+        pairs.sort()
+        self._values = [value for value, _ in pairs]
+        self._keys = [key for _, key in pairs]
+
+    def _position(self, value: str, key: str, after: bool = False) -> int:
+        lo = bisect.bisect_left(self._values, value)
+        hi = bisect.bisect_right(self._values, value, lo)
+        find = bisect.bisect_right if after else bisect.bisect_left
+        return find(self._keys, key, lo, hi)
+
+    def add(self, key: str, contact: Dict) -> None:
+        value = self.value(contact)
+        if value or not self.skip_empty:
+            i = self._position(value, key)
+            self._values.insert(i, value)
+            self._keys.insert(i, key)
+
+    def remove(self, key: str, contact: Dict) -> None:
+        value = self.value(contact)
+        if not value and self.skip_empty:
+            return
+        i = self._position(value, key)
+        if i < len(self._keys) and self._keys[i] == key and self._values[i] == value:
+            del self._values[i]
+            del self._keys[i]
+
+    def items(self, after: Optional[Tuple[str, str]] = None,
+              reverse: bool = False) -> Iterator[Tuple[str, str]]:
+        """Iterate (value, key) pairs in order, or in reverse, starting after ``after``."""
+        values, keys = self._values, self._keys
+        if reverse:
+            i = len(keys) if after is None else self._position(*after)
+            while i > 0:
+                i -= 1
+                yield values[i], keys[i]
+        else:
+            i = 0 if after is None else self._position(*after, after=True)
+            while i < len(keys):
+                yield values[i], keys[i]
+                i += 1
+
+    def _range(self, low: Optional[str], high: Optional[str]) -> Tuple[int, int]:
+        lo = 0 if low is None else bisect.bisect_left(self._values, low)
+        hi = len(self._values) if high is None else bisect.bisect_left(self._values, high, lo)
+        return lo, max(lo, hi)
+
+    def between(self, low: Optional[str], high: Optional[str]) -> List[str]:
+        """Keys whose value is at least ``low`` and below ``high``; None leaves a side open."""
+        lo, hi = self._range(low, high)
+        return self._keys[lo:hi]
+
+    def count_between(self, low: Optional[str], high: Optional[str]) -> int:
+        lo, hi = self._range(low, high)
+        return hi - lo
+
+
+class TimeIndex(SortedIndex):
+    """Contact keys ordered by a timestamp, kept as epoch microseconds in an array('q').
+
+    That is 8 bytes per contact instead of an ISO string. Contacts without
+    the timestamp are stored as UNDATED: they come first when listing in
+    this order, but ``between()`` and ``count_between()`` never return them.
+    """
+
+    def __init__(self, stamp: Callable[[Dict], int]):
+        super().__init__(stamp)
+        self._values = array('q')
+
+    def load(self, contacts: Dict[str, Dict]) -> None:
+        super().load(contacts)
+        self._values = array('q', self._values)
+
+    def _range(self, low: Optional[int], high: Optional[int]) -> Tuple[int, int]:
+        return super()._range(UNDATED + 1 if low is None else low, high)
+
+    @property
+    def undated(self) -> int:
+        """Number of contacts without the timestamp."""
+        return bisect.bisect_right(self._values, UNDATED)
+
+
+class PrefixIndex(SortedIndex):
+    """Normalized values of one field, sorted for prefix queries."""
+
+    def __init__(self, field: str, normalize: Callable[[str], str]):
+        super().__init__(lambda contact: normalize(contact.get(field) or ''), skip_empty=True)
+        self.field = field
+        self.normalize = normalize
+
+    def prefix(self, prefix: str, limit: Optional[int] = None) -> List[Tuple[str, str]]:
+        """Up to ``limit`` (or all) (value, key) pairs whose value starts with ``prefix``."""
+        prefix = self.normalize(prefix)
+        if not prefix:
+            return []
+        values = self._values
+        i = bisect.bisect_left(values, prefix)
+        found: List[Tuple[str, str]] = []
+        while i < len(values) and len(found) != limit and values[i].startswith(prefix):
+            found.append((values[i], self._keys[i]))
+            i += 1
+        return found
+
+    def count_prefix(self, prefix: str) -> int:
+        prefix = self.normalize(prefix)
+        return self.count_between(prefix, prefix + _PREFIX_END) if prefix else 0
+
+
+class LookupIndex:
+    """Exact-match hash index from a normalized field value to contact keys."""
+
+    def __init__(self, field: str, normalize: Callable[[str], str]):
+        self.field = field
+        self.normalize = normalize
+        self._keys: Dict[str, Set[str]] = {}
+
+    def add(self, key: str, contact: Dict) -> None:
+        value = self.normalize(contact.get(self.field) or '')
+        if value:
+            self._keys.setdefault(value, set()).add(key)
+
+    def remove(self, key: str, contact: Dict) -> None:
+        value = self.normalize(contact.get(self.field) or '')
+        keys = self._keys.get(value)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[value]
+
+    def lookup(self, value: str) -> List[str]:
+        """Keys of the contacts whose field normalizes like ``value``, sorted."""
+        return sorted(self._keys.get(self.normalize(value), ()))
+
+
+def fill_index(index, contacts: Dict[str, Dict]) -> None:
+    """Add every contact to an empty index; sorted indexes are loaded in one sort."""
+    if hasattr(index, 'load'):
+        index.load(contacts)
+    else:
+        for key, contact in contacts.items():
+            index.add(key, contact)
+
+
+class LazyIndex:
+    """Wrapper that fills an index the first time it is queried.
+
+    Until then ``add()`` and ``remove()`` do nothing, because the fill reads
+    the contacts as they are by then. ``lock`` is held while filling, so it
+    should be the lock writers hold while they change ``contacts()`` in
+    memory. Readers fill indexes too, so it must not be a lock that is also
+    held while saving, such as the storage lock.
+    """
+
+    def __init__(self, index, contacts: Callable[[], Dict[str, Dict]], lock):
+        self.index = index
+        self.built = False
+        self._contacts = contacts
+        self._lock = lock
+
+    def add(self, key: str, contact: Dict) -> None:
+        if self.built:
+            self.index.add(key, contact)
+
+    def remove(self, key: str, contact: Dict) -> None:
+        if self.built:
+            self.index.remove(key, contact)
+
+    def __getattr__(self, name: str):
+        if not self.built:
+            with self._lock:
+                if not self.built:
+                    fill_index(self.index, self._contacts())
+                    self.built = True
+        return getattr(self.index, name)
+
+
+def normalize_phone(phone: str) -> str:
+    """Phone number without the spaces, dashes and parentheses validation allows."""
+    return re.sub(r'[\s\-()]', '', phone)
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def _stamp(value: Timestamp) -> int:
+    if value is None or isinstance(value, int):
+        return UNDATED if value is None else value
+    # Text that ContactRecord could not hold as an integer, such as a date alone
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return UNDATED
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return epoch_micros(moment)
+
+
+def created_stamp(contact: Dict) -> int:
+    """Epoch microseconds of created_at, or UNDATED."""
+    if isinstance(contact, ContactRecord):
+        return _stamp(contact.created)
+    return _stamp(contact.get('created_at'))
+
+
+def updated_stamp(contact: Dict) -> int:
+    """Epoch microseconds of the last change; never-updated contacts use created_at."""
+    if isinstance(contact, ContactRecord):
+        return _stamp(contact.created if contact.updated is None else contact.updated)
+    return _stamp(contact.get('updated_at') or contact.get('created_at'))
+
+
+def email_domain(email: str) -> str:
+    """Lowercase domain part of an email address, or '' if it has none."""
+    _, at, domain = email.rpartition('@')
+    return domain.strip().lower() if at else ''
+
+
+class ContactStats:
+    """Contact counters updated on every change instead of recomputed by scanning."""
+
+    def __init__(self):
+        self.total = 0
+        self.with_email = 0
+        self.with_address = 0
+        self.domains: Counter = Counter()
+
+    def add(self, key: str, contact: Dict) -> None:
+        self._count(contact, 1)
+
+    def remove(self, key: str, contact: Dict) -> None:
+        self._count(contact, -1)
+
+    def _count(self, contact: Dict, delta: int) -> None:
+        self.total += delta
+        email = contact.get('email')
+        if email:
+            self.with_email += delta
+            domain = email_domain(email)
+            self.domains[domain] += delta
+            if not self.domains[domain]:
+                del self.domains[domain]
+        if contact.get('address'):
+            self.with_address += delta
+
+    def as_dict(self) -> Dict:
+        return {
+            'total': self.total,
+            'with_email': self.with_email,
+            'with_address': self.with_address,
+        }
+
+    def domain_counts(self, limit: Optional[int] = None) -> Dict[str, int]:
+        """Contacts per email domain, most common first."""
+        return dict(self.domains.most_common(limit))
@@ -0,0 +1,219 @@
+"""
+Counters, gauges and histograms in the Prometheus text format.
+
+Recording a value costs a bisect and a few additions under a lock, and
+nothing is formatted until ``Registry.render()`` is called by a scrape.
+Gauges are read from a callback at that point, so values that are already
+tracked elsewhere (the number of contacts, cache counters) cost nothing
+between scrapes. ``Registry.as_dict()`` returns the same numbers for use
+from Python, such as by the CLI.
+"""
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# Seconds, from a cached lookup to a rewrite of a large JSON file
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+# Contacts examined or returned by one search
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def samples(self) -> List[Sample]:
+        raise NotImplementedError
+
+    def value(self):
+        """The metric as plain Python values, keyed by comma-joined label values."""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A total that only goes up, one per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            values = list(self._values.items())
+        return [('', dict(zip(self.labels, key)), value) for key, value in values]
+
+    def value(self):
+        with self._lock:
+            if not self.labels:
+                return self._values.get((), 0)
+            return {','.join(key): value for key, value in self._values.items()}
+
+
+class Gauge(Metric):
+    """A current value read from ``read()`` when the metric is rendered."""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        super().__init__(name, help)
+        self._read = read
+
+    def samples(self) -> List[Sample]:
+        return [('', {}, self._read())]
+
+    def value(self):
+        return self._read()
+
+
+class CallbackCounter(Gauge):
+    """A counter kept by some other object and read when rendered."""
+
+    kind = 'counter'
+
+
+class Histogram(Metric):
+    """Observations counted into fixed buckets, plus their count and sum."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket..., count above the last bucket, sum]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        """Observe how many seconds the block took, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def _copy(self) -> List[Tuple[Tuple[str, ...], List[float]]]:
+        with self._lock:
+            return [(key, list(series)) for key, series in self._series.items()]
+
+    def samples(self) -> List[Sample]:
+        samples: List[Sample] = []
+        for key, series in self._copy():
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                samples.append(('_bucket', dict(labels, le=_format_value(bound)), cumulative))
+            samples.append(('_sum', labels, series[-1]))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+    def value(self):
+        summaries = {}
+        for key, series in self._copy():
+            counts = series[:-1]
+            summaries[','.join(key)] = {'count': sum(counts), 'sum': series[-1]}
+        if not self.labels:
+            return summaries.get('', {'count': 0, 'sum': 0.0})
+        return summaries
+
+
+class Registry:
+    """The metrics of one component, rendered together."""
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def _register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(name, help, read))
+
+    def callback_counter(self, name: str, help: str, read: Callable[[], float]) -> CallbackCounter:
+        return self._register(CallbackCounter(name, help, read))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for suffix, labels, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self) -> Dict[str, object]:
+        return {metric.name: metric.value() for metric in self._metrics}
+
+
+class ContactMetrics(Registry):
+    """Storage, search and size metrics shared by the CLI and web ContactManagers."""
+
+    def __init__(self, manager):
+        super().__init__()
+        self.storage_seconds = self.histogram(
+            'contacts_storage_duration_seconds', "Time spent loading and saving contacts",
+            ('operation',))
+        self.storage_errors = self.counter(
+            'contacts_storage_errors_total', "Loads and saves that failed", ('operation',))
+        self.callback_counter(
+            'contacts_storage_written_bytes_total',
+            "Bytes this process wrote to the contact files (not counted for sqlite)",
+            lambda: manager.storage.bytes_written)
+        self.search_candidates = self.histogram(
+            'contacts_search_candidates', "Contacts checked by one search", buckets=COUNT_BUCKETS)
+        self.search_results = self.histogram(
+            'contacts_search_results', "Contacts found by one search", buckets=COUNT_BUCKETS)
+        self.gauge('contacts_total', "Contacts in the book", lambda: len(manager.contacts))
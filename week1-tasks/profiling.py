@@ -0,0 +1,122 @@
+"""
+Opt-in cProfile sampling of web requests.
+
+``RequestProfiler`` decides per request whether to run it under cProfile:
+a random ``sample_rate`` fraction of requests, or any request that asks
+for it with the admin token. With ``slow_seconds`` set, only profiles of
+requests that took at least that long are kept. Reports hold the top
+functions by cumulative time and go into a ring buffer of the last
+``keep`` reports, so memory stays bounded however long profiling runs.
+
+cProfile can only profile one thread at a time on newer Pythons, so a
+request that arrives while another one is being profiled runs normally.
+"""
+
+import cProfile
+import io
+import itertools
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+TOP_FUNCTIONS = 30
+
+
+class RequestProfiler:
+    """Sampling switch, profile runner and ring buffer of reports."""
+
+    def __init__(self, sample_rate: float = 0.0, slow_seconds: Optional[float] = None,
+                 keep: int = 20):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self._reports: deque = deque(maxlen=keep)
+        self._ids = itertools.count(1)
+        self._active = threading.Lock()
+        self._lock = threading.Lock()
+        self.profiled = 0
+        self.skipped_busy = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def configure(self, sample_rate: Optional[float] = None, slow_seconds=...,
+                  keep: Optional[int] = None) -> None:
+        """Change settings at runtime; pass slow_seconds=None to keep every profile."""
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if slow_seconds is not ...:
+            self.slow_seconds = slow_seconds
+        if keep is not None:
+            with self._lock:
+                self._reports = deque(self._reports, maxlen=keep)
+
+    def start(self, forced: bool = False) -> Optional[cProfile.Profile]:
+        """A running profiler if this request should be profiled, else None."""
+        if not forced and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            return None
+        if not self._active.acquire(blocking=False):
+            self.skipped_busy += 1
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (a debugger, coverage) already hooks this thread
+            self._active.release()
+            return None
+        return profile
+
+    def finish(self, profile: cProfile.Profile, seconds: float, request: Dict,
+               forced: bool = False) -> Optional[Dict]:
+        """Stop ``profile`` and keep its report if the request was slow enough (or forced)."""
+        profile.disable()
+        self._active.release()
+        self.profiled += 1
+        if not forced and self.slow_seconds is not None and seconds < self.slow_seconds:
+            return None
+        report = dict(request, id=next(self._ids), duration_ms=round(seconds * 1000, 3),
+                      time=time.time(), forced=forced, **summarize(profile))
+        with self._lock:
+            self._reports.append(report)
+        return report
+
+    def reports(self) -> List[Dict]:
+        """Kept reports without their text, slowest first."""
+        with self._lock:
+            reports = list(self._reports)
+        summaries = [{key: value for key, value in report.items() if key != 'text'}
+                     for report in reports]
+        return sorted(summaries, key=lambda report: report['duration_ms'], reverse=True)
+
+    def report(self, report_id: int) -> Optional[Dict]:
+        with self._lock:
+            for report in self._reports:
+                if report['id'] == report_id:
+                    return report
+        return None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reports.clear()
+
+    def settings(self) -> Dict:
+        return {'sample_rate': self.sample_rate,
+                'slow_ms': None if self.slow_seconds is None else self.slow_seconds * 1000,
+                'keep': self._reports.maxlen, 'kept': len(self._reports),
+                'profiled': self.profiled, 'skipped_busy': self.skipped_busy}
+
+
+def summarize(profile: cProfile.Profile, limit: int = TOP_FUNCTIONS) -> Dict:
+    """Top functions by cumulative time, as data and as pstats text."""
+    text = io.StringIO()
+    stats = pstats.Stats(profile, stream=text)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    functions = [{'function': f'{filename}:{line}({name})', 'calls': calls,
+                  'own_ms': round(own * 1000, 3), 'cumulative_ms': round(cumulative * 1000, 3)}
+                 for (filename, line, name), (_, calls, own, cumulative, _) in rows]
+    return {'functions': functions, 'text': text.getvalue()}
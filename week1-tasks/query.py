@@ -0,0 +1,305 @@
+"""
+Structured contact searches and an index-aware query planner.
+
+A search that names a field is parsed as a query, and every term of it
+has to match:
+
+    name:jo*              name starts with "jo"
+    name:smith            name contains "smith"
+    phone:555-123-4567    phone number, ignoring spaces, dashes and parentheses
+    phone:555*            phone number starts with 555
+    phone:555             phone number contains 555
+    email:ann@acme.com    email address, ignoring case
+    email:ann*            email address starts with "ann"
+    email:@acme.com       email address contains "@acme.com"
+    added:>2026-01-01     created after that day; also >=, <, <=, a single day
+                          or date and time, or a range such as 2026-01-01..2026-01-31
+    updated:<2026-02-01   the same for the last change (created_at if never updated)
+    anything else         free text, found in the name, phone number or email
+
+Values with spaces can be quoted (``name:"jo smith"``). A search that names
+no field is a single free-text term, exactly like the search always was.
+
+``plan_query`` asks each index that could serve a term how many contacts
+it would return: a hash lookup, two binary searches over a sorted index or
+the smallest trigram posting set. The most selective one drives the
+search. Other indexes are intersected in while they are not much larger
+than the candidates so far, and the rest of the terms are only checked
+against the candidate records. When no index narrows the book down enough,
+the caller walks the whole book in order instead.
+"""
+
+import functools
+import re
+from datetime import date, datetime, time, timedelta
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from indexes import UNDATED, created_stamp, normalize_email, normalize_phone, updated_stamp
+from records import epoch_micros
+
+FIELDS = ('name', 'phone', 'email', 'added', 'updated')
+TEXT_FIELDS = ('name', 'phone', 'email')
+# An index only drives the search if it returns at most this share of the book
+SCAN_SHARE = 0.5
+# Another index is intersected in while it holds at most this many times the
+# candidates so far, and only while there are more candidates than MIN_INTERSECT
+INTERSECT_FACTOR = 4
+MIN_INTERSECT = 32
+
+_TOKEN = re.compile(r'(?:([a-z]+):)?(?:"([^"]*)"|(\S+))')
+_FIELD = re.compile(r'(?:^|\s)(?:%s):' % '|'.join(FIELDS))
+_TIMESTAMPS = {'added': created_stamp, 'updated': updated_stamp}
+_COMPARISONS = ('>=', '<=', '>', '<')
+
+
+class QueryError(ValueError):
+    """A search that names a field but has a value that cannot be used."""
+
+
+def _text(contact: Dict, field: str) -> str:
+    text = contact.get(field) or ''
+    return text if field == 'phone' else text.lower()
+
+
+class Term:
+    """One condition: ``field`` (or 'text') matched by ``op``: exact, prefix, contains or range.
+
+    Ranges hold epoch microseconds from ``low`` up to but not including ``high``.
+    """
+
+    __slots__ = ('field', 'op', 'value', 'low', 'high', 'source')
+
+    def __init__(self, field: str, op: str, value: str = '', low: Optional[int] = None,
+                 high: Optional[int] = None, source: str = ''):
+        self.field = field
+        self.op = op
+        self.value = value
+        self.low = low
+        self.high = high
+        self.source = source
+
+    def matches(self, contact: Dict, text_fields: Sequence[str] = TEXT_FIELDS) -> bool:
+        if self.field == 'text':
+            return any(self.value in _text(contact, field) for field in text_fields)
+        if self.op == 'range':
+            stamp = _TIMESTAMPS[self.field](contact)
+            return (stamp != UNDATED and (self.low is None or stamp >= self.low) and
+                    (self.high is None or stamp < self.high))
+        if self.field == 'phone' and self.op != 'contains':
+            text = normalize_phone(contact.get('phone') or '')
+        else:
+            text = _text(contact, self.field)
+        if self.op == 'exact':
+            return text == self.value
+        if self.op == 'prefix':
+            return text.startswith(self.value)
+        return self.value in text
+
+
+class Query:
+    """Terms that must all match; an empty query matches every contact."""
+
+    __slots__ = ('terms',)
+
+    def __init__(self, terms: Tuple[Term, ...]):
+        self.terms = terms
+
+    def __bool__(self) -> bool:
+        return bool(self.terms)
+
+    def matches(self, contact: Dict, text_fields: Sequence[str] = TEXT_FIELDS) -> bool:
+        return all(term.matches(contact, text_fields) for term in self.terms)
+
+
+def _moment(text: str) -> Tuple[int, int]:
+    """First microsecond of the day or moment ``text`` names, and the first one after it."""
+    try:
+        day = date.fromisoformat(text)
+    except ValueError:
+        pass
+    else:
+        start = datetime.combine(day, time())
+        return epoch_micros(start), epoch_micros(start + timedelta(days=1))
+    try:
+        moment = datetime.fromisoformat(text.upper())
+    except ValueError:
+        raise QueryError(f"'{text}' is not a date (use YYYY-MM-DD or YYYY-MM-DDTHH:MM)") from None
+    if moment.tzinfo is not None:
+        raise QueryError("Timestamps are local time and cannot have a time zone")
+    stamp = epoch_micros(moment)
+    return stamp, stamp + 1
+
+
+def _range_term(field: str, value: str, source: str) -> Term:
+    comparison = next((c for c in _COMPARISONS if value.startswith(c)), None)
+    if comparison is None and '..' in value:
+        first, last = value.split('..', 1)
+        low = _moment(first)[0] if first else None
+        high = _moment(last)[1] if last else None
+        return Term(field, 'range', low=low, high=high, source=source)
+    start, end = _moment(value[len(comparison or ''):])
+    low, high = {'>': (end, None), '>=': (start, None), '<': (None, start),
+                 '<=': (None, end), None: (start, end)}[comparison]
+    return Term(field, 'range', low=low, high=high, source=source)
+
+
+def _prefix_term(field: str, value: str, source: str) -> Term:
+    # An empty prefix would match every contact when checked per record but
+    # nothing in the phone and email indexes, so the plan would decide
+    if not value:
+        raise QueryError(f"'{source.strip()}' needs at least one character before the *")
+    return Term(field, 'prefix', value, source=source)
+
+
+def _term(field: str, value: str, source: str) -> Term:
+    if field in _TIMESTAMPS:
+        return _range_term(field, value, source)
+    prefix = value.endswith('*')
+    if field == 'phone':
+        digits = normalize_phone(value.rstrip('*'))
+        if prefix:
+            return _prefix_term(field, digits, source)
+        if digits.isdigit() and 10 <= len(digits) <= 15:
+            return Term(field, 'exact', digits, source=source)
+    elif field == 'email':
+        if prefix:
+            return _prefix_term(field, normalize_email(value[:-1]), source)
+        if '@' in value[1:]:
+            return Term(field, 'exact', normalize_email(value), source=source)
+    elif prefix:
+        return _prefix_term(field, value[:-1], source)
+    return Term(field, 'contains', value, source=source)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_query(text: str) -> Query:
+    """Parse a search box text; raises QueryError for a value that cannot be used."""
+    text = text.lower()
+    if not _FIELD.search(text):
+        return Query((Term('text', 'contains', text, source=text),) if text else ())
+    terms = []
+    for match in _TOKEN.finditer(text):
+        field, quoted, bare = match.groups()
+        value = bare if quoted is None else quoted
+        if field in FIELDS:
+            terms.append(_term(field, value, match.group(0)))
+        else:
+            # Not a field we know, such as a time of day: search for all of it
+            text_value = value if field is None else f'{field}:{value}'
+            terms.append(Term('text', 'contains', text_value, source=match.group(0)))
+    return Query(tuple(terms))
+
+
+def with_terms(search: str, terms: Sequence[str]) -> str:
+    """``search`` and field ``terms`` as one query; plain free text is quoted to stay one term."""
+    if not terms:
+        return search
+    if search and not _FIELD.search(search.lower()):
+        if '"' in search:
+            raise QueryError("Free text with double quotes cannot be combined with date filters")
+        search = f'"{search}"'
+    return ' '.join([search] + list(terms)) if search else ' '.join(terms)
+
+
+class Step:
+    """How the plan uses one term: its index and estimate, if any, and what it did.
+
+    ``action`` is 'driver' for the index the candidates come from, 'intersect'
+    for one intersected in and 'filter' for a term only checked per record.
+    """
+
+    __slots__ = ('term', 'index', 'estimate', 'fetch', 'action', 'remaining')
+
+    def __init__(self, term: Term, index: Optional[str] = None, estimate: Optional[int] = None,
+                 fetch: Optional[Callable[[], Set[str]]] = None):
+        self.term = term
+        self.index = index
+        self.estimate = estimate
+        self.fetch = fetch
+        self.action = 'filter'
+        self.remaining: Optional[int] = None
+
+
+def _prefix_keys(index, prefix: str) -> Set[str]:
+    # The name index holds keys, the phone and email ones (value, key) pairs
+    return {item if isinstance(item, str) else item[1] for item in index.prefix(prefix)}
+
+
+def _access(term: Term, indexes: Dict, text_fields: Sequence[str]) -> Optional[Tuple]:
+    """(index name, estimated keys, fetch) for the index that can serve ``term``, if any."""
+    field, value = term.field, term.value
+    if term.op == 'exact' and field in indexes:
+        keys = indexes[field].lookup(value)
+        return f'{field} hash', len(keys), lambda: set(keys)
+    if term.op == 'prefix' and f'{field}_prefix' in indexes:
+        index = indexes[f'{field}_prefix']
+        return f'{field} prefix', index.count_prefix(value), lambda: _prefix_keys(index, value)
+    if term.op == 'range' and field in indexes:
+        index = indexes[field]
+        return (f'{field} range', index.count_between(term.low, term.high),
+                lambda: set(index.between(term.low, term.high)))
+    if term.op == 'contains' and 'text' in indexes and (field == 'text' or field in text_fields):
+        estimate = indexes['text'].estimate(value)
+        if estimate is not None:
+            return 'trigram', estimate, lambda: indexes['text'].candidates(value)
+    return None
+
+
+class Plan:
+    """The steps of a query, most selective index first."""
+
+    def __init__(self, steps: List[Step], total: int):
+        self.steps = sorted(steps, key=lambda step: (step.estimate is None, step.estimate or 0))
+        self.total = total
+        self.scan: Optional[bool] = None
+        self._candidates: Optional[Set[str]] = None
+
+    def candidates(self) -> Optional[Set[str]]:
+        """Keys that may match, or None when walking the whole book is cheaper."""
+        if self.scan is not None:
+            return self._candidates
+        indexed = [step for step in self.steps if step.estimate is not None]
+        self.scan = not indexed or indexed[0].estimate > self.total * SCAN_SHARE
+        if self.scan:
+            return None
+        candidates = None
+        for step in indexed:
+            if candidates is None:
+                candidates = step.fetch()
+                step.action = 'driver'
+            elif len(candidates) > MIN_INTERSECT and \
+                    step.estimate <= INTERSECT_FACTOR * len(candidates):
+                candidates &= step.fetch()
+                step.action = 'intersect'
+            else:
+                continue
+            step.remaining = len(candidates)
+        self._candidates = candidates
+        return candidates
+
+    def explain(self) -> Dict:
+        """The plan as data: each term with its index, estimate, action and candidates left."""
+        candidates = self.candidates()
+        return {
+            'total': self.total,
+            'scan': self.scan,
+            'candidates': self.total if candidates is None else len(candidates),
+            'steps': [{'term': step.term.source, 'index': step.index, 'estimate': step.estimate,
+                       'action': step.action, 'remaining': step.remaining} for step in self.steps],
+        }
+
+
+def plan_query(query: Query, indexes: Dict, total: int,
+               text_fields: Sequence[str] = TEXT_FIELDS) -> Plan:
+    """Plan ``query`` over a book of ``total`` contacts.
+
+    ``indexes`` holds whichever of these the caller keeps: 'text' (a
+    TrigramIndex over ``text_fields``), 'phone' and 'email' (LookupIndex),
+    'name_prefix' (the OrderedIndex of name keys), 'phone_prefix' and
+    'email_prefix' (PrefixIndex), 'added' and 'updated' (TimeIndex).
+    """
+    steps = []
+    for term in query.terms:
+        access = _access(term, indexes, text_fields)
+        steps.append(Step(term) if access is None else Step(term, *access))
+    return Plan(steps, total)
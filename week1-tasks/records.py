@@ -0,0 +1,117 @@
+"""
+Compact in-memory representation of a contact.
+
+A plain dict per contact costs a hash table for five or six keys, and each
+ISO timestamp is its own 26-character string. ``ContactRecord`` keeps the
+fields in ``__slots__`` and holds timestamps as integer microseconds, but
+still reads like the dict it replaces (``record['email']``,
+``record.get('updated_at')``). ``to_dict()`` builds the dict only when a
+contact is written to storage or sent as JSON.
+"""
+
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, Optional, Union
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+Timestamp = Union[int, str, None]
+
+
+def epoch_micros(moment: datetime) -> int:
+    """Microseconds from the epoch to a naive datetime."""
+    return (moment - EPOCH) // MICROSECOND
+
+
+def encode_timestamp(text: Optional[str]) -> Timestamp:
+    """Microseconds since the epoch, or the text itself if it would not survive the trip."""
+    if not text:
+        return None
+    try:
+        moment = datetime.fromisoformat(text)
+    except ValueError:
+        return text
+    if moment.tzinfo is not None or moment.isoformat() != text:
+        return text
+    return epoch_micros(moment)
+
+
+def decode_timestamp(value: Timestamp) -> Optional[str]:
+    """The ISO text that ``encode_timestamp`` was given."""
+    if value is None or isinstance(value, str):
+        return value
+    return (EPOCH + timedelta(microseconds=value)).isoformat()
+
+
+class ContactRecord:
+    """One contact, stored in slots instead of a dict."""
+
+    FIELDS = ('name', 'phone', 'email', 'address', 'created_at', 'updated_at')
+    __slots__ = ('name', 'phone', 'email', 'address', 'created', 'updated')
+
+    def __init__(self, name: str, phone: str, email: str = '', address: str = '',
+                 created_at: Optional[str] = None, updated_at: Optional[str] = None):
+        self.name = name
+        self.phone = phone
+        self.email = email
+        self.address = address
+        self.created = encode_timestamp(created_at)
+        self.updated = encode_timestamp(updated_at)
+
+    @classmethod
+    def from_dict(cls, contact: Dict) -> 'ContactRecord':
+        if isinstance(contact, cls):
+            return contact
+        return cls(contact['name'], contact['phone'], contact.get('email') or '',
+                   contact.get('address') or '', contact.get('created_at'),
+                   contact.get('updated_at'))
+
+    @property
+    def created_at(self) -> Optional[str]:
+        return decode_timestamp(self.created)
+
+    @property
+    def updated_at(self) -> Optional[str]:
+        return decode_timestamp(self.updated)
+
+    def to_dict(self) -> Dict:
+        """The contact as the dict stored on disk; absent timestamps are left out."""
+        contact = {'name': self.name, 'phone': self.phone,
+                   'email': self.email, 'address': self.address}
+        if self.created is not None:
+            contact['created_at'] = self.created_at
+        if self.updated is not None:
+            contact['updated_at'] = self.updated_at
+        return contact
+
+    def __getitem__(self, field: str):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        value = getattr(self, field)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def get(self, field: str, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def __contains__(self, field: str) -> bool:
+        return self.get(field) is not None
+
+    def keys(self) -> Iterator[str]:
+        return (field for field in self.FIELDS if field in self)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, ContactRecord):
+            other = other.to_dict()
+        elif not isinstance(other, dict):
+            return NotImplemented
+        return self.to_dict() == other
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"ContactRecord({self.to_dict()!r})"
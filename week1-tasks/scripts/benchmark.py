@@ -0,0 +1,536 @@
+"""
+Benchmarks for the Contact Management System
+Run from the week1-tasks folder, for example:
+
+    python scripts/benchmark.py search --sizes 10000 100000 1000000
+    python scripts/benchmark.py memory --sizes 100000 1000000
+    python scripts/benchmark.py suggest --sizes 100000 1000000
+    python scripts/benchmark.py query --sizes 100000 1000000
+    python scripts/benchmark.py dedup --sizes 100000 1000000 --workers 0 4
+    python scripts/benchmark.py suite --sizes 1000 10000 --output results.json
+    python scripts/benchmark.py compare baseline.json results.json
+"""
+
+import argparse
+import builtins
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import contact_manager  # noqa: E402
+from dedup import find_duplicates  # noqa: E402
+from query import parse_query  # noqa: E402
+from records import ContactRecord  # noqa: E402
+from storage import STORAGE_BACKENDS, default_filename, open_storage  # noqa: E402
+
+FIRST_NAMES = [
+    'James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda',
+    'William', 'Elizabeth', 'David', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica',
+    'Thomas', 'Sarah', 'Charles', 'Karen', 'Priya', 'Wei', 'Fatima', 'Carlos',
+    'Aisha', 'Hiroshi', 'Olga', 'Mateo', 'Ananya', 'Kwame', 'Ingrid', 'Yusuf',
+]
+LAST_NAMES = [
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis',
+    'Rodriguez', 'Martinez', 'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson',
+    'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin', 'Sharma', 'Chen', 'Khan',
+    'Silva', 'Okafor', 'Tanaka', 'Ivanova', 'Rossi', 'Nielsen', 'Mensah', 'Kowalski',
+]
+DOMAINS = ['example.com', 'example.org', 'mail.com', 'company.com', 'acme.com',
+           'university.edu', 'startup.io', 'agency.gov']
+STREETS = ['Main Street', 'Oak Avenue', 'Pine Road', 'Maple Drive', 'Cedar Lane',
+           'Elm Street', 'Lake View', 'Hill Road']
+
+
+def generate_contacts(count, seed=42):
+    """Build a reproducible dictionary of synthetic contacts keyed like ContactManager."""
+    rng = random.Random(seed)
+    contacts = {}
+    for i in range(count):
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+        name = f"{first} {last} {i}"
+        contacts[name.lower()] = {
+            'name': name,
+            'phone': ''.join(rng.choice('0123456789') for _ in range(10)),
+            'email': f"{first}.{last}{i}@{rng.choice(DOMAINS)}".lower() if rng.random() < 0.8 else '',
+            'address': f"{rng.randint(1, 9999)} {rng.choice(STREETS)}" if rng.random() < 0.6 else '',
+            'created_at': f"2026-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T"
+                          f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00",
+        }
+    return contacts
+
+
+def make_manager(contacts, filename):
+    """Create an app.ContactManager holding the given contacts without writing them."""
+    cm = app.ContactManager(filename)
+    cm.contacts = contacts
+    cm.build_indexes()
+    return cm
+
+
+def linear_search(contacts, search_term):
+    """The full scan search_contacts used before the trigram index."""
+    search_term = search_term.lower()
+    results = []
+    for contact in contacts.values():
+        if (search_term in contact['name'].lower() or
+                search_term in contact['phone'] or
+                search_term in contact['email'].lower()):
+            results.append(contact)
+    return results
+
+
+def best_of(func, repeat):
+    """Run func repeat times and return (result, fastest time in milliseconds)."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def uncached_search(cm, term):
+    """Time the query itself rather than a result cache hit."""
+    cm.result_cache.clear()
+    return cm.search_contacts(term)
+
+
+def bench_search(size, repeat):
+    contacts = generate_contacts(size)
+    start = time.perf_counter()
+    cm = make_manager(contacts, os.path.join(tempfile.mkdtemp(), 'contacts.json'))
+    build_ms = (time.perf_counter() - start) * 1000
+    some_contact = contacts[next(iter(contacts))]
+    queries = {
+        'exact name': some_contact['name'],
+        'phone digits': some_contact['phone'][2:8],
+        'first name': 'priya',
+        'domain': 'startup.io',
+        'common word': 'example',
+        'short term': 'ch',
+    }
+    print(f"\n{size} contacts (index built in {build_ms:.0f} ms)")
+    print(f"{'query':<14}{'matches':>10}{'linear ms':>12}{'sorted ms':>12}{'indexed ms':>12}")
+    for label, term in queries.items():
+        expected, linear_ms = best_of(lambda: linear_search(contacts, term), repeat)
+        # The same scan with results in name order, as search_contacts returns them
+        _, sorted_ms = best_of(lambda: sorted(linear_search(contacts, term),
+                                              key=lambda contact: contact['name'].lower()), repeat)
+        results, indexed_ms = best_of(lambda: uncached_search(cm, term), repeat)
+        assert len(results) == len(expected), f"Index disagrees with scan for {term!r}"
+        print(f"{label:<14}{len(results):>10}{linear_ms:>12.2f}{sorted_ms:>12.2f}{indexed_ms:>12.2f}")
+
+
+def bench_suggest(size, queries):
+    contacts = generate_contacts(size)
+    cm = make_manager(contacts, os.path.join(tempfile.mkdtemp(), 'contacts.json'))
+    rng = random.Random(7)
+    samples = rng.sample(list(contacts.values()), min(queries, size))
+    prefixes = []
+    for contact in samples:
+        prefixes += [contact['name'][:rng.randint(1, 4)], contact['phone'][:rng.randint(2, 6)],
+                     contact['email'][:rng.randint(1, 5)]]
+    times = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        cm.suggest(prefix)
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+    print(f"{size:>10}{len(times):>10}{statistics.median(times):>10.3f}{p99:>10.3f}")
+
+
+def bench_query(size, repeat):
+    contacts = generate_contacts(size)
+    cm = make_manager(contacts, os.path.join(tempfile.mkdtemp(), 'contacts.json'))
+    some_contact = contacts[next(iter(contacts))]
+    queries = {
+        'exact email': f"email:{some_contact['email'] or 'nobody@example.com'}",
+        'name prefix': 'name:priya*',
+        'prefix + domain': 'name:priya* email:@startup.io',
+        'date range': 'added:2026-03-01..2026-03-03',
+        'all four': 'name:w* email:@acme.com phone:5* added:>2026-11-15',
+    }
+    print(f"\n{size} contacts")
+    print(f"{'query':<17}{'matches':>9}{'scan ms':>10}{'planned ms':>12}  driver")
+    for label, text in queries.items():
+        query = parse_query(text)
+        scan = lambda: sorted((c for c in contacts.values() if query.matches(c)),
+                              key=lambda c: c['name'].lower())
+        expected, scan_ms = best_of(scan, repeat)
+        results, planned_ms = best_of(lambda: uncached_search(cm, text), repeat)
+        assert results == expected, f"planned results differ for {text!r}"
+        driver = next((step['index'] for step in cm.explain(text)['steps']
+                       if step['action'] == 'driver'), 'scan')
+        print(f"{label:<17}{len(results):>9}{scan_ms:>10.2f}{planned_ms:>12.2f}  {driver}")
+
+
+def plant_duplicates(contacts, share, seed=11):
+    """Add a reformatted, misspelled copy of a share of the contacts; returns (original, copy) keys."""
+    rng = random.Random(seed)
+    planted = []
+    for key in rng.sample(sorted(contacts), int(len(contacts) * share)):
+        contact = contacts[key]
+        first, last, number = contact['name'].split()
+        phone = contact['phone']
+        copy = dict(contact, name=f"{last}, {first[:-1]} {number}", email='',
+                    phone=f"+1 ({phone[:3]}) {phone[3:6]}-{phone[6:]}")
+        contacts[copy['name'].lower()] = copy
+        planted.append((key, copy['name'].lower()))
+    return planted
+
+
+def bench_dedup(size, workers):
+    contacts = generate_contacts(size)
+    planted = plant_duplicates(contacts, 0.05)
+    start = time.perf_counter()
+    clusters = find_duplicates(contacts, workers=workers)
+    seconds = time.perf_counter() - start
+    cluster_of = {key: i for i, cluster in enumerate(clusters) for key in cluster}
+    found = sum(1 for key, copy in planted
+                if key in cluster_of and cluster_of[key] == cluster_of.get(copy))
+    print(f"{len(contacts):>10}{workers:>9}{seconds:>10.2f}{len(clusters):>10}"
+          f"{found / len(planted):>9.1%}")
+
+
+def measure(build):
+    """Return (result, bytes still allocated by build() once it has returned)."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        allocated, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, allocated
+
+
+def load_records(text):
+    """Load contacts the way ContactManager.load_contacts stores them."""
+    contacts = json.loads(text)
+    for name_key, contact in contacts.items():
+        contacts[name_key] = ContactRecord.from_dict(contact)
+    return contacts
+
+
+def bench_memory(size):
+    # Load from JSON text like the app does, so no strings are shared with the generator
+    text = json.dumps(generate_contacts(size))
+    layouts = {
+        'dicts': lambda: json.loads(text),
+        'records': lambda: load_records(text),
+    }
+    print(f"\n{size} contacts")
+    print(f"{'layout':<10}{'MB':>10}{'bytes/contact':>16}")
+    for label, build in layouts.items():
+        contacts, allocated = measure(build)
+        assert len(contacts) == size
+        del contacts
+        print(f"{label:<10}{allocated / 1e6:>10.1f}{allocated / size:>16.0f}")
+
+
+def latencies(func, args_list):
+    """Call func once per argument tuple; return (median, p95) in milliseconds."""
+    times = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return statistics.median(times), times[min(len(times) - 1, int(len(times) * 0.95))]
+
+
+@contextlib.contextmanager
+def scripted_input(answers):
+    """Answer the CLI's input() prompts from a list, and hide what it prints."""
+    answers = iter(answers)
+    original = builtins.input
+    builtins.input = lambda prompt='': next(answers)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        builtins.input = original
+
+
+def search_terms(contacts):
+    """One search term per selectivity level, all on the name so both managers support them."""
+    some_contact = contacts[next(iter(contacts))]
+    first, last = some_contact['name'].split()[:2]
+    return {
+        'one': some_contact['name'],
+        'rare': f"{first} {last}",
+        'common': first,
+        'short': first[:2],
+    }
+
+
+class CliAdapter:
+    """contact_manager.ContactManager driven without a terminal."""
+    label = 'cli'
+
+    def __init__(self, filename, storage):
+        with scripted_input([]):
+            self.cm = contact_manager.ContactManager(filename, storage)
+
+    def save(self):
+        with scripted_input([]):
+            assert self.cm.save_contacts()
+
+    def add(self, name, phone, email):
+        with scripted_input([]):
+            assert self.cm.add_contact(name, phone, email)
+
+    def update(self, name, phone):
+        with scripted_input(['', phone, '', '']):
+            assert self.cm.update_contact(name)
+
+    def delete(self, name):
+        with scripted_input(['y']):
+            assert self.cm.delete_contact(name)
+
+    def search(self, term):
+        with scripted_input([]):
+            return self.cm.search_contact(term)
+
+    def stats(self):
+        return self.cm.get_stats()
+
+
+class WebAdapter:
+    """app.ContactManager, called directly rather than through HTTP."""
+    label = 'web'
+
+    def __init__(self, filename, storage):
+        self.cm = app.ContactManager(filename, storage)
+
+    def save(self):
+        assert self.cm.save_contacts()
+
+    def add(self, name, phone, email):
+        assert self.cm.add_contact(name, phone, email)[0]
+
+    def update(self, name, phone):
+        contact = self.cm.get_contact(name)
+        assert self.cm.update_contact(name, name, phone, contact['email'], contact['address'])[0]
+
+    def delete(self, name):
+        assert self.cm.delete_contact(name)[0]
+
+    def search(self, term):
+        return uncached_search(self.cm, term)
+
+    def stats(self):
+        return self.cm.get_stats()
+
+
+def copy_book(source, directory):
+    """Copy a stored book (a file, or a directory for sharded storage) into directory."""
+    target = os.path.join(directory, os.path.basename(source))
+    if os.path.isdir(source):
+        shutil.copytree(source, target)
+    else:
+        shutil.copy(source, target)
+    return target
+
+
+def bench_manager(adapter_class, contacts, source, storage, repeat, ops):
+    """Time one ContactManager implementation; returns {metric: milliseconds}."""
+    results = {}
+    workdir = tempfile.mkdtemp()
+    try:
+        filename = copy_book(source, workdir)
+        adapter, results['load_ms'] = best_of(lambda: adapter_class(filename, storage), repeat)
+        _, results['save_ms'] = best_of(adapter.save, repeat)
+
+        names = [f"Bench Contact {i}" for i in range(ops)]
+        results['add_ms'], results['add_p95_ms'] = latencies(
+            adapter.add, [(name, '5550001234', 'bench@example.com') for name in names])
+        results['update_ms'], results['update_p95_ms'] = latencies(
+            adapter.update, [(name, '5550009876') for name in names])
+        results['delete_ms'], results['delete_p95_ms'] = latencies(
+            adapter.delete, [(name,) for name in names])
+
+        for level, term in search_terms(contacts).items():
+            matches, results[f'search_{level}_ms'] = best_of(lambda: adapter.search(term), repeat)
+            results[f'search_{level}_matches'] = len(matches)
+        _, results['stats_ms'] = best_of(adapter.stats, repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def bench_routes(contacts, source, storage, repeat):
+    """Time the Flask routes through the test client."""
+    workdir = tempfile.mkdtemp()
+    original_cm = app.cm
+    try:
+        filename = copy_book(source, workdir)
+        app.cm = app.ContactManager(filename, storage)
+        client = app.app.test_client()
+        term = search_terms(contacts)['common']
+        routes = {
+            'route_index_ms': '/',
+            'route_index_search_ms': f'/?search={term}',
+            'route_api_page_ms': '/api/contacts?limit=50',
+            'route_api_search_ms': f'/api/contacts?search={term}&limit=50',
+            'route_stats_ms': '/api/stats',
+            'route_domains_ms': '/api/stats/domains?limit=10',
+            'route_export_ms': '/api/contacts/export',
+        }
+        results = {}
+        for metric, url in routes.items():
+            def get():
+                response = client.get(url)
+                assert response.status_code == 200, f"{url} returned {response.status_code}"
+                return response.get_data()
+            _, results[metric] = best_of(get, repeat)
+        return results
+    finally:
+        app.cm = original_cm
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_suite(sizes, storage, repeat, ops):
+    """Run every benchmark at every size; returns a JSON-serializable report."""
+    report = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'storage': storage,
+            'repeat': repeat,
+            'ops': ops,
+        },
+        'results': {},
+    }
+    for size in sizes:
+        contacts = generate_contacts(size)
+        workdir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(workdir, default_filename(storage))
+            # Write the data set through the backend so every run loads the same file
+            seed_storage = open_storage(storage, source)
+            seed_storage.save(contacts)
+            seed_storage.close()
+            for adapter_class in (CliAdapter, WebAdapter):
+                metrics = bench_manager(adapter_class, contacts, source, storage, repeat, ops)
+                for metric, value in metrics.items():
+                    report['results'][f"{size}/{adapter_class.label}/{metric}"] = value
+                print(f"{size:>8} {adapter_class.label}: done", file=sys.stderr)
+            for metric, value in bench_routes(contacts, source, storage, repeat).items():
+                report['results'][f"{size}/web/{metric}"] = value
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def compare(baseline, current, threshold, min_ms):
+    """Print every shared timing and return the names of those that regressed."""
+    regressions = []
+    print(f"{'metric':<42}{'baseline':>12}{'current':>12}{'change':>9}")
+    for metric in sorted(set(baseline['results']) & set(current['results'])):
+        if not metric.endswith('_ms'):
+            continue
+        old, new = baseline['results'][metric], current['results'][metric]
+        change = (new - old) / old if old else 0.0
+        regressed = new - old > min_ms and change > threshold
+        flag = '  REGRESSION' if regressed else ''
+        print(f"{metric:<42}{old:>12.3f}{new:>12.3f}{change:>+9.0%}{flag}")
+        if regressed:
+            regressions.append(metric)
+    for metric in sorted(set(baseline['results']) - set(current['results'])):
+        print(f"{metric:<42} missing from current run")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Contact Management System benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    search = subparsers.add_parser('search', help="compare indexed search with a full scan")
+    search.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    search.add_argument('--repeat', type=int, default=3)
+    memory = subparsers.add_parser('memory', help="compare bytes per contact of dicts and records")
+    memory.add_argument('--sizes', type=int, nargs='+', default=[100000])
+    suggest = subparsers.add_parser('suggest', help="time prefix suggestions")
+    suggest.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    suggest.add_argument('--queries', type=int, default=1000)
+    query = subparsers.add_parser('query', help="compare planned structured queries with a scan")
+    query.add_argument('--sizes', type=int, nargs='+', default=[100000])
+    query.add_argument('--repeat', type=int, default=3)
+    dedup = subparsers.add_parser('dedup', help="time duplicate detection on planted duplicates")
+    dedup.add_argument('--sizes', type=int, nargs='+', default=[100000])
+    dedup.add_argument('--workers', type=int, nargs='+', default=[0])
+    suite = subparsers.add_parser('suite', help="time both ContactManagers and the Flask routes")
+    suite.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    suite.add_argument('--storage', choices=sorted(STORAGE_BACKENDS), default='json')
+    suite.add_argument('--repeat', type=int, default=3)
+    suite.add_argument('--ops', type=int, default=50, help="adds, updates and deletes to time")
+    suite.add_argument('--output', help="write the JSON report here instead of stdout")
+    compare_parser = subparsers.add_parser('compare', help="flag regressions against a baseline")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.25,
+                                help="relative slowdown that counts as a regression")
+    compare_parser.add_argument('--min-ms', type=float, default=0.05,
+                                help="ignore slowdowns smaller than this many milliseconds")
+    args = parser.parse_args()
+
+    if args.command == 'search':
+        for size in args.sizes:
+            bench_search(size, args.repeat)
+    elif args.command == 'memory':
+        for size in args.sizes:
+            bench_memory(size)
+    elif args.command == 'suggest':
+        print(f"{'contacts':>10}{'queries':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for size in args.sizes:
+            bench_suggest(size, args.queries)
+    elif args.command == 'query':
+        for size in args.sizes:
+            bench_query(size, args.repeat)
+    elif args.command == 'dedup':
+        print(f"{'contacts':>10}{'workers':>9}{'seconds':>10}{'clusters':>10}{'recall':>9}")
+        for size in args.sizes:
+            for workers in args.workers:
+                bench_dedup(size, workers)
+    elif args.command == 'suite':
+        report = run_suite(args.sizes, args.storage, args.repeat, args.ops)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(report, file, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            print()
+    elif args.command == 'compare':
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        with open(args.current) as file:
+            current = json.load(file)
+        regressions = compare(baseline, current, args.threshold, args.min_ms)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}")
+            sys.exit(1)
+        print("\nNo regressions")
+
+
+if __name__ == '__main__':
+    main()
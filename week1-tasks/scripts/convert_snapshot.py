@@ -0,0 +1,54 @@
+"""
+Convert a contact book between JSON and the binary snapshot format
+Run from the week1-tasks folder:
+
+    python scripts/convert_snapshot.py contacts.json contacts.snap
+    python scripts/convert_snapshot.py contacts.snap contacts.json
+
+The direction follows the source file: a binary snapshot is written out as
+JSON, anything else is read as JSON (plus its journal, if any) and written
+as a binary snapshot.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snapshots import is_snapshot  # noqa: E402
+from storage import BinaryStorage, JsonStorage, read_json_book  # noqa: E402
+
+
+def convert(source, target):
+    """Copy every contact from source to target; returns (count, target format)."""
+    if is_snapshot(source):
+        # JsonStorage writes real dicts, so decode every record now
+        contacts = dict(BinaryStorage(source).load().items())
+        JsonStorage(target).save(contacts)
+        return len(contacts), 'json'
+    contacts = read_json_book(source)
+    BinaryStorage(target).save(contacts)
+    return len(contacts), 'binary'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert contacts between JSON and binary snapshots")
+    parser.add_argument('source')
+    parser.add_argument('target')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        print(f"❌ {args.source} not found")
+        sys.exit(1)
+    if os.path.abspath(args.source) == os.path.abspath(args.target):
+        print("❌ Source and target must be different files")
+        sys.exit(1)
+    count, kind = convert(args.source, args.target)
+    print(f"✅ Wrote {count} contacts from {args.source} to {args.target} ({kind})")
+    if kind == 'binary':
+        print(f"Start the app with CONTACTS_STORAGE=binary CONTACTS_FILE={args.target}")
+
+
+if __name__ == '__main__':
+    main()
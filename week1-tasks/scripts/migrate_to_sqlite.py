@@ -0,0 +1,43 @@
+"""
+Copy an existing contacts.json (and its journal, if any) into an SQLite database
+Run from the week1-tasks folder:
+
+    python scripts/migrate_to_sqlite.py contacts.json contacts.db
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import SqliteStorage, read_json_book  # noqa: E402
+
+
+def migrate(source, target):
+    """Load every contact from source and write them to the target database."""
+    contacts = read_json_book(source)
+    database = SqliteStorage(target)
+    try:
+        database.save(contacts)
+    finally:
+        database.close()
+    return len(contacts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import contacts.json into an SQLite database")
+    parser.add_argument('source', nargs='?', default='contacts.json')
+    parser.add_argument('target', nargs='?', default='contacts.db')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        print(f"❌ {args.source} not found")
+        sys.exit(1)
+    count = migrate(args.source, args.target)
+    print(f"✅ Copied {count} contacts from {args.source} to {args.target}")
+    print(f"Start the app with CONTACTS_STORAGE=sqlite CONTACTS_FILE={args.target}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Change the number of shards of a sharded contact book, or create one
+Run from the week1-tasks folder:
+
+    python scripts/reshard.py contacts.shards 32
+    python scripts/reshard.py contacts.shards 16 --source contacts.json
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import ShardedStorage, read_json_book  # noqa: E402
+
+
+def reshard(directory, shards, source=None):
+    """Rewrite the book in directory with the given number of shards."""
+    storage = ShardedStorage(directory)
+    try:
+        if source is None:
+            return storage.reshard(shards)
+        contacts = read_json_book(source)
+        with storage.locked():
+            storage.load()
+            storage.save(contacts, shards)
+        return len(contacts)
+    finally:
+        storage.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Change the shard count of a sharded contact book")
+    parser.add_argument('directory', nargs='?', default='contacts.shards')
+    parser.add_argument('shards', type=int)
+    parser.add_argument('--source', help="replace the book with the contacts of this JSON file")
+    args = parser.parse_args()
+
+    if args.shards < 1:
+        print("❌ The number of shards must be at least 1")
+        sys.exit(1)
+    if args.source and not os.path.exists(args.source):
+        print(f"❌ {args.source} not found")
+        sys.exit(1)
+    count = reshard(args.directory, args.shards, args.source)
+    print(f"✅ {args.directory} now holds {count} contacts in {args.shards} shards")
+    print(f"Start the app with CONTACTS_STORAGE=sharded CONTACTS_FILE={args.directory}")
+
+
+if __name__ == '__main__':
+    main()
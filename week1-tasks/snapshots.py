@@ -0,0 +1,252 @@
+"""
+Binary snapshot of the contact book, read through mmap.
+
+A JSON snapshot has to be parsed in full before the first contact can be
+used. This format stores each field as a column: an offset table followed
+by the UTF-8 text of every value, with contacts sorted by key. Opening a
+snapshot maps the file and reads the header; a contact is only decoded
+when it is looked up, and a key is found by binary search over the key
+column.
+
+Layout (integers are little-endian, tables start on 8-byte boundaries)::
+
+    header      magic b'CONTACTS', version u32, column count u32, contact count u64
+    directory   per column: offset table position u64, text position u64
+    per column  offset table of count + 1 u64 (value i is text[off[i]:off[i + 1]]),
+                then the text of all values
+
+Missing values, including absent timestamps, are stored as empty strings.
+"""
+
+import io
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import ItemsView, MutableMapping, ValuesView
+from typing import IO, Dict, Iterator, Optional, Tuple
+
+from records import ContactRecord
+
+MAGIC = b'CONTACTS'
+VERSION = 1
+COLUMNS = ('key', 'name', 'phone', 'email', 'address', 'created_at', 'updated_at')
+HEADER = struct.Struct('<8sIIQ')
+DIRECTORY = struct.Struct('<QQ')
+
+_MISSING = object()
+
+
+class SnapshotError(ValueError):
+    """The file is not a snapshot, or is truncated."""
+
+
+def _pad(file: IO) -> None:
+    file.write(b'\0' * (-file.tell() % 8))
+
+
+def write_snapshot(file: IO, contacts: Dict[str, Dict]) -> None:
+    """Write ``contacts`` (dicts or records) to a binary file opened for writing."""
+    keys = sorted(contacts)
+    records = [contacts[key] for key in keys]
+    file.write(HEADER.pack(MAGIC, VERSION, len(COLUMNS), len(keys)))
+    directory_position = file.tell()
+    file.write(b'\0' * DIRECTORY.size * len(COLUMNS))
+    directory = []
+    for column in COLUMNS:
+        if column == 'key':
+            values = [key.encode('utf-8') for key in keys]
+        else:
+            values = [(record.get(column) or '').encode('utf-8') for record in records]
+        offsets = array('Q', [0])
+        total = 0
+        for value in values:
+            total += len(value)
+            offsets.append(total)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        _pad(file)
+        offsets_position = file.tell()
+        file.write(offsets.tobytes())
+        directory.append((offsets_position, file.tell()))
+        file.write(b''.join(values))
+    end = file.tell()
+    file.seek(directory_position)
+    for entry in directory:
+        file.write(DIRECTORY.pack(*entry))
+    file.seek(end)
+
+
+def is_snapshot(filename: str) -> bool:
+    """Whether ``filename`` starts like a binary snapshot."""
+    with open(filename, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+class SnapshotReader:
+    """Random access to the contacts of a snapshot held in ``buffer``."""
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        if len(buffer) < HEADER.size:
+            raise SnapshotError("File is too short to be a contacts snapshot")
+        magic, version, columns, count = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise SnapshotError("Not a contacts snapshot")
+        if version != VERSION or columns != len(COLUMNS):
+            raise SnapshotError(f"Unsupported snapshot version {version}")
+        self._count = count
+        self._columns = []
+        view = memoryview(buffer)
+        for column in range(columns):
+            offsets_position, text_position = DIRECTORY.unpack_from(
+                buffer, HEADER.size + column * DIRECTORY.size)
+            table = view[offsets_position:offsets_position + 8 * (count + 1)]
+            if len(table) != 8 * (count + 1):
+                raise SnapshotError("Snapshot is truncated")
+            if sys.byteorder == 'little':
+                offsets = table.cast('Q')
+            else:
+                offsets = array('Q', table.tobytes())
+                offsets.byteswap()
+            if text_position + offsets[count] > len(buffer):
+                raise SnapshotError("Snapshot is truncated")
+            self._columns.append((offsets, text_position))
+
+    @classmethod
+    def open(cls, filename: str) -> 'SnapshotReader':
+        """Map ``filename`` read-only; nothing is decoded until it is used."""
+        with open(filename, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                raise SnapshotError("Snapshot file is empty")
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def empty(cls) -> 'SnapshotReader':
+        buffer = io.BytesIO()
+        write_snapshot(buffer, {})
+        return cls(buffer.getvalue())
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _raw(self, column: int, i: int) -> bytes:
+        offsets, text = self._columns[column]
+        return self._buffer[text + offsets[i]:text + offsets[i + 1]]
+
+    def key(self, i: int) -> str:
+        return str(self._raw(0, i), 'utf-8')
+
+    def find(self, key: str) -> int:
+        """Position of ``key``, or -1. UTF-8 bytes sort like the strings they encode."""
+        target = key.encode('utf-8')
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._raw(0, mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self._count and self._raw(0, lo) == target else -1
+
+    def record(self, i: int) -> ContactRecord:
+        name, phone, email, address, created, updated = (
+            str(self._raw(column, i), 'utf-8') for column in range(1, len(COLUMNS)))
+        return ContactRecord(name, phone, email, address, created or None, updated or None)
+
+
+class MappedContacts(MutableMapping):
+    """Contacts of a snapshot, decoded one record at a time when used.
+
+    Writes are kept in a dict on top of the snapshot, with None marking a
+    deleted contact, until the book is saved again and ``remap()`` moves
+    this mapping onto the new file. The snapshot and its changes are
+    swapped in a single assignment, so a reader never sees half of each.
+    """
+
+    def __init__(self, snapshot: SnapshotReader):
+        self._state: Tuple[SnapshotReader, Dict[str, Optional[ContactRecord]]] = (snapshot, {})
+        self._len = len(snapshot)
+
+    def remap(self, snapshot: SnapshotReader) -> None:
+        """Use ``snapshot``, which holds every contact of this mapping, from now on."""
+        self._state = (snapshot, {})
+        self._len = len(snapshot)
+
+    @property
+    def overlay_size(self) -> int:
+        """Number of contacts changed since the snapshot was written."""
+        return len(self._state[1])
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __contains__(self, key) -> bool:
+        snapshot, changes = self._state
+        contact = changes.get(key, _MISSING)
+        if contact is not _MISSING:
+            return contact is not None
+        return isinstance(key, str) and snapshot.find(key) >= 0
+
+    def __getitem__(self, key: str) -> ContactRecord:
+        snapshot, changes = self._state
+        contact = changes.get(key, _MISSING)
+        if contact is _MISSING:
+            i = snapshot.find(key) if isinstance(key, str) else -1
+            if i >= 0:
+                return snapshot.record(i)
+            contact = None
+        if contact is None:
+            raise KeyError(key)
+        return contact
+
+    def __setitem__(self, key: str, contact: ContactRecord) -> None:
+        if key not in self:
+            self._len += 1
+        self._state[1][key] = contact
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._state[1][key] = None
+        self._len -= 1
+
+    def _iter_items(self) -> Iterator[Tuple[str, ContactRecord]]:
+        snapshot, changes = self._state
+        for i in range(len(snapshot)):
+            key = snapshot.key(i)
+            contact = changes.get(key, _MISSING)
+            if contact is _MISSING:
+                yield key, snapshot.record(i)
+            elif contact is not None:
+                yield key, contact
+        for key, contact in changes.items():
+            if contact is not None and snapshot.find(key) < 0:
+                yield key, contact
+
+    def __iter__(self) -> Iterator[str]:
+        snapshot, changes = self._state
+        for i in range(len(snapshot)):
+            key = snapshot.key(i)
+            if changes.get(key, _MISSING) is not None:
+                yield key
+        for key, contact in changes.items():
+            if contact is not None and snapshot.find(key) < 0:
+                yield key
+
+    def items(self) -> ItemsView:
+        return _Items(self)
+
+    def values(self) -> ValuesView:
+        return _Values(self)
+
+
+class _Items(ItemsView):
+    def __iter__(self):
+        return self._mapping._iter_items()
+
+
+class _Values(ValuesView):
+    def __iter__(self):
+        return (contact for _, contact in self._mapping._iter_items())
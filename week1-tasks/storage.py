@@ -0,0 +1,931 @@
+"""
+Storage backends for the Contact Management System.
+
+A storage object persists the contacts dictionary that ContactManager keeps
+in memory. Every backend implements the same interface: ``load()`` returns
+the stored contacts, ``save()`` rewrites all of them, ``apply()`` persists a
+list of ``(name_key, contact)`` changes, where a contact of ``None`` means
+the key was deleted, and ``close()`` releases files and connections.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows has no flock; locking then only covers one process
+    fcntl = None
+from typing import Callable, Dict, IO, Iterable, List, Optional, Set, Tuple
+
+from snapshots import MappedContacts, SnapshotReader, write_snapshot
+
+Change = Tuple[str, Optional[Dict]]
+
+
+def _create_temp_file(filename: str) -> Tuple[int, str]:
+    """Create a new, empty file next to ``filename`` and return its descriptor and path.
+
+    Unlike mkstemp() it asks for the mode open() uses, so the umask applies as
+    for any other new file.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    prefix = '.' + os.path.basename(filename) + '.'
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        tmp_path = os.path.join(directory, prefix + os.urandom(6).hex() + '.tmp')
+        try:
+            return os.open(tmp_path, flags, 0o666), tmp_path
+        except FileExistsError:
+            continue
+
+
+def write_temp_file(filename: str, write: Callable[[IO], None], mode: str = 'w') -> str:
+    """Write and fsync a temporary file next to ``filename`` and return its path.
+
+    The file gets the permissions ``filename`` has, if it exists, before it
+    replaces it.
+    """
+    fd, tmp_path = _create_temp_file(filename)
+    try:
+        if hasattr(os, 'fchmod'):
+            try:
+                os.fchmod(fd, os.stat(filename).st_mode & 0o7777)
+            except FileNotFoundError:
+                pass
+        with os.fdopen(fd, mode) as file:
+            write(file)
+            file.flush()
+            os.fsync(file.fileno())
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return tmp_path
+
+
+def atomic_write(filename: str, write: Callable[[IO], None], mode: str = 'w') -> int:
+    """Write a file through a temporary copy so a crash never leaves it truncated.
+
+    Returns the size of the file written.
+    """
+    tmp_path = write_temp_file(filename, write, mode)
+    size = os.path.getsize(tmp_path)
+    os.replace(tmp_path, filename)
+    return size
+
+
+def encode_default(value):
+    """``json`` fallback for contacts kept as records rather than dicts."""
+    to_dict = getattr(value, 'to_dict', None)
+    if to_dict is None:
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+    return to_dict()
+
+
+def diff_contacts(old: Dict[str, Dict], new: Dict[str, Dict]) -> List[Change]:
+    """Changes that turn ``old`` into ``new``."""
+    changes: List[Change] = [(key, None) for key in old if key not in new]
+    changes.extend((key, contact) for key, contact in new.items() if old.get(key) != contact)
+    return changes
+
+
+class FileLock:
+    """Advisory lock on ``path`` shared by every process using the same contacts.
+
+    The lock is re-entrant and also serialises the threads of one process.
+    Platforms without ``fcntl`` only get the in-process part.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file: Optional[IO] = None
+
+    def __enter__(self) -> 'FileLock':
+        self._thread_lock.acquire()
+        try:
+            if self._depth == 0 and fcntl is not None:
+                if self._file is None:
+                    self._file = open(self.path, 'a')
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def version(self) -> Tuple[str, int]:
+        """(book id, write count) kept in the lock file; ('', 0) before the first write."""
+        try:
+            with open(self.path) as file:
+                book_id, count = file.read().split()
+            return book_id, int(count)
+        except (OSError, ValueError):
+            return '', 0
+
+    def bump_version(self) -> Tuple[str, int]:
+        """Count one more write. The id is made up with the first one, so a count
+        that restarts from zero (the lock file was deleted) never repeats an old version."""
+        with self:
+            book_id, count = self.version()
+            book_id, count = book_id or os.urandom(4).hex(), count + 1
+            data = f'{book_id} {count}\n'.encode()
+            # Rewritten in place: replacing the file would break the flock on it
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                os.pwrite(fd, data, 0)
+                os.ftruncate(fd, len(data))
+            finally:
+                os.close(fd)
+        return book_id, count
+
+
+class Storage:
+    """Interface shared by the storage backends.
+
+    ContactManager calls ``load()``, ``refresh()`` and every write while
+    holding ``locked()``, so processes sharing a file never interleave a
+    read-modify-write. ``changed()`` is cheap enough to call on every request
+    and tells whether another process wrote since this one last looked;
+    ``refresh()`` then returns just the changes it made. ``bytes_written``
+    counts what this process wrote to the backend's files.
+
+    Every ``save()`` and ``apply()`` also counts one write in the lock file,
+    so ``shared_version()``, read under the lock, is the same in every
+    process that has read the same writes.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.lock = FileLock(filename + '.lock')
+        self.bytes_written = 0
+        self._written_lock = threading.Lock()
+
+    def _wrote(self, size: int) -> None:
+        # The journal compactor writes from its own thread
+        with self._written_lock:
+            self.bytes_written += size
+
+    def locked(self) -> FileLock:
+        return self.lock
+
+    def shared_version(self) -> Tuple[str, int]:
+        return self.lock.version()
+
+    def _committed(self) -> None:
+        self.lock.bump_version()
+
+    def load(self) -> Dict[str, Dict]:
+        raise NotImplementedError
+
+    def save(self, contacts: Dict[str, Dict]) -> None:
+        raise NotImplementedError
+
+    def apply(self, changes: Iterable[Change], contacts: Dict[str, Dict]) -> None:
+        raise NotImplementedError
+
+    def changed(self) -> bool:
+        return False
+
+    def refresh(self, contacts: Dict[str, Dict]) -> List[Change]:
+        return []
+
+    def close(self) -> None:
+        self.lock.close()
+
+
+class JsonStorage(Storage):
+    """Keep every contact in one pretty-printed JSON file."""
+
+    def __init__(self, filename: str):
+        super().__init__(filename)
+        self._seen = None
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _read_snapshot(self) -> Dict[str, Dict]:
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as file:
+                return json.load(file)
+        return {}
+
+    def load(self) -> Dict[str, Dict]:
+        self._seen = self._signature()
+        return self._read_snapshot()
+
+    def save(self, contacts: Dict[str, Dict]) -> None:
+        self._wrote(atomic_write(self.filename, lambda file: json.dump(contacts, file, indent=2,
+                                                                    default=encode_default)))
+        self._seen = self._signature()
+        self._committed()
+
+    def apply(self, changes: Iterable[Change], contacts: Dict[str, Dict]) -> None:
+        self.save(contacts)
+
+    def changed(self) -> bool:
+        return self._signature() != self._seen
+
+    def refresh(self, contacts: Dict[str, Dict]) -> List[Change]:
+        # A JSON file can only be re-read as a whole
+        return diff_contacts(contacts, self.load()) if self.changed() else []
+
+
+class BinaryStorage(JsonStorage):
+    """Keep every contact in one binary snapshot (see snapshots.py).
+
+    ``load()`` maps the file and returns a MappedContacts, which decodes a
+    contact only when it is used, so startup does not depend on the size of
+    the book. Like the JSON file, the snapshot is rewritten on every save;
+    afterwards the mapping is moved onto the new file.
+    """
+
+    def _read_snapshot(self) -> MappedContacts:
+        if os.path.exists(self.filename):
+            return MappedContacts(SnapshotReader.open(self.filename))
+        return MappedContacts(SnapshotReader.empty())
+
+    def save(self, contacts: Dict[str, Dict]) -> None:
+        self._wrote(atomic_write(self.filename, lambda file: write_snapshot(file, contacts), mode='wb'))
+        self._seen = self._signature()
+        self._committed()
+        if isinstance(contacts, MappedContacts):
+            contacts.remap(SnapshotReader.open(self.filename))
+
+
+class JournalStorage(JsonStorage):
+    """JSON snapshot plus an append-only journal of changes.
+
+    Every change is appended to ``<filename>.journal`` as one JSON line, so a
+    write costs the size of the change rather than the size of the book.
+    Once the journal grows past ``compact_bytes`` it is rotated to
+    ``<filename>.journal.1`` and a background thread folds it into a fresh
+    snapshot. Replaying a journal is idempotent, so a crash at any point
+    during compaction only means some lines are replayed twice.
+
+    Other processes follow the journal by remembering its inode and how far
+    they have read. A new journal starts with a header line that names the
+    journal it replaced, so a reader that had already read all of the old
+    one can carry on without reloading the snapshot.
+    """
+
+    def __init__(self, filename: str, compact_bytes: int = 8 * 1024 * 1024):
+        super().__init__(filename)
+        self.journal_path = filename + '.journal'
+        self.rotated_path = self.journal_path + '.1'
+        self.compact_bytes = compact_bytes
+        self._journal: Optional[IO] = None
+        self._journal_ino: Optional[int] = None
+        self._offset = 0
+        self._compactor: Optional[threading.Thread] = None
+
+    def load(self) -> Dict[str, Dict]:
+        contacts = super().load()
+        rotated = os.path.exists(self.rotated_path)
+        if rotated:
+            for key, value in self._read_journal(self.rotated_path, 0)[0]:
+                self._apply_entry(contacts, key, value)
+        if not os.path.exists(self.journal_path):
+            self._start_journal({'created': True})
+        self._journal_ino = os.stat(self.journal_path).st_ino
+        changes, self._offset = self._read_journal(self.journal_path, 0)
+        for key, value in changes:
+            self._apply_entry(contacts, key, value)
+        self._drop_torn_tail()
+        if rotated:
+            # A previous compaction did not finish; finish it now.
+            JsonStorage.save(self, contacts)
+            self._remove_rotated()
+        return contacts
+
+    def read_committed(self) -> Dict[str, Dict]:
+        """Every committed contact, read under the lock without writing anything.
+
+        Unlike ``load()`` this never creates a journal, drops a torn tail or
+        finishes a compaction, so tools can read a book that a running app
+        is using.
+        """
+        with self.lock:
+            contacts = self._read_snapshot()
+            # Replaying is idempotent, so a rotated journal already in the snapshot does no harm
+            for path in (self.rotated_path, self.journal_path):
+                if os.path.exists(path):
+                    for key, value in self._read_journal(path, 0)[0]:
+                        self._apply_entry(contacts, key, value)
+        return contacts
+
+    def _read_journal(self, path: str, start: int) -> Tuple[List[Change], int]:
+        """Committed changes in ``path`` after byte ``start``, and where they end."""
+        changes: List[Change] = []
+        offset = committed = start
+        batch: Optional[List[Change]] = None
+        with open(path, 'rb') as file:
+            file.seek(start)
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break  # torn write at the end of the journal
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                offset += len(line)
+                if 'begin' in entry:
+                    batch = []
+                elif 'commit' in entry:
+                    changes.extend(batch or ())
+                    batch = None
+                    committed = offset
+                elif 'key' not in entry:
+                    committed = offset  # header line
+                elif batch is not None:
+                    batch.append((entry['key'], entry['value']))
+                else:
+                    changes.append((entry['key'], entry['value']))
+                    committed = offset
+        return changes, committed
+
+    def _drop_torn_tail(self) -> None:
+        # Only called under the lock, so bytes past the last commit belong to
+        # a writer that died; later appends must not end up behind them.
+        if os.path.getsize(self.journal_path) > self._offset:
+            os.truncate(self.journal_path, self._offset)
+
+    @staticmethod
+    def _apply_entry(contacts: Dict[str, Dict], key: str, value: Optional[Dict]) -> None:
+        if value is None:
+            contacts.pop(key, None)
+        else:
+            contacts[key] = value
+
+    def _start_journal(self, header: Dict) -> None:
+        """Create a new journal containing only a header line."""
+        self._close_journal()
+        self._wrote(atomic_write(self.journal_path, lambda file: file.write(json.dumps(header) + '\n')))
+
+    def changed(self) -> bool:
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return True
+        return stat.st_ino != self._journal_ino or stat.st_size != self._offset
+
+    def refresh(self, contacts: Dict[str, Dict]) -> List[Change]:
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return diff_contacts(contacts, self.load())
+        changes: List[Change] = []
+        if stat.st_ino == self._journal_ino:
+            if stat.st_size != self._offset:
+                changes, self._offset = self._read_journal(self.journal_path, self._offset)
+                self._drop_torn_tail()
+            return changes
+
+        # The journal was replaced since we last read it
+        if self._rotated_ino() == self._journal_ino:
+            changes, _ = self._read_journal(self.rotated_path, self._offset)
+        elif self._read_header() != {'rotated': {'ino': self._journal_ino, 'size': self._offset}}:
+            # We missed part of a journal that is gone, or the book was rewritten
+            return diff_contacts(contacts, self.load())
+        self._close_journal()
+        self._journal_ino = stat.st_ino
+        new_changes, self._offset = self._read_journal(self.journal_path, 0)
+        self._drop_torn_tail()
+        return changes + new_changes
+
+    def _read_header(self) -> Optional[Dict]:
+        with open(self.journal_path, 'rb') as file:
+            try:
+                return json.loads(file.readline())
+            except ValueError:
+                return None
+
+    def _rotated_ino(self) -> Optional[int]:
+        try:
+            return os.stat(self.rotated_path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _remove_rotated(self) -> None:
+        try:
+            os.remove(self.rotated_path)
+        except FileNotFoundError:
+            pass
+
+    def save(self, contacts: Dict[str, Dict]) -> None:
+        with self.lock:
+            super().save(contacts)
+            self._remove_rotated()
+            self._start_journal({'saved': True})
+            self._journal_ino = os.stat(self.journal_path).st_ino
+            self._offset = os.path.getsize(self.journal_path)
+
+    def apply(self, changes: Iterable[Change], contacts: Dict[str, Dict]) -> None:
+        """Append changes to the journal with a single fsync.
+
+        More than one change is wrapped in begin/commit lines so that replay
+        applies the whole batch or none of it. Changes are written as they
+        are produced, so a large batch is never held in memory as one string.
+        """
+        changes = iter(changes)
+        first = next(changes, None)
+        if first is None:
+            return
+        second = next(changes, None)
+        with self.lock:
+            journal = self._open_journal()
+            start = journal.tell()
+            try:
+                if second is None:
+                    journal.write(self._encode(first))
+                else:
+                    journal.write(b'{"begin":true}\n')
+                    journal.write(self._encode(first))
+                    journal.write(self._encode(second))
+                    for change in changes:
+                        journal.write(self._encode(change))
+                    journal.write(b'{"commit":true}\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            except BaseException:
+                # Drop the partial write so later appends are not swallowed by it
+                self._journal = None
+                try:
+                    journal.close()
+                except OSError:
+                    pass
+                os.truncate(self.journal_path, start)
+                raise
+            self._offset = journal.tell()
+            self._wrote(self._offset - start)
+            self._committed()
+            if self._offset >= self.compact_bytes:
+                self.compact(contacts)
+
+    def _open_journal(self) -> IO:
+        if not os.path.exists(self.journal_path):
+            self._start_journal({'created': True})
+            self._journal_ino = os.stat(self.journal_path).st_ino
+            self._offset = os.path.getsize(self.journal_path)
+        journal_ino = os.stat(self.journal_path).st_ino
+        if self._journal is not None and os.fstat(self._journal.fileno()).st_ino != journal_ino:
+            self._close_journal()  # another process rotated the journal
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'ab')
+        return self._journal
+
+    @staticmethod
+    def _encode(change: Change) -> bytes:
+        key, value = change
+        return (json.dumps({'key': key, 'value': value}, separators=(',', ':'),
+                            default=encode_default) + '\n').encode('utf-8')
+
+    def compact(self, contacts: Dict[str, Dict], background: bool = True) -> None:
+        """Rotate the journal and write its contents into a new snapshot."""
+        if not background:
+            # A compaction started earlier may predate the latest changes
+            self.wait_for_compaction()
+        with self.lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            if os.path.exists(self.rotated_path):
+                return  # another process is compacting
+            self._close_journal()
+            os.replace(self.journal_path, self.rotated_path)
+            rotated_ino = self._journal_ino
+            self._start_journal({'rotated': {'ino': rotated_ino, 'size': self._offset}})
+            self._journal_ino = os.stat(self.journal_path).st_ino
+            self._offset = os.path.getsize(self.journal_path)
+            # dict() copies in a single step, so the snapshot matches the rotated journal.
+            snapshot = dict(contacts)
+            self._compactor = threading.Thread(target=self._write_snapshot,
+                                               args=(snapshot, rotated_ino),
+                                               name='journal-compactor', daemon=True)
+            self._compactor.start()
+        if not background:
+            self.wait_for_compaction()
+
+    def _write_snapshot(self, snapshot: Dict[str, Dict], rotated_ino: int) -> None:
+        tmp_path = write_temp_file(self.filename, lambda file: json.dump(snapshot, file, indent=2, default=encode_default))
+        with self.lock:
+            if self._rotated_ino() != rotated_ino:
+                # Someone else already folded this journal into the snapshot
+                os.remove(tmp_path)
+                return
+            self._wrote(os.path.getsize(tmp_path))
+            os.replace(tmp_path, self.filename)
+            self._remove_rotated()
+            self._seen = self._signature()
+
+    def wait_for_compaction(self) -> None:
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+
+    def _close_journal(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def close(self) -> None:
+        self.wait_for_compaction()
+        with self.lock:
+            self._close_journal()
+        super().close()
+
+
+class SqliteStorage(Storage):
+    """Keep contacts as rows of an SQLite database.
+
+    The database runs in WAL mode so readers never wait for the writer, and
+    every change is a single-row upsert or delete inside one transaction per
+    ``apply()``. The statements are constant strings with parameters, so the
+    sqlite3 module compiles each of them once and reuses it.
+
+    Each write transaction bumps a version counter and stamps the rows it
+    touches (deleted keys are kept as tombstones), so ``refresh()`` fetches
+    only the rows other processes changed.
+    """
+
+    FIELDS = ('name', 'phone', 'email', 'address', 'created_at', 'updated_at')
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS contacts (
+            name_key TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            email TEXT NOT NULL DEFAULT '',
+            address TEXT NOT NULL DEFAULT '',
+            created_at TEXT,
+            updated_at TEXT
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS deleted_contacts (
+            name_key TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+    """
+    SELECT_ALL = "SELECT name_key, name, phone, email, address, created_at, updated_at FROM contacts"
+    SELECT_CHANGED = SELECT_ALL + " WHERE version > ?"
+    SELECT_DELETED = "SELECT name_key FROM deleted_contacts WHERE version > ?"
+    SELECT_VERSION = "SELECT value FROM meta WHERE key = 'version'"
+    BUMP_VERSION = "UPDATE meta SET value = value + 1 WHERE key = 'version'"
+    UPSERT = """
+        INSERT INTO contacts (name_key, name, phone, email, address, created_at, updated_at, version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (name_key) DO UPDATE SET
+            name = excluded.name, phone = excluded.phone, email = excluded.email,
+            address = excluded.address, created_at = excluded.created_at,
+            updated_at = excluded.updated_at, version = excluded.version
+    """
+    UNDELETE = "DELETE FROM deleted_contacts WHERE name_key = ?"
+    DELETE = "DELETE FROM contacts WHERE name_key = ?"
+    TOMBSTONE = "INSERT OR REPLACE INTO deleted_contacts (name_key, version) VALUES (?, ?)"
+
+    def __init__(self, filename: str):
+        super().__init__(filename)
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(contacts)")]
+        if 'version' not in columns:
+            self._db.executescript("""
+                ALTER TABLE contacts ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+                CREATE INDEX IF NOT EXISTS contacts_version ON contacts (version);
+            """)
+        self._version = 0
+        self._data_version = None
+
+    def _row_to_contact(self, row: Tuple) -> Dict:
+        contact = {'name': row[1], 'phone': row[2], 'email': row[3], 'address': row[4]}
+        if row[5] is not None:
+            contact['created_at'] = row[5]
+        if row[6] is not None:
+            contact['updated_at'] = row[6]
+        return contact
+
+    def _contact_to_row(self, key: str, contact: Dict, version: int) -> Tuple:
+        return ((key,) + tuple(contact.get(field, '' if field in ('email', 'address') else None)
+                               for field in self.FIELDS) + (version,))
+
+    def _read(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        try:
+            return self._db.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            raise IOError(f"SQLite read failed: {e}") from e
+
+    def load(self) -> Dict[str, Dict]:
+        with self._db_lock:
+            self._data_version = self._read("PRAGMA data_version")[0][0]
+            self._version = self._read(self.SELECT_VERSION)[0][0]
+            return {row[0]: self._row_to_contact(row) for row in self._read(self.SELECT_ALL)}
+
+    def changed(self) -> bool:
+        # data_version only moves when another connection commits
+        with self._db_lock:
+            return self._read("PRAGMA data_version")[0][0] != self._data_version
+
+    def refresh(self, contacts: Dict[str, Dict]) -> List[Change]:
+        with self._db_lock:
+            self._data_version = self._read("PRAGMA data_version")[0][0]
+            changes: List[Change] = [(row[0], None)
+                                     for row in self._read(self.SELECT_DELETED, (self._version,))]
+            changes.extend((row[0], self._row_to_contact(row))
+                           for row in self._read(self.SELECT_CHANGED, (self._version,)))
+            self._version = self._read(self.SELECT_VERSION)[0][0]
+        return changes
+
+    def _write(self, statements: Callable[[int], Iterable[Tuple[str, Tuple]]]) -> None:
+        with self._db_lock:
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    self._db.execute(self.BUMP_VERSION)
+                    version = self._db.execute(self.SELECT_VERSION).fetchone()[0]
+                    for sql, params in statements(version):
+                        self._db.execute(sql, params)
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+                self._db.execute("COMMIT")
+            except sqlite3.Error as e:
+                # ContactManager handles storage failures as IOError
+                raise IOError(f"SQLite write failed: {e}") from e
+            self._version = version
+        self._committed()
+
+    def save(self, contacts: Dict[str, Dict]) -> None:
+        def statements(version):
+            yield "INSERT OR REPLACE INTO deleted_contacts SELECT name_key, ? FROM contacts", (version,)
+            yield "DELETE FROM contacts", ()
+            for key, contact in contacts.items():
+                yield self.UNDELETE, (key,)
+                yield self.UPSERT, self._contact_to_row(key, contact, version)
+        self._write(statements)
+
+    def apply(self, changes: Iterable[Change], contacts: Dict[str, Dict]) -> None:
+        def statements(version):
+            for key, value in changes:
+                if value is None:
+                    yield self.DELETE, (key,)
+                    yield self.TOMBSTONE, (key, version)
+                else:
+                    yield self.UNDELETE, (key,)
+                    yield self.UPSERT, self._contact_to_row(key, value, version)
+        self._write(statements)
+
+    def close(self) -> None:
+        with self._db_lock:
+            self._db.close()
+        super().close()
+
+
+class ShardedStorage(Storage):
+    """Spread contacts over several JSON files by a hash of their name key.
+
+    ``filename`` is a directory holding ``manifest.json`` and one file per
+    shard. A write rewrites only the shards it touches.
+
+    A write that touches more than one shard (a rename, a batch) is first
+    recorded in ``intent.json``. If the process dies halfway, the next
+    ``load()`` or ``refresh()`` (both run under the lock) finishes it.
+    ``save()`` and ``reshard()`` write a new generation of shard files and
+    then switch the manifest to it in one rename, so they never leave a mix
+    of old and new shards behind.
+    """
+
+    MANIFEST = 'manifest.json'
+    INTENT = 'intent.json'
+
+    def __init__(self, filename: str, shards: int = 16):
+        super().__init__(filename)
+        self.shards = shards
+        self.generation = 0
+        self._shard_keys: List[Set[str]] = [set() for _ in range(shards)]
+        self._seen: Dict[str, Optional[Tuple]] = {}
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.filename, self.MANIFEST)
+
+    @property
+    def intent_path(self) -> str:
+        return os.path.join(self.filename, self.INTENT)
+
+    def shard_path(self, shard: int, generation: Optional[int] = None) -> str:
+        generation = self.generation if generation is None else generation
+        return os.path.join(self.filename, f'shard-{generation}-{shard:03d}.json')
+
+    def shard_of(self, key: str) -> int:
+        # crc32 rather than hash(), which changes between runs for strings
+        return zlib.crc32(key.encode('utf-8')) % self.shards
+
+    @staticmethod
+    def _signature(path: str) -> Optional[Tuple]:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _signatures(self) -> Dict[str, Optional[Tuple]]:
+        paths = [self.manifest_path, self.intent_path]
+        paths.extend(self.shard_path(shard) for shard in range(self.shards))
+        return {path: self._signature(path) for path in paths}
+
+    def _read_json(self, path: str) -> Optional[Dict]:
+        try:
+            with open(path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _read_shard(self, shard: int) -> Dict[str, Dict]:
+        return self._read_json(self.shard_path(shard)) or {}
+
+    def _write_json(self, path: str, data: Dict) -> None:
+        # Compact: shards are rewritten often and are not meant to be edited by hand
+        self._wrote(atomic_write(path, lambda file: json.dump(data, file, separators=(',', ':'),
+                                                              default=encode_default)))
+
+    def _write_shard(self, shard: int, contacts: Dict[str, Dict]) -> None:
+        self._write_json(self.shard_path(shard),
+                         {key: contacts[key] for key in self._shard_keys[shard]})
+
+    def load(self) -> Dict[str, Dict]:
+        os.makedirs(self.filename, exist_ok=True)
+        manifest = self._read_json(self.manifest_path)
+        if manifest is None:
+            self._write_json(self.manifest_path, {'shards': self.shards, 'generation': 0})
+            manifest = {'shards': self.shards, 'generation': 0}
+        self.shards = manifest['shards']
+        self.generation = manifest['generation']
+        shards = [self._read_shard(shard) for shard in range(self.shards)]
+        self._finish_intent(shards)
+        self._shard_keys = [set(shard) for shard in shards]
+        self._seen = self._signatures()
+        contacts: Dict[str, Dict] = {}
+        for shard in shards:
+            contacts.update(shard)
+        return contacts
+
+    def _finish_intent(self, shards: List[Dict[str, Dict]]) -> None:
+        """Redo a multi-shard write that a crashed process left unfinished."""
+        intent = self._read_json(self.intent_path)
+        if intent is None:
+            return
+        if intent['generation'] == self.generation:
+            touched = set()
+            for key, value in intent['changes']:
+                shard = self.shard_of(key)
+                touched.add(shard)
+                if value is None:
+                    shards[shard].pop(key, None)
+                else:
+                    shards[shard][key] = value
+            for shard in touched:
+                self._write_json(self.shard_path(shard), shards[shard])
+        os.remove(self.intent_path)
+
+    def save(self, contacts: Dict[str, Dict], shards: Optional[int] = None) -> None:
+        """Write every contact into a new generation of ``shards`` files."""
+        os.makedirs(self.filename, exist_ok=True)
+        old_shards, old_generation = self.shards, self.generation
+        generation = old_generation + 1
+        self.shards = shards or self.shards
+        split: List[Dict[str, Dict]] = [{} for _ in range(self.shards)]
+        for key, contact in contacts.items():
+            split[self.shard_of(key)][key] = contact
+        try:
+            for shard in range(self.shards):
+                self._write_json(self.shard_path(shard, generation), split[shard])
+            self._write_json(self.manifest_path, {'shards': self.shards, 'generation': generation})
+        except BaseException:
+            self.shards = old_shards
+            raise
+        self.generation = generation
+        if os.path.exists(self.intent_path):
+            os.remove(self.intent_path)  # it belonged to the old generation
+        for shard in range(old_shards):
+            try:
+                os.remove(self.shard_path(shard, old_generation))
+            except FileNotFoundError:
+                pass
+        self._shard_keys = [set(shard) for shard in split]
+        self._seen = self._signatures()
+        self._committed()
+
+    def reshard(self, shards: int) -> int:
+        """Move every contact into ``shards`` files; returns the number of contacts."""
+        with self.lock:
+            contacts = self.load()
+            self.save(contacts, shards)
+        return len(contacts)
+
+    def apply(self, changes: Iterable[Change], contacts: Dict[str, Dict]) -> None:
+        changes = list(changes)
+        touched = set()
+        for key, value in changes:
+            shard = self.shard_of(key)
+            touched.add(shard)
+            if value is None:
+                self._shard_keys[shard].discard(key)
+            else:
+                self._shard_keys[shard].add(key)
+        if len(touched) > 1:
+            self._write_json(self.intent_path, {'generation': self.generation, 'changes': changes})
+        for shard in touched:
+            self._write_shard(shard, contacts)
+        if len(touched) > 1:
+            os.remove(self.intent_path)
+        self._seen = self._signatures()
+        self._committed()
+
+    def changed(self) -> bool:
+        return self._signatures() != self._seen
+
+    def refresh(self, contacts: Dict[str, Dict]) -> List[Change]:
+        signatures = self._signatures()
+        if signatures == self._seen:
+            return []
+        manifest = self._read_json(self.manifest_path) or {}
+        if (manifest.get('shards') != self.shards or manifest.get('generation') != self.generation
+                or signatures[self.intent_path] is not None):
+            # Resharded, saved in full, or a writer died halfway: read everything
+            return diff_contacts(contacts, self.load())
+        changes: List[Change] = []
+        for shard in range(self.shards):
+            path = self.shard_path(shard)
+            if signatures[path] == self._seen.get(path):
+                continue
+            stored = self._read_shard(shard)
+            changes.extend((key, None) for key in self._shard_keys[shard] if key not in stored)
+            changes.extend((key, contact) for key, contact in stored.items()
+                           if contacts.get(key) != contact)
+            self._shard_keys[shard] = set(stored)
+        self._seen = signatures
+        return changes
+
+
+STORAGE_BACKENDS = {
+    'json': JsonStorage,
+    'binary': BinaryStorage,
+    'journal': JournalStorage,
+    'sqlite': SqliteStorage,
+    'sharded': ShardedStorage,
+}
+
+DEFAULT_FILENAMES = {
+    'binary': 'contacts.snap',
+    'sqlite': 'contacts.db',
+    'sharded': 'contacts.shards',
+}
+
+
+def read_json_book(filename: str) -> Dict[str, Dict]:
+    """Contacts of a JSON book and its journal, if any, without changing either file."""
+    storage = JournalStorage(filename)
+    try:
+        return storage.read_committed()
+    finally:
+        storage.close()
+
+
+def default_filename(kind: str) -> str:
+    """File a backend uses when CONTACTS_FILE is not set."""
+    return DEFAULT_FILENAMES.get(kind, 'contacts.json')
+
+
+def open_storage(kind: str, filename: str, **options) -> Storage:
+    """Create the storage backend registered under ``kind``."""
+    try:
+        backend = STORAGE_BACKENDS[kind]
+    except KeyError:
+        raise ValueError(f"Unknown storage backend: {kind}")
+    return backend(filename, **options)
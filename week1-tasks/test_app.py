@@ -0,0 +1,719 @@
+"""
+Tests for the Flask web interface of the Contact Management System
+"""
+
+import json
+import sys
+import threading
+import time
+
+import pytest
+
+import app as web
+
+
+@pytest.fixture
+def cm(tmp_path, monkeypatch):
+    """A fresh ContactManager installed as the app's global manager"""
+    manager = web.ContactManager(str(tmp_path / "contacts.json"))
+    monkeypatch.setattr(web, "cm", manager)
+    return manager
+
+
+@pytest.fixture
+def client(cm):
+    return web.app.test_client()
+
+
+def add_people(cm, count):
+    for i in range(count):
+        success, message = cm.add_contact(f"Person {i:03d}", "1234567890", f"p{i}@example.com")
+        assert success, message
+
+
+def test_search_uses_index_and_matches_scan(cm):
+    """Indexed search returns the same contacts as a full scan"""
+    add_people(cm, 30)
+    cm.update_contact("Person 007", "Renamed Seven", "5555551234", "seven@example.org")
+    for term in ["person", "007", "seven", "example.org", "55555", "p1", "nobody"]:
+        expected = sorted(
+            (c for c in cm.contacts.values()
+             if term in c['name'].lower() or term in c['phone'] or term in c['email'].lower()),
+            key=lambda c: c['name'].lower())
+        assert cm.search_contacts(term) == expected, f"Mismatch for {term!r}"
+
+
+def test_api_pagination_is_stable(client, cm):
+    """Cursors keep their position while contacts are added and deleted"""
+    add_people(cm, 10)
+    first = client.get("/api/contacts?limit=4").get_json()
+    assert [c['name'] for c in first['contacts']] == [f"Person {i:03d}" for i in range(4)]
+
+    cm.delete_contact("Person 001")
+    cm.add_contact("Person 000a", "1234567890")
+    second = client.get(f"/api/contacts?limit=4&cursor={first['next_cursor']}").get_json()
+    assert [c['name'] for c in second['contacts']] == [f"Person {i:03d}" for i in range(4, 8)]
+
+    last = client.get(f"/api/contacts?limit=4&cursor={second['next_cursor']}").get_json()
+    assert [c['name'] for c in last['contacts']] == ["Person 008", "Person 009"]
+    assert last['next_cursor'] is None
+
+
+def test_api_pagination_rejects_bad_input(client, cm):
+    assert client.get("/api/contacts?limit=0").status_code == 400
+    assert client.get("/api/contacts?cursor=%%%").status_code == 400
+    assert isinstance(client.get("/api/contacts").get_json(), list), "Unpaged API keeps its shape"
+
+
+def test_index_page_links_to_next_page(client, cm):
+    add_people(cm, web.PAGE_SIZE + 1)
+    page = client.get("/?search=person").get_data(as_text=True)
+    assert "Person 000" in page and f"Person {web.PAGE_SIZE:03d}" not in page
+    assert "cursor=" in page, "Missing link to the next page"
+
+
+def test_export_import_round_trip(client, cm, tmp_path, monkeypatch):
+    """Exported NDJSON can be imported into an empty book with one write"""
+    add_people(cm, 5)
+    monkeypatch.setattr(web, "EXPORT_CHUNK_LINES", 2)
+    exported = client.get("/api/contacts/export")
+    assert exported.mimetype == "application/x-ndjson"
+    body = exported.get_data()
+    assert [json.loads(line)['name'] for line in body.splitlines()] == [f"Person {i:03d}" for i in range(5)]
+    assert cm._snapshot is None, "Export should stream from the index, not copy the book"
+
+    target = web.ContactManager(str(tmp_path / "imported.json"))
+    monkeypatch.setattr(web, "cm", target)
+    writes = []
+    monkeypatch.setattr(target.storage, "apply", lambda changes, contacts: writes.append(list(changes)))
+    bad_lines = b'{"name": "Bad Phone", "phone": "12"}\nnot json\n\n{"name": "Person 000", "phone": "1234567890"}\n'
+    result = client.post("/api/contacts/import", data=body + bad_lines).get_json()
+
+    assert result['imported'] == 5 and result['rejected'] == 3
+    assert [e['line'] for e in result['errors']] == [6, 7, 9]
+    assert result['errors'][0]['error'] == "Invalid phone number"
+    assert len(writes) == 1 and len(writes[0]) == 5, "Import should persist once"
+    assert target.search_contacts("") == cm.search_contacts("")
+
+
+def scan_stats(contacts):
+    """Statistics computed the slow way, by scanning every contact"""
+    domains = {}
+    for c in contacts.values():
+        if c['email']:
+            domain = c['email'].rsplit('@', 1)[1].lower()
+            domains[domain] = domains.get(domain, 0) + 1
+    return {
+        'total': len(contacts),
+        'with_email': sum(1 for c in contacts.values() if c['email']),
+        'with_address': sum(1 for c in contacts.values() if c['address']),
+    }, domains
+
+
+def test_stats_match_full_scan(client, cm):
+    """Incremental counters agree with a full scan after every kind of change"""
+    add_people(cm, 12)
+    cm.add_contact("No Email", "1234567890", "", "1 Main St")
+    cm.update_contact("Person 003", "Person 003", "1234567890", "", "2 Oak Ave")
+    cm.update_contact("Person 004", "Moved Four", "1234567890", "four@Example.org")
+    cm.delete_contact("Person 005")
+    cm.import_contacts(['{"name": "Imported", "phone": "1234567890", "email": "i@mail.com"}'])
+
+    counters, domains = scan_stats(cm.contacts)
+    assert client.get("/api/stats").get_json() == counters
+    assert client.get("/api/stats/domains").get_json() == domains
+    assert web.ContactManager(cm.filename).get_stats() == counters, "Counters rebuilt at load differ"
+
+
+def test_concurrent_readers_and_writers(client, cm, monkeypatch):
+    """Readers see consistent versions while writers add, rename and delete"""
+    add_people(cm, 50)
+    # Switch threads often so readers really run in the middle of writes
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    errors = []
+    stop = threading.Event()
+
+    def writer(n):
+        try:
+            for i in range(40):
+                name = f"Writer {n} {i:02d}"
+                cm.add_contact(name, "1234567890", f"w{n}.{i}@example.com")
+                cm.update_contact(name, f"{name} renamed", "1234567890", f"w{n}.{i}@example.org")
+                cm.delete_contact(f"{name} renamed")
+        except Exception as e:
+            errors.append(e)
+
+    def reader():
+        own_client = web.app.test_client()
+        try:
+            while not stop.is_set():
+                contacts = own_client.get("/api/contacts").get_json()
+                keys = [c['name'].lower() for c in contacts]
+                assert keys == sorted(set(keys)), "Listing is not sorted and unique"
+                stats = own_client.get("/api/stats").get_json()
+                assert stats['with_email'] == stats['total'], f"Torn statistics: {stats}"
+                lines = own_client.get("/api/contacts/export").get_data().splitlines()
+                assert len(lines) >= 50, "Export lost contacts"
+        except Exception as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=reader) for _ in range(4)]
+    writers = [threading.Thread(target=writer, args=(n,)) for n in range(3)]
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.set()
+    for thread in readers:
+        thread.join()
+    sys.setswitchinterval(interval)
+
+    assert not errors, errors[0]
+    assert cm.get_stats()['total'] == 50
+
+
+def test_reads_do_not_wait_for_a_slow_save(client, cm, monkeypatch):
+    """A write is visible to readers while it is still being saved"""
+    add_people(cm, 3)
+    saving, release = threading.Event(), threading.Event()
+    apply = cm.storage.apply
+
+    def slow_apply(changes, contacts):
+        saving.set()
+        release.wait(5)
+        apply(changes, contacts)
+
+    monkeypatch.setattr(cm.storage, "apply", slow_apply)
+    writer = threading.Thread(target=cm.add_contact, args=("Slow Save", "1234567890"))
+    writer.start()
+    try:
+        assert saving.wait(5)
+        start = time.perf_counter()
+        assert client.get("/api/stats").get_json()['total'] == 4
+        assert [c['name'] for c in client.get("/api/contacts?search=slow").get_json()] == ["Slow Save"]
+        assert time.perf_counter() - start < 1, "Readers waited for the save"
+    finally:
+        release.set()
+        writer.join()
+    assert cm.read(lambda: len(cm.contacts)) == 4
+
+
+def test_records_keep_dict_shape(client, cm):
+    """Contacts are stored as records but reach disk and the API as plain dicts"""
+    cm.add_contact("Ada", "1234567890", "ada@example.com")
+    cm.import_contacts(['{"name": "Old", "phone": "1234567890", "created_at": "2020-01-02", '
+                        '"updated_at": "2021-03-04T05:06:07.000008"}'])
+    assert isinstance(cm.contacts["ada"], web.ContactRecord)
+    old = client.get("/api/contacts?search=old").get_json()[0]
+    assert old == {'name': 'Old', 'phone': '1234567890', 'email': '', 'address': '',
+                   'created_at': '2020-01-02', 'updated_at': '2021-03-04T05:06:07.000008'}
+    assert web.ContactManager(cm.filename).contacts == cm.contacts, "Records differ after reload"
+
+
+def test_conditional_get(client, cm, monkeypatch):
+    """Unchanged polls get 304 without running the query; any change invalidates the ETag"""
+    add_people(cm, 3)
+    first = client.get("/api/contacts?search=person")
+    etag = first.headers['ETag']
+    assert first.status_code == 200 and first.headers['Last-Modified']
+
+    def fail(*args):
+        raise AssertionError("Data was read for an unchanged poll")
+    monkeypatch.setattr(cm, "search_contacts", fail)
+    monkeypatch.setattr(cm, "get_stats", fail)
+    cached = client.get("/api/contacts?search=person", headers={'If-None-Match': etag})
+    assert cached.status_code == 304 and cached.get_data() == b""
+    assert client.get("/api/stats", headers={'If-None-Match': etag}).status_code == 304
+    monkeypatch.undo()
+    monkeypatch.setattr(web, "cm", cm)
+
+    assert not cm.add_contact("Person 000", "1234567890")[0]
+    assert client.get("/api/stats", headers={'If-None-Match': etag}).status_code == 304, \
+        "A rejected write should not change the version"
+    cm.delete_contact("Person 001")
+    changed = client.get("/api/contacts?search=person", headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+    assert len(changed.get_json()) == 2
+
+    # The same second as the Last-Modified the client has is not "unchanged"
+    since = {'If-Modified-Since': changed.headers['Last-Modified']}
+    cm.modified_at = cm.modified_at.replace(microsecond=0)
+    assert client.get("/api/stats", headers=since).status_code == 304
+    cm.modified_at = cm.modified_at.replace(microsecond=500000)
+    assert client.get("/api/stats", headers=since).status_code == 200
+
+
+def test_cache_invalidates_only_affected_terms(client, cm):
+    """A write drops cached results for the terms it matches and keeps the rest"""
+    add_people(cm, 10)
+    assert len(cm.search_contacts("person 001")) == 1
+    assert len(cm.search_contacts("person 002")) == 1
+    assert "Person 002" in client.get("/?search=Person 002").get_data(as_text=True)
+
+    cm.update_contact("Person 001", "Person 001", "5555555555", "new@example.com")
+    before = client.get("/api/cache/stats").get_json()
+    assert cm.search_contacts("person 001")[0]['phone'] == "5555555555", "Stale cached result"
+    assert len(cm.search_contacts("person 002")) == 1
+    assert "Person 002" in client.get("/?search=Person 002").get_data(as_text=True)
+    after = client.get("/api/cache/stats").get_json()
+    assert after['results']['misses'] - before['results']['misses'] == 1
+    assert after['results']['hits'] - before['results']['hits'] == 1
+    assert after['html']['hits'] - before['html']['hits'] == 1
+
+    cm.delete_contact("Person 002")
+    assert cm.search_contacts("person 002") == []
+    assert "No contacts found" in client.get("/?search=Person 002").get_data(as_text=True)
+
+
+def test_cache_evicts_least_recently_used(cm):
+    cache = web.LRUCache(max_entries=2, max_size=5)
+    cache.put("a", [1])
+    cache.put("b", [2])
+    cache.get("a")
+    cache.put("c", [3])
+    assert cache.get("b") is None and cache.get("a") == [1], "Least recently used entry should go"
+    cache.put("d", [4, 5, 6, 7])
+    assert cache.get("c") is None and cache.get("a") == [1], "Size limit should evict too"
+    cache.put("e", list(range(6)))
+    assert cache.get("e") is None, "Entries over the size limit are not cached"
+    assert cache.stats()['evictions'] == 2
+
+
+def test_change_feed(client, cm):
+    """Clients can fetch only what changed since the last sequence number they saw"""
+    add_people(cm, 2)
+    start = client.get("/api/changes").get_json()
+    assert [c['op'] for c in start['changes']] == ['insert', 'insert'] and start['latest'] == 2
+
+    cm.update_contact("Person 000", "Person Zero", "1234567890")
+    cm.delete_contact("Person 001")
+    cm.add_contact("Person 001", "1234567890")
+    assert not cm.add_contact("Person 001", "1234567890")[0]
+    feed = client.get(f"/api/changes?since={start['latest']}&instance={start['instance']}").get_json()
+    assert [(c['op'], c['key']) for c in feed['changes']] == [
+        ('update', 'person zero'), ('delete', 'person 001'), ('insert', 'person 001')]
+    assert feed['changes'][0]['old_key'] == 'person 000'
+    assert feed['changes'][0]['contact']['name'] == 'Person Zero'
+    assert feed['latest'] == 5 and not feed['has_more']
+
+    assert client.get("/api/changes?since=5&limit=1").get_json()['changes'] == []
+    assert client.get("/api/changes?since=99").status_code == 410
+    assert client.get("/api/changes?since=0&instance=other").status_code == 410
+
+
+def test_change_feed_expires_old_changes(client, cm, monkeypatch):
+    monkeypatch.setattr(cm, "changes", web.ChangeLog(max_entries=3))
+    add_people(cm, 5)
+    assert client.get("/api/changes?since=1").status_code == 410
+    assert [c['seq'] for c in client.get("/api/changes?since=2").get_json()['changes']] == [3, 4, 5]
+
+
+def test_workers_share_etags_and_change_feed(client, cm, monkeypatch):
+    """Another process on the same book sends the same ETag and resumes the feed"""
+    add_people(cm, 2)
+    etag = client.get("/api/stats").headers['ETag']
+    old = client.get("/api/changes").get_json()
+    cm.update_contact("Person 000", "Person Zero", "1234567890")
+    cm.delete_contact("Person 001")
+    start = client.get("/api/changes").get_json()
+
+    worker = web.ContactManager(cm.filename)
+    monkeypatch.setattr(web, "cm", worker)
+    assert client.get("/api/stats", headers={'If-None-Match': etag}).status_code == 200
+    assert client.get("/api/stats").headers['ETag'] == f'"{cm.etag()}"'
+    assert client.get(f"/api/changes?since={start['latest']}&instance={start['instance']}"
+                      ).status_code == 410, "Numbers of another process do not resume"
+    assert client.get(f"/api/changes?version={old['version']}").status_code == 410, \
+        "Changes from before the process loaded the book are not in its log"
+
+    cm.add_contact("Person 002", "1234567890")
+    feed = client.get(f"/api/changes?since={start['latest']}&instance={start['instance']}"
+                      f"&version={start['version']}").get_json()
+    assert feed['instance'] == worker.instance_id
+    assert [(c['op'], c['key']) for c in feed['changes']] == [('insert', 'person 002')]
+    assert client.get("/api/stats").headers['ETag'] == f'"{cm.etag()}"'
+
+    # And back: the first process picks up where this one left off
+    worker.update_contact("Person 002", "Person Two", "1234567890")
+    monkeypatch.setattr(web, "cm", cm)
+    back = client.get(f"/api/changes?since={feed['latest']}&instance={feed['instance']}"
+                      f"&version={feed['version']}").get_json()
+    assert sorted((c['op'], c['key']) for c in back['changes']) == [
+        ('delete', 'person 002'), ('insert', 'person two')]
+    assert client.get(f"/api/changes?version={back['version']}").get_json()['changes'] == []
+
+
+def test_change_stream(client, cm):
+    """The SSE endpoint sends the backlog, then pushes new changes as they happen"""
+    add_people(cm, 1)
+    response = client.get("/api/changes/stream?since=0", buffered=False)
+    assert response.mimetype == "text/event-stream"
+    events = response.iter_encoded()
+    assert next(events).startswith(b"retry:")
+    assert b'"key": "person 000"' in next(events)
+
+    threading.Timer(0.1, lambda: cm.delete_contact("Person 000")).start()
+    pushed = next(events)
+    book_id = cm.book_version[0]
+    assert pushed.startswith(f"id: {cm.instance_id}-2-{book_id}-1\n".encode())
+    assert b'"delete"' in pushed
+    response.close()
+
+    resumed = client.get("/api/changes/stream",
+                         headers={'Last-Event-ID': f"{cm.instance_id}-1-{book_id}-0"}, buffered=False)
+    resumed_events = resumed.iter_encoded()
+    next(resumed_events)
+    assert f"id: {cm.instance_id}-2-".encode() in next(resumed_events)
+    resumed.close()
+
+
+def test_batch_endpoint_commits_once(client, cm, monkeypatch):
+    """A mixed batch is validated per operation and saved with a single write"""
+    add_people(cm, 3)
+    writes = []
+    apply = cm.storage.apply
+    monkeypatch.setattr(cm.storage, "apply",
+                        lambda changes, contacts: writes.append(list(changes)) or apply(changes, contacts))
+    operations = [
+        {"op": "create", "name": "New One", "phone": "1234567890", "email": "new@example.com"},
+        {"op": "update", "name": "Person 000", "new_name": "Renamed", "address": "1 Main St"},
+        {"op": "update", "name": "New One", "phone": "0987654321"},
+        {"op": "delete", "name": "Person 001"},
+    ]
+    result = client.post("/api/contacts/batch", json=operations).get_json()
+    assert result['committed'] and result['applied'] == 4, result
+    assert len(writes) == 1
+    assert sorted(key for key, _ in writes[0]) == ["new one", "person 000", "person 001", "renamed"]
+    renamed = cm.get_contact("Renamed")
+    assert renamed['phone'] == "1234567890" and renamed['address'] == "1 Main St"
+    assert cm.get_contact("New One")['phone'] == "0987654321"
+    assert web.ContactManager(cm.filename).contacts == cm.contacts
+    feed = client.get("/api/changes?since=3").get_json()['changes']
+    assert [c['op'] for c in feed] == ['insert', 'update', 'update', 'delete']
+
+    nulls = client.post("/api/contacts/batch", json=[
+        {"op": "update", "name": "Renamed", "phone": None, "email": None, "address": None}])
+    assert nulls.status_code == 200 and nulls.get_json()['applied'] == 1
+    kept = cm.get_contact("Renamed")
+    assert [kept[f] for f in ('phone', 'email', 'address')] == \
+        [renamed[f] for f in ('phone', 'email', 'address')], "null should keep the current value"
+
+
+def test_batch_endpoint_is_all_or_nothing(client, cm):
+    add_people(cm, 2)
+    before = dict(cm.contacts)
+    operations = [
+        {"op": "delete", "name": "Person 000"},
+        {"op": "create", "name": "Bad", "phone": "12"},
+        {"op": "rename", "name": "Person 001"},
+    ]
+    response = client.post("/api/contacts/batch", json=operations)
+    result = response.get_json()
+    assert response.status_code == 422 and not result['committed']
+    assert [r['success'] for r in result['results']] == [True, False, False]
+    assert result['results'][1]['message'] == "Invalid phone number"
+    assert cm.contacts == before and cm.get_stats()['total'] == 2, "Rejected batch changed contacts"
+    assert cm.search_contacts("person 000"), "Index not restored after rollback"
+
+    partial = client.post("/api/contacts/batch",
+                          json={"operations": operations, "atomic": False}).get_json()
+    assert partial['committed'] and partial['applied'] == 1 and partial['failed'] == 2
+    assert cm.get_contact("Person 000") is None
+    assert client.post("/api/contacts/batch", json={"operations": "nope"}).status_code == 400
+
+
+def test_batch_context_manager_rolls_back_on_error(cm):
+    add_people(cm, 1)
+    with pytest.raises(RuntimeError):
+        with cm.batch():
+            cm.add_contact("Temp", "1234567890")
+            cm.delete_contact("Person 000")
+            raise RuntimeError("abort")
+    assert cm.get_contact("Temp") is None and cm.get_contact("Person 000") is not None
+    assert web.ContactManager(cm.filename).contacts == cm.contacts
+
+
+def test_write_behind_groups_writes(tmp_path, monkeypatch):
+    """Writes are acknowledged from memory and saved together shortly after"""
+    cm = web.ContactManager(str(tmp_path / "contacts.json"), write_behind_delay=0.2)
+    writes = []
+    apply = cm.storage.apply
+    monkeypatch.setattr(cm.storage, "apply",
+                        lambda changes, contacts: writes.append(list(changes)) or apply(changes, contacts))
+    add_people(cm, 20)
+    cm.delete_contact("Person 003")
+    assert writes == [], "Nothing should be saved before the delay"
+    assert cm.changes.latest == 0, "The change feed only has saved changes"
+    assert cm.search_contacts("person 00")[0]['name'] == "Person 000", "Writes must be visible at once"
+
+    deadline = time.monotonic() + 5
+    while not writes and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(writes) == 1 and len(writes[0]) == 20, "Queued changes should be saved in one write"
+    assert web.ContactManager(cm.filename).contacts == cm.contacts
+    cm.close()
+    assert cm.changes.latest == 21
+
+
+def test_write_behind_flushes_when_full_and_on_close(tmp_path):
+    cm = web.ContactManager(str(tmp_path / "contacts.json"), write_behind_delay=60, max_pending=5)
+    add_people(cm, 12)
+    assert cm.flushes == 2, "A full queue should be saved right away"
+    assert len(web.ContactManager(cm.filename).contacts) == 10
+    other = web.ContactManager(cm.filename)
+    other.add_contact("From Elsewhere", "1234567890")
+    cm.close()
+    reloaded = web.ContactManager(cm.filename)
+    assert len(reloaded.contacts) == 13, "Closing should save the rest without losing other writes"
+    assert cm.get_contact("From Elsewhere") is not None
+
+
+def test_lookup_by_normalized_phone_and_email(client, cm):
+    """Reverse lookups match any formatting of a phone number and any case of an email"""
+    cm.add_contact("Ann", "(555) 555-1234", "Ann@Example.com")
+    cm.add_contact("Bob", "555 555 1234", "bob@example.com")
+    cm.add_contact("Cy", "5555559999")
+
+    owners = client.get("/api/contacts/by-phone/555-555-1234").get_json()
+    assert [c['name'] for c in owners] == ["Ann", "Bob"]
+    assert client.get("/api/contacts/by-email/ANN@example.COM").get_json()[0]['name'] == "Ann"
+    assert client.get("/api/contacts/by-phone/5555550000").status_code == 404
+
+    cm.update_contact("Ann", "Ann", "5555550000", "ann@new.org")
+    assert [c['name'] for c in cm.find_by_phone("5555551234")] == ["Bob"]
+    assert cm.find_by_email("ann@example.com") == []
+    assert cm.find_by_phone("(555) 555-0000")[0]['email'] == "ann@new.org"
+
+
+def test_suggest_prefixes(client, cm):
+    cm.add_contact("Ann Lee", "(555) 555-1234", "Ann@Example.com")
+    cm.add_contact("Annie Moss", "5555559999", "annie@moss.org")
+    cm.add_contact("Bob", "4445550000", "bob@example.com")
+
+    data = client.get("/api/contacts/suggest?prefix=ANN").get_json()
+    assert data['names'] == ["Ann Lee", "Annie Moss"]
+    assert [e['name'] for e in data['emails']] == ["Ann Lee", "Annie Moss"]
+    phones = client.get("/api/contacts/suggest?prefix=555-555&limit=1").get_json()['phones']
+    assert phones == [{'value': "(555) 555-1234", 'name': "Ann Lee"}]
+    assert client.get("/api/contacts/suggest?prefix=a&limit=51").status_code == 400
+
+    cm.update_contact("Ann Lee", "Zed", "4441112222", "zed@example.com")
+    cm.delete_contact("Annie Moss")
+    data = cm.suggest("ann")
+    assert data == {'names': [], 'phones': [], 'emails': []}
+    assert [p['name'] for p in cm.suggest("444")['phones']] == ["Zed", "Bob"], "Sorted by phone number"
+
+
+def test_list_by_creation_and_update_time(client, cm):
+    cm.import_contacts([
+        '{"name": "Old", "phone": "1234567890", "created_at": "2020-01-01T00:00:00"}',
+        '{"name": "Mid", "phone": "1234567890", "created_at": "2022-01-01T00:00:00"}',
+        '{"name": "New", "phone": "1234567890", "created_at": "2024-01-01T00:00:00"}',
+    ])
+    names = lambda response: [c['name'] for c in response.get_json()['contacts']]
+    first = client.get("/api/contacts?order=-created_at&limit=2")
+    assert names(first) == ["New", "Mid"]
+    rest = client.get(f"/api/contacts?order=-created_at&limit=2&cursor={first.get_json()['next_cursor']}")
+    assert names(rest) == ["Old"] and rest.get_json()['next_cursor'] is None
+
+    cm.update_contact("Old", "Old", "1234567890")
+    listed = client.get("/api/contacts?order=-updated_at").get_json()
+    assert [c['name'] for c in listed] == ["Old", "New", "Mid"], "An update moves a contact to the front"
+    assert [c['name'] for c in cm.search_contacts("mid", 'created_at')] == ["Mid"]
+    assert client.get("/api/contacts?order=phone").status_code == 400
+    assert client.get("/api/contacts?order=created_at&limit=2&cursor=YWJj").status_code == 400
+    assert b"Newest" in client.get("/?order=-created_at").data
+
+
+def test_metrics_endpoint(client, cm, monkeypatch):
+    registry = web.Registry()
+    monkeypatch.setattr(web, "http_metrics", registry)
+    monkeypatch.setattr(web, "request_seconds", registry.histogram(
+        web.request_seconds.name, web.request_seconds.help, web.request_seconds.labels))
+    add_people(cm, 3)
+    cm.search_contacts("person")
+    client.get("/api/contacts?search=person")
+    client.get("/no-such-page")
+
+    def fail(*args):
+        raise IOError("disk full")
+    monkeypatch.setattr(cm.storage, "apply", fail)
+    assert not cm.add_contact("Broken", "1234567890")[0]
+
+    response = client.get("/metrics")
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert "contacts_total 4" in text, "The failed add is still in memory"
+    assert 'contacts_storage_errors_total{operation="apply"} 1' in text
+    assert 'contacts_search_results_bucket{le="10"} 1' in text
+    assert ('contacts_http_request_duration_seconds_count'
+            '{route="/api/contacts",method="GET",status="200"} 1') in text
+    assert 'route="unmatched",method="GET",status="404"' in text
+    assert cm.metrics.as_dict()["contacts_storage_written_bytes_total"] > 0
+
+
+def test_profiling_with_token_and_sampling(client, cm, monkeypatch):
+    monkeypatch.setattr(web, "PROFILE_TOKEN", "secret")
+    monkeypatch.setattr(web, "profiler", web.RequestProfiler(keep=2))
+    add_people(cm, 5)
+    token = {"X-Profile-Token": "secret"}
+
+    assert client.get("/admin/profiles").status_code == 403
+    assert client.get("/api/stats", headers={"X-Profile-Token": "sécret"}).status_code == 200
+    assert client.get("/admin/profiles", headers={"X-Profile-Token": "sécret"}).status_code == 403
+    assert "X-Profile-Id" not in client.get("/api/contacts?search=person").headers, "Off by default"
+    cm.result_cache.clear()
+    response = client.get("/api/contacts?search=person", headers=token)
+    report = client.get(f"/admin/profiles/{response.headers['X-Profile-Id']}", headers=token).get_json()
+    assert report["route"] == "/api/contacts" and report["forced"]
+    assert any("search_contacts" in f["function"] for f in report["functions"])
+    assert b"cumulative" in client.get(f"/admin/profiles/{report['id']}?format=text", headers=token).data
+
+    settings = client.put("/admin/profiles/settings", json={"sample_rate": 1, "slow_ms": None},
+                          headers=token).get_json()
+    assert settings["sample_rate"] == 1
+    for _ in range(3):
+        client.get("/")
+    profiles = client.get("/admin/profiles", headers=token).get_json()["profiles"]
+    assert [p["route"] for p in profiles] == ["/", "/"], "The ring buffer keeps the last two"
+    client.put("/admin/profiles/settings", json={"slow_ms": 60000}, headers=token)
+    client.delete("/admin/profiles", headers=token)
+    client.get("/")
+    assert client.get("/admin/profiles", headers=token).get_json()["profiles"] == [], \
+        "Requests faster than slow_ms are not kept"
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(cm, "get_stats", broken)
+    monkeypatch.setitem(web.app.config, "PROPAGATE_EXCEPTIONS", True)
+    with pytest.raises(RuntimeError):
+        client.get("/api/stats", headers=token)
+    del cm.get_stats
+    skipped = web.profiler.skipped_busy
+    assert "X-Profile-Id" in client.get("/api/stats", headers=token).headers, \
+        "A request that raised left the profiler busy"
+    assert web.profiler.skipped_busy == skipped
+
+    monkeypatch.setattr(web, "PROFILE_TOKEN", "")
+    assert client.get("/admin/profiles", headers=token).status_code == 404
+
+
+def test_optional_uniqueness_checks(tmp_path):
+    cm = web.ContactManager(str(tmp_path / "contacts.json"), unique_phones=True, unique_emails=True)
+    assert cm.add_contact("Ann", "5555551234", "ann@example.com")[0]
+    assert cm.add_contact("Bob", "(555) 555-1234") == (False, "Phone number already belongs to Ann")
+    assert cm.add_contact("Bob", "5555550000", "ANN@example.com") == (False, "Email already belongs to Ann")
+    assert cm.update_contact("Ann", "Ann B", "555-555-1234", "ann@example.com")[0], \
+        "A contact may keep its own phone number and email"
+    success, result = cm.import_contacts(['{"name": "C", "phone": "5555557777"}',
+                                          '{"name": "D", "phone": "555 555 7777"}'])
+    assert result['imported'] == 1 and result['errors'][0]['line'] == 2
+
+
+def test_duplicates_found_and_merged(client, cm):
+    cm.add_contact("John Doe", "1 (555) 123-4567", "", "1 Main St")
+    cm.add_contact("Jon Doe", "555 123 4567", "jd@example.com")
+    cm.add_contact("Doe, John", "4445550000")
+    cm.add_contact("Jane Doe", "5551234567")
+    cm.add_contact("Bob", "5550000000", "JD+work@example.com")
+
+    data = client.get("/api/duplicates").get_json()
+    assert data['count'] == 1
+    cluster = data['clusters'][0]
+    assert sorted(c['name'] for c in cluster['contacts']) == ["Doe, John", "John Doe", "Jon Doe"], \
+        "Jane Doe only shares a phone number, Bob only an email address"
+    assert cluster['keep'] in ("John Doe", "Jon Doe")
+    assert client.get("/api/duplicates?threshold=2").status_code == 400
+
+    response = client.post("/api/duplicates/merge", json={'names': ["Jon Doe", "Doe, John"],
+                                                          'keep': "Doe, John"})
+    assert response.status_code == 200 and response.get_json()['merged'] == 1
+    merged = cm.get_contact("Doe, John")
+    assert cm.get_contact("Jon Doe") is None
+    assert (merged['phone'], merged['email']) == ("4445550000", "jd@example.com"), \
+        "The kept contact's phone wins, its empty email is filled in"
+
+    response = client.post("/api/duplicates/merge", json={'all': True})
+    assert response.get_json()['results'][0]['success']
+    assert sorted(cm.contacts) == ["bob", "jane doe", "john doe"], "Ties keep the oldest contact"
+    assert cm.get_contact("John Doe")['email'] == "jd@example.com"
+    assert client.post("/api/duplicates/merge", json={'names': ["Bob"]}).status_code == 422
+    assert client.post("/api/duplicates/merge", json={'names': "Bob"}).status_code == 400
+
+
+def test_structured_query_matches_scan_and_explains_plan(client, cm):
+    lines = [json.dumps({'name': f"Person {i:03d}", 'phone': f"555-01{i:02d}-0000",
+                         'email': f"p{i}@{'acme.com' if i % 10 == 0 else 'example.com'}",
+                         'created_at': f"2026-01-{i % 28 + 1:02d}T12:00:00"}) for i in range(100)]
+    lines.append('{"name": "Jo Old", "phone": "5550000000", "email": "jo@acme.com"}')
+    cm.import_contacts(lines)
+    names = lambda search: [c['name'] for c in cm.search_contacts(search)]
+
+    assert names("name:person* email:@acme.com added:>2026-01-20") == \
+        [c['name'] for c in sorted(cm.contacts.values(), key=lambda c: c['name'].lower())
+         if c['name'].startswith("Person") and c['email'].endswith("@acme.com")
+         and c['created_at'] > "2026-01-21"]
+    assert names('name:"jo old"') == ["Jo Old"]
+    assert names("phone:555-0142-0000") == ["Person 042"], "Exact phone ignores formatting"
+    assert names("phone:5550142*") == ["Person 042"]
+    assert names("email:P7@EXAMPLE.com") == ["Person 007"]
+    assert names("added:2026-01-05 email:p4*") == ["Person 004"]
+
+    plan = client.get("/api/contacts?search=email:p42@example.com name:person*&explain=1").get_json()
+    assert [(s['index'], s['action']) for s in plan['steps']] == \
+        [('email hash', 'driver'), ('name prefix', 'filter')]
+    assert plan['candidates'] == 1 and not plan['scan']
+    plan = cm.explain("added:>2026-01-15 email:@example.com")
+    assert [(s['index'], s['action']) for s in plan['steps']] == \
+        [('added range', 'driver'), ('trigram', 'intersect')]
+    assert plan['steps'][1]['remaining'] < plan['steps'][0]['remaining']
+    plan = cm.explain("name:pe")
+    assert plan['scan'] and plan['steps'][0]['index'] is None, "Too short for the trigram index"
+    assert client.get("/api/contacts?search=added:>yesterday").status_code == 400
+    for empty in ("name:*", "email:*", "phone:*", "phone:-*"):
+        response = client.get(f"/api/contacts?search={empty}")
+        assert response.status_code == 400 and "before the *" in response.get_json()['error'], empty
+
+    cm.search_contacts("email:@acme.com")
+    cm.add_contact("Zed", "1234567890", "zed@acme.com")
+    assert "Zed" in names("email:@acme.com"), "Cached query results are invalidated"
+
+
+def test_time_range_filters_and_recent_view(tmp_path, monkeypatch):
+    filename = tmp_path / "contacts.json"
+    filename.write_text(json.dumps({
+        "legacy": {"name": "Legacy", "phone": "1234567890", "email": "", "address": ""},
+        "old": {"name": "Old", "phone": "1234567890", "email": "", "address": "",
+                "created_at": "2020-01-01T00:00:00", "updated_at": "2025-06-01T00:00:00"},
+        "mid": {"name": "Mid", "phone": "1234567890", "email": "", "address": "",
+                "created_at": "2022-03-04"},
+        "new": {"name": "New", "phone": "1234567890", "email": "", "address": "",
+                "created_at": "2024-01-01T08:30:00.250000"},
+    }))
+    cm = web.ContactManager(str(filename))
+    monkeypatch.setattr(web, "cm", cm)
+    client = web.app.test_client()
+    names = lambda query: [c['name'] for c in client.get(f"/api/contacts?{query}").get_json()]
+
+    assert cm.created_order._values.typecode == 'q' and cm.created_order.undated == 1
+    assert names("created_after=2022-03-04") == ["Mid", "New"], "After includes the day given"
+    assert names("created_before=2022-03-04") == ["Old"]
+    assert names("created_after=2024-01-01 08:30:00.250000") == ["New"]
+    assert names("updated_before=2024-06-01&order=-updated_at") == ["New", "Mid"], \
+        "Never-updated contacts use created_at"
+    assert names("search=ol&updated_after=2025-01-01") == ["Old"]
+    assert names("order=created_at") == ["Legacy", "Old", "Mid", "New"], \
+        "Contacts without timestamps are still listed, first"
+    assert client.get("/api/contacts?created_after=someday").status_code == 400
+
+    first = client.get("/api/contacts?order=-created_at&created_after=2020-01-01&limit=2").get_json()
+    rest = client.get("/api/contacts?order=-created_at&created_after=2020-01-01&limit=2"
+                      f"&cursor={first['next_cursor']}").get_json()
+    assert [c['name'] for c in first['contacts'] + rest['contacts']] == ["New", "Mid", "Old"]
+
+    cm.add_contact("Fresh", "1234567890")
+    response = client.get("/recent")
+    assert response.status_code == 302 and "order=-created_at" in response.location
+    page = client.get(response.location).data
+    assert b"Fresh" in page and b"Legacy" not in page
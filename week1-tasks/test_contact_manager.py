@@ -52,5 +52,120 @@ def test_contact_manager():
     print("\n🎉 All tests passed successfully!")
     print("Contact Management System is working correctly.")
 
+
+def test_contact_statistics():
+    """Statistics follow adds and deletes without rescanning"""
+    test_cm = ContactManager("test_stats_contacts.json")
+    try:
+        test_cm.add_contact("Stat One", "1234567890", "one@example.com", "1 Main St")
+        test_cm.add_contact("Stat Two", "1234567890", "", "")
+        test_cm.add_contact("Stat Three", "1234567890", "three@example.com", "")
+        test_cm._remove_contact("stat three")
+
+        assert test_cm.get_stats() == {'total': 2, 'with_email': 1, 'with_address': 1}
+        assert test_cm.stats.domain_counts() == {'example.com': 1}
+    finally:
+        if os.path.exists("test_stats_contacts.json"):
+            os.remove("test_stats_contacts.json")
+
+
+def test_update_keeps_concurrent_edits(monkeypatch):
+    """Fields left unchanged at the prompts keep what another process saved meanwhile"""
+    test_cm = ContactManager("test_update_contacts.json")
+    try:
+        test_cm.add_contact("Ann Lee", "1234567890", "ann@example.com", "")
+        other = ContactManager("test_update_contacts.json")
+        answers = iter(["", "5550001111", "", ""])
+
+        def prompt(text):
+            if text.startswith("Address"):
+                other.contacts["ann lee"]["email"] = "ann@elsewhere.org"
+                other.commit_changes([("ann lee", other.contacts["ann lee"])])
+            return next(answers)
+        monkeypatch.setattr("builtins.input", prompt)
+
+        assert test_cm.update_contact("Ann Lee")
+        ann = ContactManager("test_update_contacts.json").contacts["ann lee"]
+        assert ann["phone"] == "5550001111" and ann["email"] == "ann@elsewhere.org"
+    finally:
+        if os.path.exists("test_update_contacts.json"):
+            os.remove("test_update_contacts.json")
+
+
+def test_list_all_contacts_in_name_order(capsys):
+    """Listing walks the ordered index, which follows adds and deletes"""
+    test_cm = ContactManager("test_order_contacts.json")
+    try:
+        for name in ("carol", "Alice", "bob", "Dave"):
+            test_cm.add_contact(name, "1234567890", "", "")
+        test_cm._remove_contact("dave")
+        capsys.readouterr()
+        test_cm.list_all_contacts()
+        names = [line[6:] for line in capsys.readouterr().out.splitlines() if line.startswith("Name: ")]
+        assert names == ["Alice", "bob", "carol"]
+        assert [c['name'] for c in test_cm.search_contact("o")] == ["bob", "carol"]
+    finally:
+        if os.path.exists("test_order_contacts.json"):
+            os.remove("test_order_contacts.json")
+
+
+def test_cli_metrics():
+    """The CLI manager records the same storage and search metrics as the web app"""
+    test_cm = ContactManager("test_metrics_contacts.json")
+    try:
+        test_cm.add_contact("Metric One", "1234567890", "", "")
+        test_cm.search_contact("metric")
+        metrics = test_cm.get_metrics()
+        assert metrics["contacts_total"] == 1
+        assert metrics["contacts_storage_duration_seconds"]["apply"]["count"] == 1
+        assert metrics["contacts_storage_written_bytes_total"] > 0
+        assert metrics["contacts_search_results"] == {"count": 1, "sum": 1.0}
+    finally:
+        if os.path.exists("test_metrics_contacts.json"):
+            os.remove("test_metrics_contacts.json")
+
+
+def test_search_with_query_syntax(capsys):
+    """The CLI accepts the same queries as the web app, with free text matching names"""
+    test_cm = ContactManager("test_query_contacts.json")
+    try:
+        test_cm.add_contact("Jo Smith", "555-123-4567", "jo@acme.com", "")
+        test_cm.add_contact("Joan Doe", "5559990000", "joan@example.com", "")
+        test_cm.add_contact("Bob Jones", "5551110000", "bob@acme.com", "")
+        names = lambda term: [c["name"] for c in test_cm.search_contact(term)]
+
+        assert names("name:jo*") == ["Jo Smith", "Joan Doe"]
+        assert names("name:jo* email:@acme.com") == ["Jo Smith"]
+        assert names("phone:5551234567") == ["Jo Smith"]
+        assert names("jo") == ["Bob Jones", "Jo Smith", "Joan Doe"]
+        assert names("555") == [], "Free text only searches names in the CLI"
+        assert names("added:>2020-01-01") == [], "CLI contacts have no timestamps"
+        assert names("added:>soon") == []
+        assert "Invalid search" in capsys.readouterr().out
+    finally:
+        if os.path.exists("test_query_contacts.json"):
+            os.remove("test_query_contacts.json")
+
+
+def test_find_and_merge_duplicates():
+    """Near-duplicate names are clustered and merged into the most complete contact"""
+    test_cm = ContactManager("test_dedup_contacts.json")
+    try:
+        test_cm.add_contact("John Doe", "555-123-4567", "john@example.com", "")
+        test_cm.add_contact("Jon Doe", "1 555 123 4567", "", "1 Main St")
+        test_cm.add_contact("Jane Roe", "5551234567", "", "")
+        clusters = test_cm.find_duplicates()
+        assert [sorted(cluster) for cluster in clusters] == [["john doe", "jon doe"]]
+
+        assert test_cm.merge_contacts(list(clusters[0]))
+        assert sorted(test_cm.contacts) == ["jane roe", "john doe"]
+        assert test_cm.contacts["john doe"]["address"] == "1 Main St"
+        assert ContactManager("test_dedup_contacts.json").contacts == test_cm.contacts
+    finally:
+        if os.path.exists("test_dedup_contacts.json"):
+            os.remove("test_dedup_contacts.json")
+
+
 if __name__ == "__main__":
     test_contact_manager()
+    test_contact_statistics()
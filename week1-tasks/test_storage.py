@@ -0,0 +1,296 @@
+"""
+Tests for the storage backends used by the Contact Management System
+"""
+
+import json
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+import app as web
+from contact_manager import ContactManager
+from storage import JournalStorage, ShardedStorage, open_storage
+
+
+def test_journal_replays_changes(tmp_path):
+    """Changes appended to the journal are replayed on top of the snapshot"""
+    filename = str(tmp_path / "contacts.json")
+    cm = ContactManager(filename, storage="journal")
+    assert cm.add_contact("Test User", "1234567890", "test@example.com")
+    assert cm.add_contact("Other User", "0987654321", "")
+    del cm.contacts["other user"]
+    assert cm.commit_changes([("other user", None)])
+
+    assert not os.path.exists(filename), "Journal mode should not rewrite the snapshot"
+    reloaded = ContactManager(filename, storage="journal")
+    assert list(reloaded.contacts) == ["test user"], "Journal was not replayed"
+
+
+def test_journal_ignores_torn_write(tmp_path):
+    """A partially written journal line is dropped and trimmed from the file"""
+    filename = str(tmp_path / "contacts.json")
+    storage = JournalStorage(filename)
+    storage.apply([("a", {"name": "A"})], {})
+    storage.close()
+    with open(filename + ".journal", "ab") as file:
+        file.write(b'{"key":"b","value":{"na')
+
+    contacts = JournalStorage(filename).load()
+    assert contacts == {"a": {"name": "A"}}, "Torn line should be ignored"
+    with open(filename + ".journal", "rb") as file:
+        assert file.read().endswith(b"}}\n"), "Torn line should be trimmed"
+
+
+def test_journal_compaction(tmp_path):
+    """Compaction folds the journal into the snapshot"""
+    filename = str(tmp_path / "contacts.json")
+    storage = JournalStorage(filename, compact_bytes=200)
+    contacts = {}
+    for i in range(20):
+        contacts[f"user {i}"] = {"name": f"User {i}"}
+        storage.apply([(f"user {i}", contacts[f"user {i}"])], contacts)
+    storage.compact(contacts, background=False)
+    storage.close()
+
+    with open(filename) as file:
+        assert json.load(file) == contacts, "Snapshot should hold every contact"
+    assert not os.path.exists(filename + ".journal.1"), "Rotated journal should be removed"
+    assert JournalStorage(filename).load() == contacts
+
+
+def test_json_storage_writes_atomically(tmp_path):
+    """Saving leaves no temporary files behind and keeps the file's permissions"""
+    filename = str(tmp_path / "contacts.json")
+    storage = open_storage("json", filename)
+    storage.save({"a": {"name": "A"}})
+    assert sorted(os.listdir(tmp_path)) == ["contacts.json", "contacts.json.lock"]
+    plain = tmp_path / "plain.txt"
+    plain.write_text("")
+    assert os.stat(filename).st_mode == os.stat(plain).st_mode, "New files get the usual permissions"
+    os.chmod(filename, 0o640)
+    storage.save({"b": {"name": "B"}})
+    assert os.stat(filename).st_mode & 0o777 == 0o640, "Saving keeps the file's permissions"
+
+
+def test_journal_discards_uncommitted_batch(tmp_path):
+    """A batch is replayed only when its commit line made it to disk"""
+    filename = str(tmp_path / "contacts.json")
+    storage = JournalStorage(filename)
+    storage.apply([("a", {"name": "A"}), ("b", {"name": "B"})], {})
+    storage.close()
+    with open(filename + ".journal", "ab") as file:
+        file.write(b'{"begin":true}\n{"key":"c","value":{"name":"C"}}\n')
+
+    storage = JournalStorage(filename)
+    assert storage.load() == {"a": {"name": "A"}, "b": {"name": "B"}}
+    storage.apply([("d", {"name": "D"})], {})
+    storage.close()
+    assert set(JournalStorage(filename).load()) == {"a", "b", "d"}, "Later writes must survive"
+
+
+def test_sqlite_storage_round_trip(tmp_path):
+    """The SQLite backend persists adds, renames and deletes row by row"""
+    filename = str(tmp_path / "contacts.db")
+    cm = ContactManager(filename, storage="sqlite")
+    assert cm.add_contact("Test User", "1234567890", "test@example.com")
+    assert cm.add_contact("Other User", "0987654321", "")
+    cm._remove_contact("other user")
+    assert cm.commit_changes([("other user", None)])
+
+    cm.storage.close()
+    assert ContactManager(filename, storage="sqlite").contacts == cm.contacts
+
+
+def test_binary_snapshot_loads_lazily(tmp_path):
+    """A binary snapshot is mapped at startup; records and indexes are built when used"""
+    filename = str(tmp_path / "contacts.snap")
+    cm = web.ContactManager(filename, storage="binary")
+    assert cm.add_contact("Ann Lee", "1234567890", "ann@example.com")[0]
+    assert cm.add_contact("Bob", "0987654321")[0]
+    assert cm.contacts.overlay_size == 0, "Saving moves the mapping onto the new file"
+
+    reloaded = web.ContactManager(filename, storage="binary")
+    assert not reloaded.search_index.built and not reloaded.stats.built
+    # A writer saving (holding the storage lock) does not hold up the first query
+    saving, done = threading.Event(), threading.Event()
+
+    def hold_storage_lock():
+        with reloaded.storage.locked():
+            saving.set()
+            done.wait(5)
+    holder = threading.Thread(target=hold_storage_lock)
+    holder.start()
+    saving.wait(5)
+    try:
+        assert [c["name"] for c in reloaded.find_by_phone("1234567890")] == ["Ann Lee"]
+        assert holder.is_alive(), "The query waited for the storage lock"
+    finally:
+        done.set()
+        holder.join()
+    assert reloaded.contacts == cm.contacts
+    assert reloaded.contacts["ann lee"].created_at == cm.contacts["ann lee"].created_at
+    assert reloaded.update_contact("Bob", "Rob", "0987654321")[0]
+    assert not reloaded.search_index.built, "Writes before the first query leave indexes unbuilt"
+    assert [c["name"] for c in reloaded.search_contacts("ob")] == ["Rob"]
+    assert reloaded.get_stats()["total"] == 2 and reloaded.search_index.built
+    assert set(ContactManager(filename, storage="binary").contacts) == {"ann lee", "rob"}
+
+
+def test_convert_between_json_and_binary(tmp_path):
+    from scripts.convert_snapshot import convert
+
+    source = str(tmp_path / "contacts.json")
+    with open(os.path.join(os.path.dirname(__file__), "sample_contacts.json")) as file:
+        sample = json.load(file)
+    with open(source, "w") as file:
+        json.dump(sample, file)
+
+    assert convert(source, str(tmp_path / "contacts.snap")) == (len(sample), "binary")
+    assert convert(str(tmp_path / "contacts.snap"), str(tmp_path / "back.json")) == (len(sample), "json")
+    assert not os.path.exists(source + ".journal"), "Converting only reads the source"
+    with open(tmp_path / "back.json") as file:
+        assert json.load(file) == sample
+
+
+def test_migrate_json_to_sqlite(tmp_path):
+    """The migration script copies every contact, including journaled ones, read-only"""
+    from scripts.migrate_to_sqlite import migrate
+
+    source = str(tmp_path / "contacts.json")
+    with open(os.path.join(os.path.dirname(__file__), "sample_contacts.json")) as file:
+        sample = json.load(file)
+    with open(source, "w") as file:
+        json.dump(sample, file)
+    JournalStorage(source).apply([("new person", {"name": "New Person", "phone": "1234567890",
+                                                  "email": "", "address": ""})], {})
+    with open(source + ".journal", "ab") as file:
+        file.write(b'{"key": "half written"')  # another process's append in flight
+    journal_size = os.path.getsize(source + ".journal")
+
+    assert migrate(source, str(tmp_path / "contacts.db")) == len(sample) + 1
+    migrated = open_storage("sqlite", str(tmp_path / "contacts.db")).load()
+    assert migrated["john doe"] == sample["john doe"]
+    assert "new person" in migrated
+    assert os.path.getsize(source + ".journal") == journal_size, "The source is not modified"
+
+
+@pytest.mark.parametrize("kind", ["json", "journal", "sqlite", "sharded", "binary"])
+def test_managers_sharing_a_file_see_each_others_writes(tmp_path, kind):
+    """Two managers on one file (like two gunicorn workers) never lose writes"""
+    filename = str(tmp_path / "contacts.data")
+    first = web.ContactManager(filename, storage=kind)
+    second = web.ContactManager(filename, storage=kind)
+
+    assert first.add_contact("Alice", "1234567890")[0]
+    assert second.storage.changed()
+    assert second.sync() == 1 and second.get_contact("alice")
+    assert second.add_contact("Bob", "1234567890")[0]
+    assert first.add_contact("Carol", "1234567890")[0], "first must pick up Bob before writing"
+    assert not first.add_contact("Bob", "1234567890")[0], "duplicate check must see Bob"
+    assert first.delete_contact("Alice")[0]
+    second.sync()
+
+    assert set(second.contacts) == {"bob", "carol"}
+    assert second.get_stats()["total"] == 2
+    assert set(web.ContactManager(filename, storage=kind).contacts) == {"bob", "carol"}
+
+
+def test_journal_readers_follow_rotation_incrementally(tmp_path, monkeypatch):
+    """A reader that kept up with the journal carries on after compaction without a full reload"""
+    filename = str(tmp_path / "contacts.json")
+    writer = web.ContactManager(filename, storage="journal")
+    reader = web.ContactManager(filename, storage="journal")
+    writer.storage.compact_bytes = 400
+    monkeypatch.setattr(reader.storage, "load", lambda: pytest.fail("full reload"))
+
+    for i in range(12):
+        assert writer.add_contact(f"Person {i}", "1234567890")[0]
+        reader.sync()
+    writer.storage.wait_for_compaction()
+    assert "rotated" in writer.storage._read_header(), "journal should have been compacted"
+    assert writer.add_contact("Last Person", "1234567890")[0]
+    reader.sync()
+    assert set(reader.contacts) == set(writer.contacts)
+
+
+def _add_from_worker(filename, worker):
+    cm = web.ContactManager(filename, storage="journal")
+    for i in range(20):
+        cm.add_contact(f"Worker {worker} Person {i}", "1234567890")
+
+
+def test_journal_across_processes(tmp_path):
+    """Writes from several processes all end up in the journal"""
+    filename = str(tmp_path / "contacts.json")
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_add_from_worker, args=(filename, w)) for w in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+    assert len(web.ContactManager(filename, storage="journal").contacts) == 80
+
+
+def test_sharded_write_rewrites_one_shard(tmp_path):
+    """Adding a contact rewrites only the shard its key hashes to"""
+    directory = str(tmp_path / "contacts.shards")
+    cm = web.ContactManager(directory, storage="sharded")
+    for i in range(40):
+        assert cm.add_contact(f"Person {i}", "1234567890")[0]
+    before = {name: os.stat(os.path.join(directory, name)).st_mtime_ns
+              for name in os.listdir(directory)}
+    assert cm.add_contact("Late Arrival", "1234567890")[0]
+    rewritten = [name for name in os.listdir(directory)
+                 if os.stat(os.path.join(directory, name)).st_mtime_ns != before.get(name)]
+    assert rewritten == [os.path.basename(cm.storage.shard_path(cm.storage.shard_of("late arrival")))]
+    assert web.ContactManager(directory, storage="sharded").contacts == cm.contacts
+
+
+def test_sharded_rename_finishes_after_crash(tmp_path, monkeypatch):
+    """A rename across shards that died halfway is completed from the intent file"""
+    directory = str(tmp_path / "contacts.shards")
+    storage = ShardedStorage(directory, shards=4)
+    contacts = storage.load()
+    old_key = "alice"
+    new_key = next(k for k in ("alicia", "ally", "alison", "alice b") if
+                   storage.shard_of(k) != storage.shard_of(old_key))
+    contacts[old_key] = {"name": "Alice", "phone": "1234567890"}
+    storage.apply([(old_key, contacts[old_key])], contacts)
+
+    contacts[new_key] = contacts.pop(old_key)
+    written = []
+    write_json = storage._write_json
+
+    def crash_after_first_shard(path, data):
+        if "shard-" in path and written:
+            raise KeyboardInterrupt("power cut")
+        write_json(path, data)
+        if "shard-" in path:
+            written.append(path)
+    monkeypatch.setattr(storage, "_write_json", crash_after_first_shard)
+    with pytest.raises(KeyboardInterrupt):
+        storage.apply([(old_key, None), (new_key, contacts[new_key])], contacts)
+    assert os.path.exists(storage.intent_path)
+
+    recovered = ShardedStorage(directory).load()
+    assert recovered == {new_key: {"name": "Alice", "phone": "1234567890"}}
+    assert not os.path.exists(storage.intent_path)
+
+
+def test_reshard_keeps_contacts(tmp_path):
+    from scripts.reshard import reshard
+
+    directory = str(tmp_path / "contacts.shards")
+    cm = web.ContactManager(directory, storage="sharded")
+    for i in range(30):
+        assert cm.add_contact(f"Person {i}", "1234567890")[0]
+    other = web.ContactManager(directory, storage="sharded")
+
+    assert reshard(directory, 5) == 30
+    assert len([name for name in os.listdir(directory) if name.startswith("shard-")]) == 5
+    assert other.sync() == 0, "Resharding should not change any contact"
+    assert other.add_contact("After Reshard", "1234567890")[0]
+    reloaded = ShardedStorage(directory)
+    assert len(reloaded.load()) == 31 and reloaded.shards == 5